@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 """
 Various decorator functions
-    - Memoization with args and kwargs (@memoized)
+    - Memoization with args and kwargs (@memoized, @memoized(maxsize=10))
+    - Dictionaries with values loaded on first access (L{LazyDict})
     - Make a parallel version of a function (@make_parallel)
     - Retry with exponential backoff (@retry(3,2))
     - Retry accessing website with exponential backoff (@retry(3,2))
@@ -13,6 +14,10 @@ Various decorator functions
 """
 import functools
 import cPickle
+import hashlib
+import threading
+import collections
+import os
 import time
 import logging
 import sys
@@ -20,27 +25,326 @@ import math
 import socket
 import logging
 import inspect
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 logger = logging.getLogger("DEC")
 memory = {}
 
-#{ Common tools
-def memoized(fctn):
+#{ Memoization
+
+class LRUCache(object):
+    """
+    Least-recently-used cache with an optional limit on the number of entries
+    and on the (estimated) memory used by the cached values.
+    
+    When one of the limits is exceeded, the least recently used entries are
+    evicted. The cache keeps track of the number of hits, misses and
+    evictions. All operations are protected by a lock, so the cache can be
+    shared between threads. Processes never share a cache: after a fork, the
+    child process continues with its own copy.
+    
+    If given, C{on_evict} is called as C{on_evict(key,value)} for every entry
+    that is evicted or cleared, e.g. to close file handles.
+    """
+    def __init__(self,maxsize=None,maxmem=None,on_evict=None):
+        """
+        @param maxsize: maximum number of entries (None for no limit)
+        @type maxsize: int
+        @param maxmem: maximum memory of the cached values in bytes (None for no limit)
+        @type maxmem: int
+        @param on_evict: function to call on evicted entries
+        @type on_evict: callable
+        """
+        self.maxsize = maxsize
+        self.maxmem = maxmem
+        self.on_evict = on_evict
+        self.data = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+    
+    def _check_fork(self):
+        """
+        Renew the lock in a forked process: it could have been copied in a
+        locked state.
+        """
+        if self._pid!=os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.RLock()
+    
+    def get(self,key,default=None):
+        """
+        Retrieve a value from the cache and mark it as most recently used.
+        """
+        self._check_fork()
+        with self._lock:
+            if key in self.data:
+                value,nbytes = self.data.pop(key)
+                self.data[key] = value,nbytes
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+    
+    def put(self,key,value):
+        """
+        Add a value to the cache and evict old values if necessary.
+        """
+        self._check_fork()
+        nbytes = _sizeof(value)
+        with self._lock:
+            if key in self.data:
+                self.nbytes -= self.data.pop(key)[1]
+            self.data[key] = value,nbytes
+            self.nbytes += nbytes
+            self._evict()
+    
+    def resize(self,maxsize=None,maxmem=None):
+        """
+        Change the limits of the cache, evicting entries if needed.
+        """
+        self._check_fork()
+        with self._lock:
+            self.maxsize = maxsize
+            self.maxmem = maxmem
+            self._evict()
+    
+    def _evict(self):
+        """
+        Remove least recently used entries until the limits are satisfied. The
+        most recent entry is always kept.
+        """
+        while len(self.data)>1 and \
+             ((self.maxsize is not None and len(self.data)>self.maxsize) or \
+              (self.maxmem is not None and self.nbytes>self.maxmem)):
+            key,(value,nbytes) = self.data.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key,value)
+    
+    def clear(self):
+        """
+        Remove all entries from the cache (statistics are kept).
+        """
+        self._check_fork()
+        with self._lock:
+            if self.on_evict is not None:
+                for key,(value,nbytes) in self.data.items():
+                    self.on_evict(key,value)
+            self.data.clear()
+            self.nbytes = 0
+    
+    def info(self):
+        """
+        Return statistics on the use of the cache.
+        
+        @return: hits, misses, evictions, current number of entries and bytes, limits
+        @rtype: dict
+        """
+        return dict(hits=self.hits,misses=self.misses,evictions=self.evictions,
+                    size=len(self.data),nbytes=self.nbytes,
+                    maxsize=self.maxsize,maxmem=self.maxmem)
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __contains__(self,key):
+        return key in self.data
+
+
+class LazyDict(dict):
+    """
+    Dictionary of which some values are only computed (loaded) on first access.
+    
+    A lazy value is set with C{set_lazy(key,loader)}: C{loader()} is called
+    the first time the key is accessed, and its result replaces the lazy value.
+    Until then, the key is in the dictionary, but nothing is loaded. Methods
+    that return all values (C{values}, C{items}, C{copy}, pickling) load all
+    lazy values first.
+    
+    >>> d = LazyDict(a=1)
+    >>> d.set_lazy('b',lambda: 2)
+    >>> d.is_lazy('b')
+    True
+    >>> d['b']
+    2
+    >>> d.is_lazy('b')
+    False
+    """
+    def __init__(self,*args,**kwargs):
+        dict.__init__(self,*args,**kwargs)
+        self._loaders = {}
+    
+    def set_lazy(self,key,loader):
+        """
+        Set a value that is loaded on first access.
+        
+        @param key: key
+        @type key: hashable
+        @param loader: function without arguments returning the value
+        @type loader: callable
+        """
+        dict.__setitem__(self,key,None)
+        self._loaders[key] = loader
+    
+    def is_lazy(self,key):
+        """
+        Check whether a value is not loaded yet.
+        """
+        return key in self._loaders
+    
+    def load(self):
+        """
+        Load all lazy values.
+        """
+        for key in list(self._loaders.keys()):
+            self[key]
+    
+    def __getitem__(self,key):
+        if key in self._loaders:
+            dict.__setitem__(self,key,self._loaders.pop(key)())
+        return dict.__getitem__(self,key)
+    
+    def __setitem__(self,key,value):
+        self._loaders.pop(key,None)
+        dict.__setitem__(self,key,value)
+    
+    def __delitem__(self,key):
+        self._loaders.pop(key,None)
+        dict.__delitem__(self,key)
+    
+    def get(self,key,default=None):
+        return self[key] if key in self else default
+    
+    def pop(self,key,*default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self,key,*default)
+    
+    def values(self):
+        self.load()
+        return dict.values(self)
+    
+    def itervalues(self):
+        self.load()
+        return dict.itervalues(self)
+    
+    def items(self):
+        self.load()
+        return dict.items(self)
+    
+    def iteritems(self):
+        self.load()
+        return dict.iteritems(self)
+    
+    def copy(self):
+        self.load()
+        return LazyDict(dict.items(self))
+    
+    def __reduce__(self):
+        self.load()
+        return (LazyDict,(dict(dict.items(self)),))
+
+
+def _sizeof(value):
+    """
+    Estimate the memory used by a (nested) return value.
+    
+    Arrays count with their number of bytes, containers with the sum of their
+    contents.
+    """
+    if np is not None and isinstance(value,np.ndarray):
+        return value.nbytes
+    elif isinstance(value,(list,tuple)):
+        return sum([_sizeof(val) for val in value])
+    elif isinstance(value,dict):
+        return sum([_sizeof(val) for val in value.values()])
+    return sys.getsizeof(value)
+
+
+def make_key(obj):
+    """
+    Make a cheap, hashable key from (nested) function arguments.
+    
+    Arrays are represented by their shape, type and a hash of their contents,
+    which is much faster than pickling them. Containers are converted
+    recursively, other hashable objects are used as is, and everything else
+    is pickled.
+    
+    @param obj: function argument(s)
+    @return: hashable key
+    """
+    if np is not None and isinstance(obj,np.ndarray):
+        if obj.dtype.hasobject:
+            return ('ndarray',obj.shape,make_key(obj.tolist()))
+        digest = hashlib.md5(np.ascontiguousarray(obj).view(np.uint8)).hexdigest()
+        return ('ndarray',obj.shape,obj.dtype.str,digest)
+    elif isinstance(obj,(list,tuple)):
+        return (type(obj).__name__,)+tuple([make_key(val) for val in obj])
+    elif isinstance(obj,dict):
+        return ('dict',)+tuple(sorted([(key,make_key(val)) for key,val in obj.iteritems()]))
+    elif isinstance(obj,(set,frozenset)):
+        return ('set',frozenset([make_key(val) for val in obj]))
+    try:
+        hash(obj)
+    except TypeError:
+        return ('pickle',cPickle.dumps(obj,-1))
+    return obj
+
+
+def memoized(fctn=None,maxsize=None,maxmem=None):
     """
     Cache a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned, and
     not re-evaluated.
+    
+    Without arguments, the cache is unbounded:
+    
+    >>> @memoized
+    ... def myfunc(x):
+    ...     return x**2
+    
+    You can limit the number of cached results (C{maxsize}) and/or their total
+    size in bytes (C{maxmem}), in which case the least recently used results
+    are discarded:
+    
+    >>> @memoized(maxsize=2)
+    ... def myfunc(x):
+    ...     return x**2
+    >>> output = myfunc(1),myfunc(2),myfunc(3),myfunc(3)
+    >>> print myfunc.cache_info()['hits'],myfunc.cache_info()['evictions']
+    1 1
+    
+    The cache of a function is available as C{myfunc.cache} (see L{LRUCache}),
+    and can be cleared with C{myfunc.cache.clear()} or with
+    L{clear_memoization}.
     """
+    if fctn is None:
+        return functools.partial(memoized,maxsize=maxsize,maxmem=maxmem)
+    cache = LRUCache(maxsize=maxsize,maxmem=maxmem)
+    memory.setdefault(fctn.__module__,{})[fctn.__name__] = cache
+    missing = object()
+    
     @functools.wraps(fctn)
     def memo(*args,**kwargs):
-        haxh = cPickle.dumps((fctn.__name__, args, sorted(kwargs.iteritems())))
-        modname = fctn.__module__
-        if not (modname in memory):
-            memory[modname] = {}
-        if not (haxh in memory[modname]):
-            memory[modname][haxh] = fctn(*args,**kwargs)
+        haxh = make_key((args,kwargs))
+        output = cache.get(haxh,missing)
+        if output is missing:
+            output = fctn(*args,**kwargs)
+            cache.put(haxh,output)
             logger.debug("Function %s memoized"%(str(fctn)))
-        return memory[modname][haxh]
+        return output
+    memo.cache = cache
+    memo.cache_info = cache.info
     if memo.__doc__:
         memo.__doc__ = "\n".join([memo.__doc__,"This function is memoized."])
     return memo
@@ -48,14 +352,39 @@ def memoized(fctn):
 def clear_memoization(keys=None):
     """
     Clear contents of memory
+    
+    @param keys: module names to clear (default: all)
+    @type keys: list of str
     """
     if keys is None:
         keys = memory.keys()
     for key in keys:
         if key in memory:
-            riddens = [memory[key].pop(ikey) for ikey in memory[key].keys()[:]]
+            for cache in memory[key].values():
+                cache.clear()
     logger.debug("Memoization cleared")
 
+def memoization_stats(keys=None):
+    """
+    Collect the cache statistics of all memoized functions.
+    
+    @param keys: module names to include (default: all)
+    @type keys: list of str
+    @return: statistics per 'module.function'
+    @rtype: dict
+    """
+    if keys is None:
+        keys = memory.keys()
+    stats = {}
+    for key in keys:
+        for name,cache in memory.get(key,{}).items():
+            stats['%s.%s'%(key,name)] = cache.info()
+    return stats
+
+#}
+
+#{ Common tools
+
 def make_parallel(fctn):
     """
     Make a parallel version of a function.
@@ -289,6 +289,33 @@ def random_rectangular_grid(gridpoints,size):
 
     return sample
 
+def interp_rows(x,xp,fp):
+    """
+    Linearly interpolate every row of a 2D array C{fp} from C{xp} onto C{x}.
+    
+    The interpolation weights are computed only once for all rows. Outside
+    the range of C{xp}, the edge values are repeated (as in C{np.interp}).
+    
+    >>> fp = np.array([[0.,1.,2.],[0.,2.,4.]])
+    >>> print interp_rows(np.array([0.5,1.5,3.]),np.array([0.,1.,2.]),fp)
+    [[ 0.5  1.5  2. ]
+     [ 1.   3.   4. ]]
+    
+    @param x: x-coordinates to interpolate onto
+    @type x: 1D array
+    @param xp: increasing x-coordinates of the rows
+    @type xp: 1D array
+    @param fp: values to interpolate, one row per function
+    @type fp: 2D array
+    @return: interpolated rows
+    @rtype: 2D array
+    """
+    x = np.clip(x,xp[0],xp[-1])
+    right = np.clip(np.searchsorted(xp,x),1,len(xp)-1)
+    left = right-1
+    weight = (x-xp[left])/(xp[right]-xp[left])
+    return fp[:,left]*(1-weight) + fp[:,right]*weight
+
 #}
 #{ Record arrays
 
@@ -12,20 +12,30 @@ http://alfven.org/wp/hdf5-for-python/
 
 import os
 import h5py
+import numpy as np
 import logging
 from ivs.aux import loggers
+from ivs.aux.decorators import LazyDict
 
 logger = logging.getLogger("IO.HDF5")
 logger.addHandler(loggers.NullHandler())
 
 #{ Input
 
-def read2dict(filename):
+def read2dict(filename, lazy_size=None):
     """
     Read the filestructure of a hdf5 file to a dictionary.
     
+    If C{lazy_size} is given, datasets with more elements than C{lazy_size}
+    are not read immediately: they are read from the file the first time they
+    are accessed in the dictionary (see L{ivs.aux.decorators.LazyDict}). This
+    way, the small datasets and attributes of a large file can be inspected
+    without reading everything.
+    
     @param filename: the name of the hdf5 file to read
     @type filename: str
+    @param lazy_size: datasets larger than this are loaded on first access
+    @type lazy_size: int
     @return: dictionary with read filestructure
     @rtype: dict
     """
@@ -33,15 +43,19 @@ def read2dict(filename):
     if not os.path.isfile(filename):
         logger.error('The file you try to read does not exist!')
         raise IOError
+    filename = os.path.abspath(filename)
     
     def read_rec(hdf):
         """ recusively read the hdf5 file """
-        res = {}
+        res = {} if lazy_size is None else LazyDict()
         for name,grp in hdf.items():
             #-- read the subgroups and datasets
             if hasattr(grp, 'items'):
                 # in case of a group, read the group into a new dictionary key
                 res[name] = read_rec(grp)
+            elif lazy_size is not None and grp.size > lazy_size:
+                # in case of a large dataset, read the value when it is needed
+                res.set_lazy(name, _dataset_loader(filename, grp.name))
             else:
                 # in case of dataset, read the value
                 res[name] = grp.value
@@ -49,7 +63,9 @@ def read2dict(filename):
         #-- read all the attributes
         for name, atr in hdf.attrs.iteritems():
             res[name] = atr
-                
+        
+        if lazy_size is not None:
+            res.source = filename, hdf.name
         return res
     
     hdf = h5py.File(filename, 'r')
@@ -58,11 +74,44 @@ def read2dict(filename):
     
     return result
 
+def _dataset_loader(filename, name):
+    """
+    Return a function that reads a dataset from a hdf5 file.
+    """
+    def loader():
+        hdf = h5py.File(filename, 'r')
+        try:
+            return hdf[name][...]
+        finally:
+            hdf.close()
+    return loader
+
+def read_records(filename, name):
+    """
+    Read a table of records written with L{append_records}.
+    
+    @param filename: the name of the hdf5 file to read
+    @type filename: str
+    @param name: name of the dataset
+    @type name: str
+    @return: the records, or None if the file or dataset does not exist
+    @rtype: record array
+    """
+    if not os.path.isfile(filename):
+        return None
+    hdf = h5py.File(filename, 'r')
+    try:
+        if not name in hdf:
+            return None
+        return hdf[name][...].view(np.recarray)
+    finally:
+        hdf.close()
+
 #}
 
 #{ Output
 
-def write_dict(data, filename, update=True, attr_types=[]):
+def write_dict(data, filename, update=True, attr_types=[], compression=None, chunk_size=1024):
     """
     Write the content of a dictionary to a hdf5 file. The dictionary can contain other
     nested dictionaries, this file stucture will be maintained in the saved hdf5 file.
@@ -72,6 +121,11 @@ def write_dict(data, filename, update=True, attr_types=[]):
     the same type: ['bla', 1, 24.5] will become ['bla', '1', '24.5']. Upt till now there
     is nothing in place to check this, or correct it when reading a hdf5 file.
     
+    Arrays with more than C{chunk_size} elements are stored as chunked datasets,
+    compressed with the C{compression} filter if given. Datasets of a
+    dictionary read lazily from the same file with L{read2dict}, that were
+    never accessed, are unchanged and thus not written again.
+    
     @param data: the dictionary to write to file
     @type data: dict
     @param filename: the name of the hdf5 file to write to
@@ -81,16 +135,28 @@ def write_dict(data, filename, update=True, attr_types=[]):
     @param attr_types: the data types that you want to save as an attribute instead of
                        a dataset. (standard everything is saved as dataset.)
     @type attr_types: List of types
+    @param compression: compression filter for large datasets (e.g. 'gzip')
+    @type compression: str
+    @param chunk_size: minimum number of elements of a chunked dataset
+    @type chunk_size: int
     """
     
     if not update and os.path.isfile(filename):
+        #-- lazy values could still need to be read from the old file
+        _load_lazy(data, os.path.abspath(filename))
         os.remove(filename)
+    filename = os.path.abspath(filename)
     
     def save_rec(data, hdf):
         """ recusively save a dictionary """
         for key in data.keys():
             
-            if type(data[key]) == dict:
+            if isinstance(data, LazyDict) and data.is_lazy(key) and \
+               getattr(data, 'source', None) == (filename, hdf.name) and key in hdf:
+                # unchanged dataset that is still in the file
+                continue
+            
+            if isinstance(data[key], dict):
                 # if part is dictionary: add 1 level and save dictionary in new level
                 if not key in hdf:
                     hdf.create_group(key)
@@ -104,9 +170,66 @@ def write_dict(data, filename, update=True, attr_types=[]):
                 # other data is stored as datasets
                 if key in hdf:
                     del hdf[key]
-                hdf.create_dataset(key, data=data[key])
+                value = np.asarray(data[key]) if isinstance(data[key], (list, tuple)) else data[key]
+                if isinstance(value, np.ndarray) and value.ndim and value.size > chunk_size:
+                    hdf.create_dataset(key, data=value, chunks=True, compression=compression)
+                else:
+                    hdf.create_dataset(key, data=value)
     
     hdf = h5py.File(filename)
     save_rec(data, hdf)
     hdf.close()
-#}
\ No newline at end of file
+
+def _load_lazy(data, filename):
+    """
+    Load the lazy values read from a file in a (nested) dictionary.
+    """
+    if isinstance(data, LazyDict) and getattr(data, 'source', (None,))[0] == filename:
+        data.load()
+    for key in data.keys():
+        if isinstance(data, LazyDict) and data.is_lazy(key):
+            continue
+        if isinstance(data[key], dict):
+            _load_lazy(data[key], filename)
+
+def append_records(records, filename, name, chunks=1024, compression='gzip'):
+    """
+    Append records to a growable table in a hdf5 file.
+    
+    The table is created on the first call as a chunked and compressed
+    dataset of unlimited length, and extended on every next call. The file is
+    flushed after every write, so that all appended records survive an
+    interruption of the program. This makes it possible to write results
+    incrementally, and to resume afterwards by reading the table with
+    L{read_records}.
+    
+    Object fields (e.g. names of arbitrary length) are stored as
+    variable-length strings, so they are never truncated.
+    
+    @param records: the records to append
+    @type records: record array
+    @param filename: the name of the hdf5 file to write to
+    @type filename: str
+    @param name: name of the dataset
+    @type name: str
+    @param chunks: number of records per chunk
+    @type chunks: int
+    @param compression: compression filter
+    @type compression: str
+    """
+    records = np.asarray(records)
+    hdf = h5py.File(filename, 'a')
+    try:
+        if not name in hdf:
+            dtype = [(field, h5py.special_dtype(vlen=str) if records.dtype[field].kind=='O' \
+                                else records.dtype[field]) for field in records.dtype.names]
+            hdf.create_dataset(name, shape=(0,), dtype=np.dtype(dtype), maxshape=(None,),
+                               chunks=(chunks,), compression=compression)
+        dset = hdf[name]
+        N = dset.shape[0]
+        dset.resize((N+len(records),))
+        dset[N:] = records.astype(dset.dtype)
+        hdf.flush()
+    finally:
+        hdf.close()
+#}
@@ -107,4 +107,54 @@ class HDF5TestCase(unittest.TestCase):
 
         
         
-        
\ No newline at end of file
+            
+    def testReadDictLazy(self):
+        """ io.hdf5.read2dict() with lazy loading """
+        
+        grid = np.random.uniform(size=(100,100))
+        data = {'grid':grid, 'set1':{'grid':grid, 'value':np.array([1.5])}}
+        hdf5.write_dict(data, 'test.hdf5', update=False, compression='gzip')
+        
+        hdf = h5py.File('test.hdf5', 'r')
+        self.assertEqual(hdf['grid'].compression, 'gzip')
+        self.assertEqual(hdf['set1']['value'].compression, None)
+        hdf.close()
+        
+        data = hdf5.read2dict('test.hdf5', lazy_size=100)
+        self.assertTrue(data.is_lazy('grid'))
+        self.assertTrue(data['set1'].is_lazy('grid'))
+        self.assertFalse(data['set1'].is_lazy('value'))
+        self.assertTrue(np.all(data['grid'] == grid))
+        self.assertFalse(data.is_lazy('grid'))
+        
+        #-- datasets that were not accessed are kept when updating the file,
+        #   also when it is overwritten
+        data['set1']['value'] = np.array([2.5])
+        hdf5.write_dict(data, 'test.hdf5', update=False)
+        data = hdf5.read2dict('test.hdf5')
+        self.assertTrue(np.all(data['set1']['grid'] == grid))
+        self.assertEqual(data['set1']['value'][0], 2.5)
+        
+        if os.path.isfile('test.hdf5'):
+            os.remove('test.hdf5')
+    
+    def testAppendRecords(self):
+        """ io.hdf5.append_records() and read_records() """
+        
+        dtype = [('targetname',object), ('nobs','i4'), ('teff','f8')]
+        names = ['HD%d'%i for i in range(3)] + ['SDSS J012345.67+012345.6 (a rather long target name)']
+        records = np.array([(name, i, 5000.+i) for i,name in enumerate(names)], dtype=dtype)
+        
+        self.assertTrue(hdf5.read_records('test.hdf5', 'records') is None)
+        hdf5.append_records(records[:2], 'test.hdf5', 'records', chunks=2)
+        hdf5.append_records(records[2:], 'test.hdf5', 'records', chunks=2)
+        
+        data = hdf5.read_records('test.hdf5', 'records')
+        self.assertEqual(len(data), 4)
+        self.assertEqual(list(data['targetname']), names)
+        self.assertEqual(list(data['nobs']), [0, 1, 2, 3])
+        self.assertTrue(np.all(data['teff'] == records['teff']))
+        self.assertTrue(hdf5.read_records('test.hdf5', 'other') is None)
+        
+        if os.path.isfile('test.hdf5'):
+            os.remove('test.hdf5')
@@ -389,8 +389,8 @@ def reflection_effect(primary,secondary,theta,phi,A1=1.,A2=1.,max_iter=1):
             s12 = s12.ravel()
             
             keep = (psi2<pi/2.) & (psi1<pi/2.)
-            Lambda_2_bol = np.array([limbdark.get_itable(teff=iteff,logg=np.log10(igrav*100),theta=ipsi2,photbands=['OPEN.BOL'],absolute=False)[0]\
-                            for iteff,igrav,ipsi2 in zip(secondary['teff'][keep],secondary['grav'][keep],psi2[keep])])
+            Lambda_2_bol = limbdark.get_itable(teff=secondary['teff'][keep],logg=np.log10(secondary['grav'][keep]*100),
+                                               theta=psi2[keep],photbands=['OPEN.BOL'],absolute=False)[0]
     
             s = vectors.norm(s12[keep])
             J_21_entrant = A1 * R2[i] * np.sum(secondary['flux'][keep] * cos(psi1[keep])*cos(psi2[keep])*Lambda_2_bol*secondary['areas'][keep]/s**2)
@@ -407,8 +407,8 @@ def reflection_effect(primary,secondary,theta,phi,A1=1.,A2=1.,max_iter=1):
             s12 = s12.ravel()
             
             keep = (psi2<pi/2.) & (psi1<pi/2.)
-            Lambda_2_bol = np.array([limbdark.get_itable(teff=iteff,logg=np.log10(igrav*100),theta=ipsi2,photbands=['OPEN.BOL'],absolute=False)[0]\
-                    for iteff,igrav,ipsi2 in zip(primary['teff'][keep],primary['grav'][keep],psi2[keep])])
+            Lambda_2_bol = limbdark.get_itable(teff=primary['teff'][keep],logg=np.log10(primary['grav'][keep]*100),
+                                               theta=psi2[keep],photbands=['OPEN.BOL'],absolute=False)[0]
         
             s = vectors.norm(s12)
             J_12_entrant = A2 * R1[i] * np.nansum(primary['flux'][keep] * cos(psi1[keep])*cos(psi2[keep])*Lambda_2_bol*primary['areas'][keep]/s**2)
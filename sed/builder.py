@@ -562,6 +562,7 @@ import logging
 import itertools
 import glob
 import json
+from multiprocessing import Pool,cpu_count
 
 import pylab as pl
 from matplotlib import mlab
@@ -574,7 +575,7 @@ import pyfits
 from ivs import config
 from ivs.aux import numpy_ext
 from ivs.aux import termtools
-from ivs.aux.decorators import memoized,clear_memoization
+from ivs.aux.decorators import memoized,clear_memoization,LazyDict
 from ivs.io import ascii
 from ivs.io import fits
 from ivs.io import hdf5
@@ -948,6 +949,37 @@ def photometry2str(master,comment='',sort='photband',color=False,index=False):
 
 
 
+def _fits_table_loader(filename,extname,fields=None,dtype=None):
+    """
+    Return a function that reads a FITS table extension.
+    
+    The function returns a record array with all columns, or, if C{fields}
+    are given, a tuple with one array of type C{dtype} per field. The file
+    is memory mapped, and only the requested columns are copied.
+    
+    @param filename: name of the FITS file
+    @type filename: str
+    @param extname: name of the extension
+    @type extname: str
+    @param fields: names of the columns to read
+    @type fields: list of str
+    @return: function without arguments
+    @rtype: callable
+    """
+    def loader():
+        ff = pyfits.open(filename,memmap=True)
+        try:
+            data = ff[extname].data
+            if fields is None:
+                names = data.columns.names
+                return np.rec.fromarrays([data.field(name) for name in names],names=','.join(names))
+            return tuple([np.array(data.field(field),dtype=dtype) for field in fields])
+        finally:
+            ff.close()
+    return loader
+
+
+
 class SED(object):
     """
     Class that facilitates the use of the ivs.sed module.
@@ -1811,6 +1843,11 @@ class SED(object):
                 pars[name] = self.results[mtype]['CI'][name]
                 pars[name+"range"] = [self.results[mtype]['CI'][name+"_l"],\
                                        self.results[mtype]['CI'][name+"_u"]]
+        #-- options of the CI calculation itself
+        cikws = {}
+        for key in ['threads', 'refine', 'CI_levels']:
+            if key in kwargs:
+                cikws[key] = kwargs.pop(key)
         pars.update(kwargs)
         pars = self.generate_fit_param(**pars)  
         
@@ -1822,7 +1859,7 @@ class SED(object):
                              self.master['e_cmeas'][include_grid],
                              self.master['photband'][include_grid],
                              xpar, ypar, limits=limits, res=res, 
-                             constraints=self.constraints, **pars)
+                             constraints=self.constraints, **dict(pars, **cikws))
         
         #-- store the CI
         if not 'CI2D' in self.results[mtype]: self.results[mtype]['CI2D'] = {}
@@ -1848,9 +1885,12 @@ class SED(object):
     def iminimize(self, teff=None, logg=None, ebv=None, z=0, rv=3.1, vrad=0, teffrange=None,
                      loggrange=None, ebvrange=None, zrange=None, rvrange=None, vradrange=None,
                      points=None, distance=None, start_from='igrid_search',df=None, CI_limit=None, 
-                     calc_ci=False, set_model=True, **kwargs):
+                     calc_ci=False, set_model=True, threads=1, **kwargs):
         """ 
         Basic minimizer method for SED fitting implemented using the lmfit library from sigproc.fit
+        
+        When starting from a number of random C{points}, the fits are distributed
+        over C{threads} processes.
         """
         
         #-- set defaults limits and starting values
@@ -1870,7 +1910,7 @@ class SED(object):
         grid, chisq, nfev, scale, lumis = fit.iminimize(self.master['cmeas'][include_grid],
                                             self.master['e_cmeas'][include_grid],
                                             self.master['photband'][include_grid],
-                                            fitkws=fitkws, points=points,**pars)
+                                            fitkws=fitkws, points=points, threads=threads, **pars)
         
         logger.info('Minimizer Succes with startpoints=%s, chi2=%s, nfev=%s'%(len(chisq), chisq[0], nfev[0]))
         #-- handle the results
@@ -1891,12 +1931,18 @@ class SED(object):
         
         
     def imc(self,teffrange=None,loggrange=None,ebvrange=None,zrange=None,start_from='imc',\
-                 distribution='uniform',points=None,fitmethod='fmin',disturb=True):
-        
-        limits,type = self.generate_ranges(teffrange=teffrange,loggrange=loggrange,\
-                                      ebvrange=ebvrange,zrange=zrange,distribution=distribution,\
-                                      start_from='imc')
+                 distribution='uniform',points=None,fitmethod='fmin',disturb=True,
+                 gridpoints=100000,threads=1):
+        """
+        Monte Carlo estimation of the fundamental parameters and their errors.
         
+        The photometry is perturbed C{points} times with its errors, and every
+        realisation is fitted. With C{fitmethod='fmin'} or C{'fmin_powell'},
+        every realisation is fitted separately with a downhill minimizer. With
+        C{fitmethod='grid'}, all realisations are fitted at once with a grid
+        search on C{gridpoints} points of the pixel grid (see
+        L{fit.igrid_search_mc}), distributed over C{threads} processes.
+        """
         #-- grid search on all include data: extract the best CHI2
         include = self.master['include']
         meas = self.master['cmeas'][include]
@@ -1907,6 +1953,23 @@ class SED(object):
         photbands = self.master['photband'][include]
         logger.info('The following measurements are included in the fitting process:\n%s'%(photometry2str(self.master[include])))
         
+        if fitmethod=='grid':
+            limits = self.generate_ranges(teffrange=teffrange,loggrange=loggrange,\
+                                      ebvrange=ebvrange,zrange=zrange,start_from='imc')
+            output = fit.igrid_search_mc(meas,self.master['e_cmeas'][include],photbands,
+                                      realisations=points,points=gridpoints,disturb=disturb,
+                                      threads=threads,**limits)
+            names = ['teff','logg','ebv','z','labs','chisq','scale']
+            output = np.rec.fromarrays([output[name] for name in names],names=names)
+            #-- remove nonsense results
+            output = output[-np.isinf(output['chisq'])]
+            self._store_imc_results(output)
+            return
+        
+        limits,type = self.generate_ranges(teffrange=teffrange,loggrange=loggrange,\
+                                      ebvrange=ebvrange,zrange=zrange,distribution=distribution,\
+                                      start_from='imc')
+        
         #-- generate initial guesses
         teffs,loggs,ebvs,zs,radii = fit.generate_grid(self.master['photband'][include],type=type,points=points+25,**limits)         
         NrPoints = len(teffs)>points and points or len(teffs)
@@ -1953,6 +2016,13 @@ class SED(object):
         keep = (output[:,0]==0) & (output[:,1]>0)
         output = output[keep]
         output = np.rec.fromarrays(output[:,1:-1].T,names=['teff','logg','ebv','z','labs','chisq','scale'])
+        self._store_imc_results(output)
+    
+    def _store_imc_results(self,output):
+        """
+        Derive the confidence intervals from the Monte Carlo realisations (the
+        last one is the fit to the original data).
+        """
         #-- derive confidence intervals and median values
         #print np.median(output[:,1:],axis=0)
         
@@ -2415,8 +2485,14 @@ class SED(object):
         pvalues = [1-grid['ci_'+chi2_type]]
         add_info = []
         #-- create the evolutionary grid and interpolate the stellar evolutinary
-        #   grid on the SED-integrated grid points
-        output = np.array([evolutionmodels.get_itable(iteff,ilogg,iz) for iteff,ilogg,iz in zip(grid['teff'],grid['logg'],grid['z'])])
+        #   grid on the SED-integrated grid points. The same (teff,logg,z)
+        #   combination occurs for many values of E(B-V) and Rv, so every
+        #   combination is interpolated only once
+        points = np.rec.fromarrays([grid['teff'],grid['logg'],grid['z']],names=['teff','logg','z'])
+        unique_points,inverse = np.unique(points,return_inverse=True)
+        output = np.array([evolutionmodels.get_itable(iteff,ilogg,iz) for iteff,ilogg,iz in \
+                              zip(unique_points['teff'],unique_points['logg'],unique_points['z'])])
+        output = output[inverse]
         output = np.rec.fromarrays(output.T,names=['age','labs','radius'])
         for label in ylabels:
             y_interpolated = output[label]
@@ -3301,6 +3377,10 @@ class SED(object):
         """
         if filename is None:
             filename = str(os.path.splitext(self.photfile)[0]+'.fits')
+        #-- results loaded lazily could still need to be read from the old file
+        for mtype in self.results:
+            if isinstance(self.results[mtype],LazyDict):
+                self.results[mtype].load()
         if overwrite:
             if os.path.isfile(filename):
                 os.remove(filename)
@@ -3354,6 +3434,10 @@ class SED(object):
         Load a previously made SED FITS file. Only works for SEDs saved with 
         the save_fits function after 14.06.2012.
         
+        The grids and model spectra are read from the (memory mapped) file
+        only when they are accessed; the photometry, confidence intervals and
+        synthetic fluxes are read immediately.
+        
         The .fits file can contain the following extensions:
            1) data (all previously collected photometric data = content of .phot file)
            2) model_igrid_search (full best model SED table from grid_search)
@@ -3373,7 +3457,8 @@ class SED(object):
         if not os.path.isfile(filename):
             logger.warning('No previous results saved to FITS file {:s}'.format(filename))
             return False
-        ff = pyfits.open(filename)
+        filename = os.path.abspath(filename)
+        ff = pyfits.open(filename,memmap=True)
         
         #-- observed photometry
         fields = ff['data'].columns.names
@@ -3394,24 +3479,26 @@ class SED(object):
         mtypes = list(set(mtypes) - set(['DATA']))
         for mtype in mtypes:
             mtype = mtype.lower().lstrip('synflux_').lstrip('model_')
-            if not mtype in self.results:
-                    self.results[mtype] = {}
-            self.results[mtype]['model'] = np.array(ff['model_'+mtype].data.field('wave'),dtype='float64'),np.array(ff['model_'+mtype].data.field('flux'),dtype='float64'),np.array(ff['model_'+mtype].data.field('dered_flux'),dtype='float64')
+            if not isinstance(self.results.get(mtype,None),LazyDict):
+                self.results[mtype] = LazyDict(self.results.get(mtype,{}))
+            #-- the model spectrum is only read when it is needed
+            self.results[mtype].set_lazy('model',_fits_table_loader(filename,'model_'+mtype,
+                                  fields=['wave','flux','dered_flux'],dtype='float64'))
             self.results[mtype]['chi2'] = np.array(ff['synflux_'+mtype].data.field('chi2'),dtype='float64')
             self.results[mtype]['synflux'] = np.array(ff['synflux_'+mtype].data.field('mod_eff_wave'),dtype='float64'),np.array(ff['synflux_'+mtype].data.field('synflux'),dtype='float64'),self.master['photband']
             
                 
         for mtype in ['igrid_search','iminimize','imc']:
             try:
-                fields = ff[mtype].columns.names
-                master = np.rec.fromarrays([ff[mtype].data.field(field) for field in fields],names=','.join(fields))
-                if not mtype in self.results:
-                    self.results[mtype] = {}
-                self.results[mtype]['grid'] = master
-                if 'factor' in ff[mtype].header:
-                    self.results[mtype]['factor'] = np.array([ff[mtype].header['factor']])[0]
+                header = ff[mtype].header
+                if not isinstance(self.results.get(mtype,None),LazyDict):
+                    self.results[mtype] = LazyDict(self.results.get(mtype,{}))
+                #-- the (possibly huge) grid is only read when it is needed
+                self.results[mtype].set_lazy('grid',_fits_table_loader(filename,mtype))
+                if 'factor' in header:
+                    self.results[mtype]['factor'] = np.array([header['factor']])[0]
                 
-                headerkeys = ff[mtype].header.ascardlist().keys()
+                headerkeys = header.ascardlist().keys()
                 for key in headerkeys[::-1]:
                     for badkey in ['xtension','bitpix','naxis','pcount','gcount','tfields','ttype','tform','tunit','factor','extname']:
                         if key.lower().count(badkey):
@@ -3420,7 +3507,7 @@ class SED(object):
                 self.results[mtype]['CI'] = {}
                 for key in headerkeys:
                     #-- we want to have the same types as the original: numpy.float64 --> np.array([..])[0]
-                    self.results[mtype]['CI'][key.lower()] = np.array([ff[mtype].header[key]])[0]
+                    self.results[mtype]['CI'][key.lower()] = np.array([header[key]])[0]
             except KeyError:
                 continue
         
@@ -3439,7 +3526,7 @@ class SED(object):
         logger.info('Loaded previous results from FITS file: %s'%(filename))
         return filename
     
-    def save_hdf5(self, filename=None, update=True):
+    def save_hdf5(self, filename=None, update=True, compression='gzip'):
         """
         Save content of SED object to a HDF5 file. (HDF5 is the successor of FITS files, 
         providing a clearer structure of the saved content.)
@@ -3450,11 +3537,17 @@ class SED(object):
             - sed.results (results from all fitting methods)
             - sed.constraints (extra constraints on the fits)
         
+        Large arrays (grids, model spectra) are stored as chunked and compressed
+        datasets. When updating the file the results were loaded from, results
+        that were never accessed are left untouched in the file.
+        
         @param filename: name of SED FITS file
         @type filename: string
         @param update: if True, an existing file will be updated with the current information, if
                        False, an existing fill be overwritten
         @type update: bool
+        @param compression: compression filter for large datasets (None for no compression)
+        @type compression: str
         @return: the name of the output HDF5 file.
         @rtype: string
         """
@@ -3467,17 +3560,25 @@ class SED(object):
         data['results'] = self.results
         data['constraints'] = self.constraints
         
-        hdf5.write_dict(data, filename, update=update)
+        hdf5.write_dict(data, filename, update=update, compression=compression)
         
         logger.info('Results saved to HDF5 file: %s'%(filename))
         return filename    
                 
-    def load_hdf5(self,filename=None):
+    def load_hdf5(self,filename=None,lazy_size=1000):
         """
         Load a previously made SED from HDF5 file.
         
+        Arrays with more than C{lazy_size} elements (e.g. the grids of the
+        fitting methods, model spectra and CI2D grids) are only read from the
+        file when they are accessed, so loading only the photometry and the
+        confidence intervals is fast. Set C{lazy_size=None} to read everything
+        immediately.
+        
         @param filename: name of SED FITS file
         @type filename: string
+        @param lazy_size: arrays larger than this are loaded on first access
+        @type lazy_size: int
         @return: True if HDF5 file could be loaded
         @rtype: bool
         """
@@ -3487,7 +3588,7 @@ class SED(object):
             logger.warning('No previous results saved to HFD5 file {:s}'.format(filename))
             return False
             
-        data = hdf5.read2dict(filename)
+        data = hdf5.read2dict(filename, lazy_size=lazy_size)
         
         self.master = data.get('master', {})
         self.results = data.get('results', {})
@@ -3596,6 +3697,10 @@ class BinarySED(SED):
         contraints are supported:
             - masses (in Msol)
             - distance (in Rsol)
+            - radius_ratio (rad2/rad, as a (low,high) range)
+            - mass_ratio (M2/M1, as a (low,high) range)
+        Grid points that violate the ratios are rejected in igrid_search before their
+        photometry is interpolated (see L{fit.constraint_mask}).
         TODO: This function should in the future accept Units.
         """
         for key in kwargs.keys():
@@ -3846,6 +3951,40 @@ class Calibrator(SED):
         self.set_model(wave,flux)
         
 
+#-- grid and synthetic photometry shared with the processes of a batch fit
+_batch_grid = {}
+
+def _batch_gridsearch_target(args):
+    """
+    Evaluate the grid search of one target from a batch fit.
+    
+    The grid parameters and synthetic fluxes are taken from C{_batch_grid}.
+    The statistics follow L{SED.calculate_statistics} and
+    L{SED.calculate_confidence_intervals}.
+    
+    @return: targetname, number of observations, rescaling factor and the
+    value and confidence interval of all parameters
+    @rtype: tuple
+    """
+    ID,index,colors,meas,e_meas,df,CI_limit = args
+    syn_flux = _batch_grid['syn_flux'][index]
+    chisqs,scales,e_scales = fit.stat_chi2(meas.reshape(-1,1),e_meas.reshape(-1,1),colors,syn_flux)
+    columns = _batch_grid['pars'] + [chisqs,scales,e_scales,_batch_grid['lumis']]
+    #-- do the statistics
+    N = len(meas)
+    k = max(N-df,1)
+    valid = -np.isnan(chisqs)
+    best = np.argmin(np.where(valid,chisqs,np.inf))
+    factor = max(chisqs[best]/k,1)
+    ci_red = scipy.stats.distributions.chi2.cdf(chisqs/factor,k)
+    region = valid & (ci_red<=CI_limit)
+    if not region.any():
+        region = np.arange(len(chisqs))==best
+    row = [ID,N,factor]
+    for column in columns:
+        row += [column[best],column[region].min(),column[region].max()]
+    return tuple(row)
+
 class SampleSEDs(object):
     """
     Class representing a list of SEDs.
@@ -4007,6 +4146,140 @@ class SampleSEDs(object):
             values[i,2] = sed.results[mtype]['CI'][parameter+'_u']
             sed.clear()
         return values
+    
+    def igrid_search(self,points=100000,teffrange=(-np.inf,np.inf),loggrange=(-np.inf,np.inf),
+                          ebvrange=(-np.inf,np.inf),zrange=(0,0),rvrange=(3.1,3.1),
+                          vradrange=(0,0),df=None,CI_limit=None,threads=1,
+                          outfile=None,chunksize=100):
+        """
+        Fit fundamental parameters of all SEDs in the sample with one grid search.
+        
+        Instead of running L{SED.igrid_search} for each target separately, the
+        parameter grid is generated and the synthetic photometry is interpolated
+        only once, for the union of all included passbands of the sample. The
+        targets are then grouped per set of included passbands, so that every
+        group uses the same rows of the synthetic photometry matrix, and the
+        chi2 of every target is evaluated against that matrix. The targets are
+        distributed over a pool of C{threads} processes.
+        
+        For every target, the best value and confidence interval of each
+        parameter is stored in C{sed.results['igrid_search']['CI']}, in the same
+        way as L{SED.igrid_search} does. The full grids are not stored.
+        
+        If C{outfile} is given, the confidence intervals are also appended to a
+        table 'igrid_search' in that HDF5 file as soon as they are computed. If
+        the file already contains results, the targets that are present in it
+        are not fitted again (so an interrupted run can be resumed), but their
+        results are loaded from the file.
+        
+        >>> #sample = SampleSEDs(['HD180642','HD50230'])
+        >>> #results = sample.igrid_search(points=100000,teffrange=(5000,30000),threads=4,outfile='sample.hdf5')
+        
+        @param points: number of grid points
+        @type points: int
+        @param df: degrees of freedom (derived from the ranges if not given)
+        @type df: int
+        @param CI_limit: confidence limit
+        @type CI_limit: float
+        @param threads: number of processes
+        @type threads: int or 'max'
+        @param outfile: HDF5 file to write the results to
+        @type outfile: str
+        @param chunksize: number of targets sent to a process at once
+        @type chunksize: int
+        @return: results of all targets (one row per target)
+        @rtype: record array
+        """
+        if CI_limit is None:
+            CI_limit = self.seds[0].CI_limit if len(self.seds) else 0.95
+        ranges = dict(teffrange=teffrange,loggrange=loggrange,ebvrange=ebvrange,
+                      zrange=zrange,rvrange=rvrange,vradrange=vradrange)
+        if df is None:
+            df,df_info = self.seds[0].calculateDF(**ranges)
+        
+        #-- check which targets are already done
+        done = None
+        if outfile is not None:
+            done = hdf5.read_records(outfile,'igrid_search')
+        done_ids = set() if done is None else set(done['targetname'])
+        todo = [sed for sed in self.seds if not sed.ID in done_ids]
+        logger.info('Batch grid search: {} targets to fit ({} already done)'.format(len(todo),len(done_ids)))
+        
+        if todo:
+            #-- build the grid and the synthetic photometry for all passbands
+            #   used in the sample at once
+            photbands = sorted(set([band for sed in todo for band in sed.master['photband'][sed.master['include']]]))
+            pars = fit.generate_grid_pix(photbands,points=points,**ranges)
+            syn_flux,lumis = model.get_itable_pix(photbands=photbands,**pars)
+            parnames = sorted(pars.keys())
+            
+            #-- group the targets per set of passbands
+            groups = {}
+            for sed in todo:
+                include = sed.master['include']
+                bands = tuple(sed.master['photband'][include])
+                groups.setdefault(bands,[]).append(sed)
+            logger.info('Batch grid search: {} passband sets'.format(len(groups)))
+            tasks = []
+            for bands,seds in groups.items():
+                index = np.searchsorted(np.array(photbands),bands)
+                colors = np.array([filters.is_color(band) for band in bands],bool)
+                for sed in seds:
+                    include = sed.master['include']
+                    tasks.append((sed.ID,index,colors,sed.master['cmeas'][include],
+                                  sed.master['e_cmeas'][include],df,CI_limit))
+            
+            #-- share the grid with the processes
+            _batch_grid['pars'] = [pars[name] for name in parnames]
+            _batch_grid['syn_flux'] = syn_flux
+            _batch_grid['lumis'] = lumis
+            names = parnames + ['chisq','scale','escale','labs']
+            #-- target names can be of any length
+            dtype = [('targetname',object),('nobs','i4'),('factor','f8')]
+            dtype += [(name+suffix,'f8') for name in names for suffix in ['','_l','_u']]
+            
+            if threads=='max':
+                threads = cpu_count()
+            threads = int(threads)
+            if threads>1:
+                pool = Pool(threads)
+                results = pool.imap_unordered(_batch_gridsearch_target,tasks,chunksize=chunksize)
+            else:
+                pool = None
+                results = itertools.imap(_batch_gridsearch_target,tasks)
+            
+            #-- collect the results and write them in blocks
+            new_results = []
+            block = []
+            try:
+                for i,row in enumerate(results):
+                    block.append(row)
+                    if outfile is not None and (len(block)>=chunksize or i==len(tasks)-1):
+                        hdf5.append_records(np.array(block,dtype=dtype),outfile,'igrid_search')
+                        new_results += block
+                        block = []
+                        logger.info('Batch grid search: {}/{} targets done'.format(i+1,len(tasks)))
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                _batch_grid.clear()
+            new_results = np.rec.fromrecords(new_results+block,dtype=dtype)
+            done = new_results if done is None else np.hstack([done,new_results.astype(done.dtype)]).view(np.recarray)
+        
+        if done is None:
+            return None
+        
+        #-- store the confidence intervals in the SED instances
+        index = dict([(targetname,i) for i,targetname in enumerate(done['targetname'])])
+        cinames = [name for name in done.dtype.names if not name in ['targetname','nobs','factor']]
+        for sed in self.seds:
+            if not sed.ID in index:
+                continue
+            row = done[index[sed.ID]]
+            sed.results.setdefault('igrid_search',{})
+            sed.results['igrid_search']['CI'] = dict([(name,row[name]) for name in cinames])
+            sed.results['igrid_search']['factor'] = row['factor']
+        return done
         
         
 
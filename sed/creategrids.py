@@ -14,9 +14,11 @@ Examples::
 import sys
 import pyfits
 import logging
+import cPickle
+import itertools
 import numpy as np
 import time
-from multiprocessing import cpu_count,Manager,Process
+from multiprocessing import cpu_count,Pool
 import os
 import shutil
 from ivs.sed import model
@@ -85,13 +87,181 @@ def get_responses(responses=None,add_spectrophotometry=False,wave=(0,np.inf)):
     
     return responses
 
+def _get_threads(threads):
+    """
+    Translate a thread specification to a number of processes.
+    
+    @param threads: number of threads
+    @type threads; integer, 'max', 'half' or 'safe' 
+    @return: number of threads
+    @rtype: int
+    """
+    if threads=='max':
+        threads = cpu_count()
+    elif threads=='half':
+        threads = cpu_count()/2
+    elif threads=='safe':
+        threads = cpu_count()-1
+    return max(1,int(threads))
+
+def _read_checkpoint(checkpoint,header):
+    """
+    Read all finished tasks from a checkpoint file.
+    
+    A checkpoint file is an append-only sequence of pickled records. The
+    first record is a header describing the calculation, all following records
+    are tuples (task,result). If the header does not match the given one, the
+    checkpoint belongs to another calculation and is not used. A truncated
+    record at the end of the file (e.g. from a crash during writing) is
+    discarded.
+    
+    @param checkpoint: name of the checkpoint file
+    @type checkpoint: str
+    @param header: description of the calculation
+    @type header: dict
+    @return: finished tasks, offset of the last valid record
+    @rtype: dict, int
+    """
+    done = {}
+    offset = 0
+    if not os.path.isfile(checkpoint):
+        return done,offset
+    with open(checkpoint,'rb') as ff:
+        try:
+            header_ = cPickle.load(ff)
+        except Exception:
+            return done,offset
+        if repr(header_)!=repr(header):
+            logger.warning('Checkpoint %s belongs to another calculation: starting over'%(checkpoint))
+            return done,offset
+        offset = ff.tell()
+        while True:
+            try:
+                task,result = cPickle.load(ff)
+            except EOFError:
+                break
+            except Exception:
+                logger.warning('Discarding truncated record in checkpoint %s'%(checkpoint))
+                break
+            done[task] = result
+            offset = ff.tell()
+    logger.info('Resuming from checkpoint %s: %d tasks already done'%(checkpoint,len(done)))
+    return done,offset
+
+def _run_tasks(func,tasks,checkpoint,header,threads=1):
+    """
+    Run tasks on a process pool and stream the results to a checkpoint file.
+    
+    Tasks already present in the checkpoint file are not recomputed. Each
+    task is a tuple (task id, arguments); C{func} is called with the arguments
+    and must return a tuple (task id, result, error message). Results are
+    appended to the checkpoint as soon as they come in, so that at most the
+    running tasks are lost after an interruption.
+    
+    @param func: module level function to evaluate
+    @type func: callable
+    @param tasks: list of (task id, arguments)
+    @type tasks: list
+    @param checkpoint: name of the checkpoint file
+    @type checkpoint: str
+    @param header: description of the calculation
+    @type header: dict
+    @param threads: number of processes
+    @type threads: int
+    @return: dictionary of results, list of exceptions
+    @rtype: dict, list
+    """
+    done,offset = _read_checkpoint(checkpoint,header)
+    todo = [task for task in tasks if not task[0] in done]
+    logger.info('%d/%d tasks to compute'%(len(todo),len(tasks)))
+    
+    #-- open the checkpoint for appending, removing a possible corrupt tail
+    if offset:
+        ff = open(checkpoint,'r+b')
+        ff.truncate(offset)
+        ff.seek(offset)
+    else:
+        ff = open(checkpoint,'wb')
+        cPickle.dump(header,ff,-1)
+    
+    if threads>1:
+        pool = Pool(threads,initializer=_init_process,initargs=(model.defaults.copy(),))
+        results = pool.imap_unordered(func,todo)
+    else:
+        pool = None
+        results = itertools.imap(func,todo)
+    
+    exceptions_logs = []
+    c0 = time.time()
+    try:
+        for i,(task,result,error) in enumerate(results):
+            if error is not None:
+                logger.warning('Exception in task %s: %s'%(task,error))
+                exceptions_logs.append(error)
+                continue
+            cPickle.dump((task,result),ff,-1)
+            ff.flush()
+            os.fsync(ff.fileno())
+            done[task] = result
+            logger.info('Task %s (%d/%d): ET %d seconds'%(task,i+1,len(todo),(time.time()-c0)/(i+1)*(len(todo)-i-1)))
+    finally:
+        ff.close()
+        if pool is not None:
+            pool.terminate()
+    
+    return done,exceptions_logs
+
+def _init_process(defaults):
+    """
+    Make sure every process in the pool uses the same grid as the parent.
+    """
+    model.set_defaults(**defaults)
+
+def _integrated_grid_task(args):
+    """
+    Compute one block of E(B-V) values for one model table.
+    
+    @return: task, array (teff,logg,Labs,ebv,fluxes) for every E(B-V), error message
+    @rtype: tuple, ndarray, str
+    """
+    task,(teff,logg,ebvs,law,Rv,units,responses) = args
+    try:
+        wave,flux = model.get_table(teff=teff,logg=logg)
+        Labs = model.luminosity(wave,flux)
+        flux_ = reddening.redden_multi(flux,wave=wave,ebvs=ebvs,rtype='flux',law=law,Rv=Rv)
+        synflux = model.synthetic_flux(wave,flux_,responses,units=units)
+    except Exception:
+        return task,None,'Teff=%f, logg=%f: %s'%(teff,logg,sys.exc_info()[1])
+    block = np.zeros((len(ebvs),4+len(responses)))
+    block[:,:3] = teff,logg,Labs
+    block[:,3] = ebvs
+    block[:,4:] = synflux
+    return task,block,None
+
+def _update_grid_task(args):
+    """
+    Compute new passbands for all rows of the grid sharing one model table.
+    
+    @return: task, array (row index, fluxes) for every row, error message
+    @rtype: tuple, ndarray, str
+    """
+    task,(teff,logg,z,rv,ebvs,rows,law,units,responses) = args
+    try:
+        model.set_defaults(z=z)
+        wave,flux = model.get_table(teff=teff,logg=logg)
+        flux_ = reddening.redden_multi(flux,wave=wave,ebvs=ebvs,rtype='flux',law=law,Rv=rv)
+        synflux = model.synthetic_flux(wave,flux_,responses,units=units)
+    except Exception:
+        return task,None,'Teff=%f, logg=%f, z=%f: %s'%(teff,logg,z,sys.exc_info()[1])
+    return task,np.vstack([rows,synflux.T]),None
+
 #}
 
 #{ Limb darkening coefficients
 
 def calc_limbdark_grid(responses=None,vrads=[0],ebvs=[0],zs=[0.],\
          ld_law='claret',fitmethod='equidist_r_leastsq',
-         outfile=None,force=False,**kwargs):
+         outfile=None,force=False,threads=1,checkpoint=None,**kwargs):
     """
     Calculate a grid of limb-darkening coefficients.
     
@@ -106,6 +276,14 @@ def calc_limbdark_grid(responses=None,vrads=[0],ebvs=[0],zs=[0.],\
     will be overwritten. You'd probably only want to update or overwrite existing
     files if you use the same C{vrads}, C{ebvs}, C{zs} etc...
     
+    Every model of the atmosphere grid is one task: its intensity profile is
+    integrated over all new passbands at once, and the law is fitted in each
+    passband. The tasks are distributed over a pool of C{threads} processes,
+    and finished tasks are written to a checkpoint file (by default the name
+    of the output file with extension C{.ckpt}), so that an interrupted
+    calculation resumes where it stopped when called again with the same
+    arguments. The checkpoint is removed once all passbands are written.
+    
     The generated FITS file has the following structure:
         
         1. The primary HDU is empty. The primary header contains only the fit
@@ -145,31 +323,36 @@ def calc_limbdark_grid(responses=None,vrads=[0],ebvs=[0],zs=[0.],\
     hd.update('LAW', ld_law, 'FITTED LD LAW')
     hd.update('GRID', kwargs.get('grid',limbdark.defaults['grid']), 'GRID')
     
-    #-- cycle through all the bands and compute the limb darkening coefficients
-    for i,photband in enumerate(photbands):
+    #-- only compute the bands that are not there yet
+    todo = []
+    for photband in photbands:
         if photband in existing_bands and not force:
             logger.info('BAND {} already exists: skipping'.format(photband))
-            continue
-        logger.info('Calculating photband {} ({}/{})'.format(photband,i+1,len(photbands)))
-        pars,coeffs,Imu1s = limbdark.fit_law_to_grid(photband,vrads=vrads,ebvs=ebvs,zs=zs,\
-                      law=ld_law,fitmethod=fitmethod,**kwargs)
-        cols = []
-
-        cols.append(pyfits.Column(name='Teff', format='E', array=pars[:,0]))
-        cols.append(pyfits.Column(name="logg", format='E', array=pars[:,1]))
-        cols.append(pyfits.Column(name="ebv" , format='E', array=pars[:,2]))
-        cols.append(pyfits.Column(name="vrad", format='E', array=pars[:,3]))
-        cols.append(pyfits.Column(name="z"   , format='E', array=pars[:,4]))
-        for col in range(coeffs.shape[1]):
-            cols.append(pyfits.Column(name='a{:d}'.format(col+1), format='E', array=coeffs[:,col]))
-        cols.append(pyfits.Column(name='Imu1', format='E', array=Imu1s[:,0]))
-        cols.append(pyfits.Column(name='SRS', format='E', array=Imu1s[:,1]))
-        cols.append(pyfits.Column(name='dint', format='E', array=Imu1s[:,2]))
-
-        newtable = pyfits.new_table(pyfits.ColDefs(cols))
-        newtable.header.update('EXTNAME', photband, "SYSTEM.FILTER")
-        newtable.header.update('SYSTEM', photband.split('.')[0], 'PASSBAND SYSTEM')
-        newtable.header.update('FILTER', photband.split('.')[1], 'PASSBAND FILTER')
+        else:
+            todo.append(photband)
+    
+    #-- every model (and combination of ebv, vrad and z) is one task
+    if todo:
+        teffs,loggs = limbdark.get_grid_dimensions(**kwargs)
+        grid_pars = [(teff,logg)+combo for teff,logg in zip(teffs,loggs) \
+                                    for combo in itertools.product(ebvs,vrads,zs)]
+        tasks = [((i,),pars+(todo,ld_law,fitmethod,kwargs)) for i,pars in enumerate(grid_pars)]
+        logger.info('Calculating photbands {} ({} models)'.format(', '.join(todo),len(tasks)))
+        if checkpoint is None:
+            checkpoint = os.path.splitext(outfile)[0]+'.ckpt'
+        header = dict(responses=todo,vrads=list(vrads),ebvs=list(ebvs),zs=list(zs),
+                      law=ld_law,fitmethod=fitmethod,kwargs=kwargs,defaults=limbdark.defaults)
+        done,exceptions_logs = _run_tasks(limbdark._fit_law_task,tasks,checkpoint,header,
+                                          threads=_get_threads(threads))
+        if exceptions_logs:
+            for i in exceptions_logs:
+                logger.error(i)
+            raise ValueError('Failed to compute %d models: resume from %s'%(len(exceptions_logs),checkpoint))
+        #-- rows are (teff,logg,ebv,vrad,z,coeffs,Imu1,SRS,dint), per passband
+        output = np.array([done[task] for task,task_args in tasks])
+    
+    for i,photband in enumerate(todo):
+        newtable = limbdark._ld_table(photband,output[:,i,:5],output[:,i,5:-3],output[:,i,-3:])
         if photband in existing_bands and force:
             hdulist[hdulist.index_of(photband)] = newtable
             logger.info("Forced overwrite of {}".format(photband))
@@ -181,6 +364,8 @@ def calc_limbdark_grid(responses=None,vrads=[0],ebvs=[0],zs=[0.],\
         hdulist.close()
     else:
         hdulist.writeto(outfile)
+    if todo:
+        os.remove(checkpoint)
 
 
 #}
@@ -188,7 +373,8 @@ def calc_limbdark_grid(responses=None,vrads=[0],ebvs=[0],zs=[0.],\
 #{ Integrated photometry
 
 def calc_integrated_grid(threads=1,ebvs=None,law='fitzpatrick2004',Rv=3.1,
-           units='Flambda',responses=None,update=False,add_spectrophotometry=False,**kwargs):
+           units='Flambda',responses=None,update=False,add_spectrophotometry=False,
+           ebv_block=50,checkpoint=None,**kwargs):
     """
     Integrate an entire SED grid over all passbands and save to a FITS file.
     
@@ -197,6 +383,17 @@ def calc_integrated_grid(threads=1,ebvs=None,law='fitzpatrick2004',Rv=3.1,
     
     WARNING: this function can take a loooooong time to compute!
     
+    The work is split in tasks of one model table (teff,logg) and a block of
+    C{ebv_block} E(B-V) values, which are distributed over a pool of
+    C{threads} processes. Every finished task is appended to a checkpoint
+    file (by default the name of the output file with extension C{.ckpt}).
+    If the calculation is interrupted, calling this function again with the
+    same arguments resumes from the checkpoint, and only the missing tasks are
+    computed. The checkpoint file is removed once the FITS file is written.
+    
+    If C{update=True} and the output file exists, only the passbands that are
+    not yet present in the file are computed.
+    
     Extra keywords can be used to specify the grid.
     
     @param threads: number of threads
@@ -214,20 +411,16 @@ def calc_integrated_grid(threads=1,ebvs=None,law='fitzpatrick2004',Rv=3.1,
     @param update: if true append to existing FITS file, otherwise overwrite
     possible existing file.
     @type update: boolean
+    @param ebv_block: number of E(B-V) values computed in one task
+    @type ebv_block: integer
+    @param checkpoint: name of the checkpoint file
+    @type checkpoint: str
     """    
     if ebvs is None:
         ebvs = np.r_[0:4.01:0.01]
         
     #-- select number of threads
-    if threads=='max':
-        threads = cpu_count()
-    elif threads=='half':
-        threads = cpu_count()/2
-    elif threads=='safe':
-        threads = cpu_count()-1
-    threads = int(threads)
-    if threads > len(ebvs):
-        threads = len(ebvs)
+    threads = _get_threads(threads)
     logger.info('Threads: %s'%(threads))
     
     #-- set the parameters for the SED grid
@@ -241,65 +434,47 @@ def calc_integrated_grid(threads=1,ebvs=None,law='fitzpatrick2004',Rv=3.1,
     responses = get_responses(responses=responses,\
               add_spectrophotometry=add_spectrophotometry,wave=wave)
     
-    #-- definition of one process:
-    def do_ebv_process(ebvs,arr,responses):
-        logger.debug('EBV: %s-->%s (%d)'%(ebvs[0],ebvs[-1],len(ebvs)))
-        for ebv in ebvs:
-            flux_ = reddening.redden(flux,wave=wave,ebv=ebv,rtype='flux',law=law,Rv=Rv)
-            #-- calculate synthetic fluxes
-            synflux = model.synthetic_flux(wave,flux_,responses,units=units)
-            arr.append([np.concatenate(([ebv],synflux))])
-        logger.debug("Finished EBV process (len(arr)=%d)"%(len(arr)))
-    
-    #-- do the calculations
-    c0 = time.time()
-    output = np.zeros((len(teffs)*len(ebvs),4+len(responses)))
-    start = 0
-    logger.info('Total number of tables: %i'%(len(teffs)))
-    exceptions = 0
-    exceptions_logs = []
-    for i,(teff,logg) in enumerate(zip(teffs,loggs)):
-        if i>0:
-            logger.info('%s %s %s %s: ET %d seconds'%(teff,logg,i,len(teffs),(time.time()-c0)/i*(len(teffs)-i)))
-        
-        #-- get model SED and absolute luminosity
-        wave,flux = model.get_table(teff=teff,logg=logg)
-        Labs = model.luminosity(wave,flux)
-        
-        #-- threaded calculation over all E(B-V)s
-        processes = []
-        manager = Manager()
-        arr = manager.list([])
-        all_processes = []
-        for j in range(threads):
-            all_processes.append(Process(target=do_ebv_process,args=(ebvs[j::threads],arr,responses)))
-            all_processes[-1].start()
-        for p in all_processes:
-            p.join()
-        
-        try:
-            #-- collect the results and add them to 'output'
-            arr = np.vstack([row for row in arr])
-            sa = np.argsort(arr[:,0])
-            arr = arr[sa]
-            output[start:start+arr.shape[0],:3] = teff,logg,Labs
-            output[start:start+arr.shape[0],3:] = arr
-            start += arr.shape[0]
-        except:
-            logger.warning('Exception in calculating Teff=%f, logg=%f'%(teff,logg))
-            logger.debug('Exception: %s'%(sys.exc_info()[1]))
-            exceptions = exceptions + 1
-            exceptions_logs.append(sys.exc_info()[1])
-    
-    #-- make FITS columns
+    #-- construct the output filename
     gridfile = model.get_file()
-    if os.path.isfile(os.path.basename(gridfile)):
-        outfile = os.path.basename(gridfile)
-    else:
-        outfile = os.path.join(os.path.dirname(gridfile),'i{0}'.format(os.path.basename(gridfile)))
     outfile = 'i{0}'.format(os.path.basename(gridfile))
     outfile = os.path.splitext(outfile)
     outfile = outfile[0]+'_law{0}_Rv{1:.2f}'.format(law,Rv)+outfile[1]
+    
+    #-- when updating, only compute the passbands that are missing
+    if update and os.path.isfile(outfile):
+        hdulist = pyfits.open(outfile)
+        existing_responses = set(hdulist[1].columns.names)
+        hdulist.close()
+        responses = [resp for resp in responses if not resp in existing_responses]
+        if not len(responses):
+            logger.info("No new responses to do")
+            return None
+    
+    #-- define the tasks: every model table gets split in blocks of E(B-V)
+    ebv_blocks = [ebvs[j:j+ebv_block] for j in range(0,len(ebvs),ebv_block)]
+    tasks = [((i,j),(teff,logg,ebvs_,law,Rv,units,responses)) \
+                   for i,(teff,logg) in enumerate(zip(teffs,loggs)) \
+                   for j,ebvs_ in enumerate(ebv_blocks)]
+    logger.info('Total number of tables: %i (%d tasks)'%(len(teffs),len(tasks)))
+    
+    #-- do the calculations, and store the results in the checkpoint file
+    if checkpoint is None:
+        checkpoint = os.path.splitext(outfile)[0]+'.ckpt'
+    header = dict(gridfile=os.path.basename(gridfile),law=law,Rv=Rv,units=units,
+                  responses=responses,ebvs=list(ebvs),defaults=model.defaults)
+    done,exceptions_logs = _run_tasks(_integrated_grid_task,tasks,checkpoint,header,
+                                      threads=threads)
+    #-- never write a partial grid: the finished tasks are kept in the
+    #   checkpoint, so that a next call only computes the failed ones
+    if exceptions_logs:
+        for i in exceptions_logs:
+            logger.error(i)
+        raise ValueError('Failed to compute %d tasks: resume from %s'%(len(exceptions_logs),checkpoint))
+    
+    #-- collect the results in the right order
+    output = np.vstack([done[task] for task,task_args in tasks])
+    
+    #-- make FITS columns
     logger.info('Precaution: making original grid backup at {0}.backup'.format(outfile))
     if os.path.isfile(outfile):
         shutil.copy(outfile,outfile+'.backup')
@@ -348,17 +523,22 @@ def calc_integrated_grid(threads=1,ebvs=None,law='fitzpatrick2004',Rv=3.1,
         hdulist.close()
         logger.info("Appended output to %s"%(outfile))
     
-    logger.warning('Encountered %s exceptions!'%(exceptions))
-    for i in exceptions_logs:
-        print 'ERROR'
-        print i
+    #-- the output is safe, the checkpoint is not needed anymore
+    os.remove(checkpoint)
 
-def update_grid(gridfile,responses,threads=10):
+def update_grid(gridfile,responses,threads=10,checkpoint=None):
     """
     Add passbands to an existing grid.
+    
+    Only the passbands that are not yet present in the grid are computed. The
+    rows of the grid are grouped per model table (teff,logg,z) and Rv, so that
+    every model table is read only once, and all its E(B-V) values are
+    reddened and integrated in one go. The groups are distributed over a pool
+    of C{threads} processes, and finished groups are written to a checkpoint
+    file (default: C{gridfile} with extension C{.ckpt}), such that an
+    interrupted update can be resumed by calling this function again.
     """
-    shutil.copy(gridfile,gridfile+'.backup')
-    hdulist = pyfits.open(gridfile,mode='update')
+    hdulist = pyfits.open(gridfile)
     existing_responses = set(list(hdulist[1].columns.names))
     responses = sorted(list(set(responses) - existing_responses))
     if not len(responses):
@@ -372,58 +552,40 @@ def update_grid(gridfile,responses,threads=10):
     ebvs = hdulist[1].data.field('ebv')
     zs = hdulist[1].data.field('z')
     rvs = hdulist[1].data.field('rv')
-    vrads = hdulist[1].data.field('vrad')
-    names = hdulist[1].columns.names
+    hdulist.close()
     
     N = len(teffs)
-    index = np.arange(N)
-    
-    output = np.zeros((len(responses),len(teffs)))
-    print N
-    
-    #--- PARALLEL PROCESS
-    def do_process(teffs,loggs,ebvs,zs,rvs,index,arr):
-        output = np.zeros((len(responses)+1,len(teffs)))
-        c0 = time.time()
-        N = len(teffs)
-        for i,(teff,logg,ebv,z,rv,ind) in enumerate(zip(teffs,loggs,ebvs,zs,rvs,index)):
-            if i%100==0:
-                dt = time.time()-c0
-                print "ETA",index[0],(N-i)/100.*dt/3600.,'hr'
-                c0 = time.time()
-            #-- get model SED and absolute luminosity
-            model.set_defaults(z=z)
-            wave,flux = model.get_table(teff,logg)
-            Labs = model.luminosity(wave,flux)
-            flux_ = reddening.redden(flux,wave=wave,ebv=ebv,rtype='flux',law=law,Rv=rv)
-            #-- calculate synthetic fluxes
-            output[0,i] = ind
-            output[1:,i] = model.synthetic_flux(wave,flux_,responses,units=units)
-        arr.append(output)
-    #--- PARALLEL PROCESS
-    c0 = time.time()
+    logger.info('Updating %d rows with %d new passbands'%(N,len(responses)))
+    
+    #-- group the rows per model table and Rv
+    index = np.lexsort((rvs,zs,loggs,teffs))
+    axis = np.column_stack([teffs,loggs,zs,rvs])[index]
+    breaks = np.hstack([0,np.nonzero(np.any(np.diff(axis,axis=0)!=0,axis=1))[0]+1,N])
+    tasks = []
+    for k,(i0,i1) in enumerate(zip(breaks[:-1],breaks[1:])):
+        rows = index[i0:i1]
+        teff,logg,z,rv = axis[i0]
+        tasks.append(((k,),(teff,logg,z,rv,ebvs[rows],rows,law,units,responses)))
+    
+    #-- do the calculations
+    if checkpoint is None:
+        checkpoint = os.path.splitext(gridfile)[0]+'.ckpt'
+    header = dict(gridfile=os.path.basename(gridfile),law=law,units=units,
+                  responses=responses,N=N)
+    done,exceptions_logs = _run_tasks(_update_grid_task,tasks,checkpoint,header,
+                                      threads=_get_threads(threads))
+    if exceptions_logs:
+        for i in exceptions_logs:
+            logger.error(i)
+        raise ValueError('Failed to compute %d groups: resume from %s'%(len(exceptions_logs),checkpoint))
+    
+    output = np.zeros((len(responses),N))
+    for block in done.values():
+        output[:,block[0].astype(int)] = block[1:]
     
-    manager = Manager()
-    arr = manager.list([])
-    
-    all_processes = []
-    for j in range(threads):
-        all_processes.append(Process(target=do_process,args=(teffs[j::threads],\
-                                                                loggs[j::threads],\
-                                                                ebvs[j::threads],\
-                                                                zs[j::threads],\
-                                                                rvs[j::threads],\
-                                                                index[j::threads],arr)))
-        all_processes[-1].start()
-    for p in all_processes:
-        p.join()
-    
-    output = np.hstack([res for res in arr])
-    del arr
-    sa = np.argsort(output[0])
-    output = output[:,sa][1:]
-    ascii.write_array(np.rec.fromarrays(output,names=responses),'test.temp',header=True)
     #-- copy old columns and append new ones
+    shutil.copy(gridfile,gridfile+'.backup')
+    hdulist = pyfits.open(gridfile,mode='update')
     cols = []
     for i,photband in enumerate(responses):
         cols.append(pyfits.Column(name=photband,format='E',array=output[i]))
@@ -432,7 +594,7 @@ def update_grid(gridfile,responses,threads=10):
     table = pyfits.new_table(hdulist[1].columns + table.columns,header=hdulist[1].header)
     hdulist[1] = table
     hdulist.close()
-
+    os.remove(checkpoint)
 
 def fix_grid(grid):
     hdulist = pyfits.open(grid,mode='update')
@@ -66,45 +66,111 @@ def parallel_gridsearch(fctn):
         
     return globpar
 
+class _ColumnBuffer(object):
+    """
+    Growable columnar buffer for the results of an iterated grid search.
+    
+    Every field of the record array is stored in its own column. The capacity
+    of the columns is doubled when needed, so appending a new stage does not
+    copy all previous results.
+    """
+    def __init__(self,dtype,capacity=1024):
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.columns = dict([(name,np.empty(capacity,self.dtype[name])) for name in self.dtype.names])
+    
+    def __len__(self):
+        return self.size
+    
+    def __getitem__(self,name):
+        return self.columns[name][:self.size]
+    
+    def append(self,data):
+        N = len(data)
+        capacity = len(self.columns[self.dtype.names[0]])
+        if self.size+N>capacity:
+            capacity = max(2*capacity,self.size+N)
+            for name in self.dtype.names:
+                column = np.empty(capacity,self.dtype[name])
+                column[:self.size] = self.columns[name][:self.size]
+                self.columns[name] = column
+        for name in self.dtype.names:
+            self.columns[name][self.size:self.size+N] = data[name]
+        self.size += N
+    
+    def records(self):
+        return np.rec.fromarrays([self[name] for name in self.dtype.names],dtype=self.dtype)
+
 def iterate_gridsearch(fctn):
     """
-    Decorator to run SED iteratively and zooming in on the minimum.
+    Decorator to run SED grid search adaptively, zooming in on the minimum.
+    
+    All evaluated grid points are kept. After every stage, the confidence
+    region is defined as all points with chi2 below (1+speed*0.5**stage) times
+    the best chi2, and the next stage only samples within the ranges of the
+    parameters in that region. Points that were already evaluated within
+    those ranges are reused: only as many points are added as needed to have
+    C{increase**stage} times the number of points of the first stage inside
+    the new ranges.
     
-    iterations: number of iterative zoom-ins
+    The refinement stops when the best chi2 and the widths of the confidence
+    region change less than the relative tolerance C{tol} between two stages,
+    when no new points are needed, or after C{iterations} stages.
+    
+    iterations: maximum number of stages (1 means no zooming in)
     increase: increase in number of grid points in each search (1 means no increase)
-    size: speed of zoomin: the higher, the slower
+    speed: size of the first confidence region (relative to the best chi2),
+    halved in every stage
+    tol: relative tolerance on the best chi2 and the confidence region widths
     """
     @functools.wraps(fctn)
     def globpar(*args,**kwargs):
         iterations = kwargs.pop('iterations',1)
         increase = kwargs.pop('increase',1)
         speed = kwargs.pop('speed',2)
+        tol = kwargs.pop('tol',0.01)
         
-        N = 0
+        data = None
+        previous = None
         for nr_iter in range(iterations):
             data_ = fctn(*args,**kwargs)
-            #-- append results to record array
-            if nr_iter == 0:
-                data = data_
-                startN = len(data)
-            else:
-                data = np.core.records.fromrecords(data.tolist()+data_.tolist(),dtype=data.dtype)
+            #-- append results to the buffer
+            if data is None:
+                data = _ColumnBuffer(data_.dtype,capacity=iterations*len(data_))
+                startN = len(data_)
+                names = [name for name in ['teff','logg','ebv','z'] if name in data_.dtype.names]
+            data.append(data_)
+            
+            #-- determine the confidence region
+            chisq = data['chisq']
+            best = np.argmin(chisq)
+            limit = chisq[best]+speed*0.5**nr_iter*chisq[best]
+            region = chisq<=limit
+            ranges = dict([(name,(data[name][region].min(),data[name][region].max())) for name in names])
+            current = np.array([chisq[best]]+[ranges[name][1]-ranges[name][0] for name in names])
             
-            #-- select next stage
-            best = np.argmin(data['chisq'])
-            limit = data['chisq'][best]+speed*0.5**nr_iter*data['chisq'][best]
+            logger.info('Best parameters (stage %d/%d): %s (CHI2=%g, cutoff=%g, %d points)'\
+                     %(nr_iter+1,iterations,', '.join(['%s=%.4g'%(name,data[name][best]) for name in names]),
+                       chisq[best],limit,len(data)))
             
-            kwargs['teffrange'] = (data['teff'][data['chisq']<=limit]).min(),(data['teff'][data['chisq']<=limit]).max()
-            kwargs['loggrange'] = (data['logg'][data['chisq']<=limit]).min(),(data['logg'][data['chisq']<=limit]).max()
-            kwargs['ebvrange'] = (data['ebv'][data['chisq']<=limit]).min(),(data['ebv'][data['chisq']<=limit]).max()
-            kwargs['zrange'] = (data['z'][data['chisq']<=limit]).min(),(data['z'][data['chisq']<=limit]).max()
-            kwargs['points'] = increase**(nr_iter+1)*startN
+            #-- stop if the best chi2 and the widths of the region converged
+            if previous is not None and np.all(np.abs(current-previous)<=tol*np.abs(previous)):
+                logger.info('Grid search converged after %d stages'%(nr_iter+1))
+                break
+            previous = current
             
-            logger.info('Best parameters (stage %d/%d): teff=%.0f logg=%.3f E(B-V)=%.3f Z=%.2f (CHI2=%g, cutoff=%g)'\
-                     %(nr_iter+1,iterations,data['teff'][best],data['logg'][best],\
-                       data['ebv'][best],data['z'][best],data['chisq'][best],limit))
+            #-- select next stage: only add what is needed to reach the
+            #   requested number of points inside the new ranges
+            inside = np.ones(len(data),bool)
+            for name in names:
+                kwargs[name+'range'] = ranges[name]
+                inside = inside & (ranges[name][0]<=data[name]) & (data[name]<=ranges[name][1])
+            kwargs['points'] = increase**(nr_iter+1)*startN - inside.sum()
+            if kwargs['points']<=0:
+                logger.info('Grid search: confidence region sufficiently sampled after %d stages'%(nr_iter+1))
+                break
         
-        return data
+        return data.records()
         
     return globpar
 
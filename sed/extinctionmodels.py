@@ -3,6 +3,23 @@
 Extinction models of Arenou, Drimmel and Marschall
 
 Uniformly rewritten by K. Smolders
+
+All models accept single coordinates as well as arrays of longitudes,
+latitudes (and distances), so that the extinction towards a whole catalogue
+is computed in one call:
+
+>>> av = findext([10.2,107.05],[59.0,-34.93],model='arenou',distance=[1000.,144.65])
+
+The Arenou parameters are looked up in a table of 1x1 degree cells, the
+Marshall sightlines via a KD-tree over the model grid, and the Drimmel
+rescaling factors via the COBE quad-cube pixelisation. The conversion factor
+from the native band of a model to C{norm} is computed once per reddening law,
+Rv and norm.
+
+The Drimmel and Schlegel dust maps are memory mapped on first use (see
+L{get_dustmap}), so importing this module does not read them. Call
+L{prefetch_dustmaps} to read them up front, e.g. before starting parallel
+workers, which then share the mapped pages.
 """
 
 from ivs.catalogs import vizier
@@ -15,6 +32,7 @@ import numpy  as np
 from numpy import (abs, arange, array, ceil, cos, dot, floor, int, logical_and,
                    logical_or, max, min, ones, pi, sin, sqrt, where, zeros, exp)
 import scipy  as sc
+from scipy import spatial
 import pyfits as pf
 import logging
 
@@ -101,16 +119,19 @@ def findext(lng, lat, model='drimmel', distance=None, **kwargs):
   d) Marschall is only available for certain longitudes and latitudes:
   0 < lng < 100 or 260 < lng < 360 and -10 < lat < 10
   
+  e) All models accept arrays of longitudes, latitudes and distances, and then
+  return an array. Positions outside the range of a model give NaN.
+  
   @param lng: Galactic Longitude (in degrees)
-  @type lng: float
+  @type lng: float or array
   @param lat: Galactic Lattitude (in degrees)
-  @type lat: float
+  @type lat: float or array
   @param model: the name of the extinction model: ("arenou", "schlegel", "drimmel" or "marshall"; if none given, the program uses "drimmel")
   @type model: str
   @param distance: Distance to the source (in parsecs), if the distance is not given, the total galactic extinction along the line of sight is calculated
-  @type distance: float
+  @type distance: float or array
   @return: The extinction in Johnson V-band
-  @rtype: float
+  @rtype: float or array
   """
   
   if model.lower() == 'drimmel':
@@ -123,7 +144,116 @@ def findext(lng, lat, model='drimmel', distance=None, **kwargs):
     av = findext_schlegel(lng, lat, distance=distance, **kwargs)
   return(av)
 
-#}  
+@memoized
+def _get_norm_factor(redlaw, Rv, norm, photband):
+  """
+  Return the extinction in C{photband} relative to C{norm}.
+  
+  Every model computes the extinction in its own band (Johnson V or K), and
+  converts it to the band given by C{norm}. The factor only depends on the
+  reddening law, Rv and the bands, so it is cached.
+  
+  @param redlaw: the used reddening law
+  @type redlaw: str
+  @param Rv: Av/E(B-V)
+  @type Rv: float
+  @param norm: band to normalise to (e.g. 'Av', 'Ak' or a passband)
+  @type norm: str
+  @param photband: native band of the model
+  @type photband: str
+  @return: A(photband)/A(norm)
+  @rtype: float
+  """
+  redwave, redflux = get_law(redlaw,Rv=Rv,norm=norm,photbands=[photband])
+  return float(redflux[0])
+
+def _prepare_coordinates(ll, bb, distance=None):
+  """
+  Convert coordinates (and distances) to flat arrays of equal length.
+  
+  @return: True if the input was scalar, longitudes, latitudes and distances
+  (None if not given)
+  @rtype: bool, array, array, array
+  """
+  scalar = np.isscalar(ll) and np.isscalar(bb) and (distance is None or np.isscalar(distance))
+  if distance is None:
+    ll, bb = np.broadcast_arrays(np.atleast_1d(np.asarray(ll, float)),
+                                 np.atleast_1d(np.asarray(bb, float)))
+  else:
+    ll, bb, distance = np.broadcast_arrays(np.atleast_1d(np.asarray(ll, float)),
+                                           np.atleast_1d(np.asarray(bb, float)),
+                                           np.atleast_1d(np.asarray(distance, float)))
+    distance = distance.ravel()
+  return scalar, ll.ravel(), bb.ravel(), distance
+
+#}
+# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+#{ Dust map store
+# The Drimmel and Schlegel maps are only opened on first use, and
+# memory mapped: the pages are read from disk when they are accessed, and
+# are shared between processes via the file cache instead of being copied
+# into every (parallel) worker.
+# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+dustmaps = {'avdisk':      ('drimmel', 'avdisk.fits'),
+            'avloc':       ('drimmel', 'avloc.fits'),
+            'avspir':      ('drimmel', 'avspir.fits'),
+            'avdloc':      ('drimmel', 'avdloc.fits'),
+            'avori':       ('drimmel', 'avori.fits'),
+            'coordinates': ('drimmel', 'coordinates.fits'),
+            'avgrid':      ('drimmel', 'avgrid.fits'),
+            'avori2':      ('drimmel', 'avori2.fits'),
+            'rf_allsky':   ('drimmel', 'rf_allsky.fits'),
+            'dust_south':  ('schlegel', 'SFD_dust_4096_sgp.fits'),
+            'mask_south':  ('schlegel', 'SFD_mask_4096_sgp.fits'),
+            'dust_north':  ('schlegel', 'SFD_dust_4096_ngp.fits'),
+            'mask_north':  ('schlegel', 'SFD_mask_4096_ngp.fits')}
+_dustmaps = {}
+
+def get_dustmap(name):
+  """
+  Return a dust map, memory mapped on first use.
+  
+  The first extension with data is returned, i.e. the image for the
+  Drimmel grids and Schlegel maps, and the table for C{rf_allsky}.
+  
+  @param name: name of the map (one of the keys of C{dustmaps})
+  @type name: str
+  @return: the (memory mapped) data of the map
+  @rtype: array or FITS_rec
+  """
+  if not name in _dustmaps:
+    if not name in dustmaps:
+      raise ValueError('Unknown dust map %s (choose from %s)'%(name, ', '.join(sorted(dustmaps))))
+    filename = config.get_datafile(*dustmaps[name])
+    ff = pf.open(filename, memmap=True)
+    ext = 0 if ff[0].data is not None else 1
+    #-- keep the file open, the data are only read when accessed
+    _dustmaps[name] = ff, ff[ext].data
+    logger.debug('Memory mapped dust map %s from %s'%(name, filename))
+  return _dustmaps[name][1]
+
+def prefetch_dustmaps(names=None):
+  """
+  Open dust maps and read them once from disk.
+  
+  Use this before starting parallel workers (or a batch of lookups), so that
+  the maps are in the file cache, and are shared by all processes that map
+  them.
+  
+  @param names: names of the maps (default: all maps)
+  @type names: list of str
+  """
+  if names is None:
+    names = sorted(dustmaps)
+  for name in names:
+    get_dustmap(name)
+    with open(config.get_datafile(*dustmaps[name]), 'rb') as ff:
+      while ff.read(2**20):
+        pass
+    logger.info('Prefetched dust map %s'%(name))
+
+#}
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 #{ Arenou 3D extinction model
 # (based on Arenou et al, "A tridimensional model of the 
@@ -163,26 +293,32 @@ def findext_arenou(ll, bb, distance=None, redlaw='cardelli1989', Rv=3.1, norm='A
         >>> print("Av at lng = %.2f, lat = %.2f and distance = %.2f parsecs is %.2f magnitude" %(lng, lat, dd, av))
         Av at lng = 107.05, lat = -34.93 and distance = 144.65 parsecs is 0.15 magnitude
         
+    3. Whole catalogues are handled at once:
+    
+        >>> av = findext_arenou([10.2,107.05], [59.0,-34.93], distance=[1000.,144.65])
+        
   @param ll: Galactic Longitude (in degrees)
-  @type ll: float
+  @type ll: float or array
   @param bb: Galactic Lattitude (in degrees)
-  @type bb: float
+  @type bb: float or array
   @param distance: Distance to the source (in parsecs)
-  @type distance: float
+  @type distance: float or array
   @return: The extinction in Johnson V-band
-  @rtype: float
+  @rtype: float or array
   """
+  scalar, ll, bb, distance = _prepare_coordinates(ll, bb, distance)
   # make sure that the values for b and l are within the correct range
-  if bb < -90. or bb > 90:
+  if (bb < -90.).any() or (bb > 90).any():
     logger.error("galactic lattitude outside [-90,90] degrees")
-  elif ll < 0. or ll > 360:
+  elif (ll < 0.).any() or (ll > 360).any():
     logger.error("galactic longitude outside [0,360] degrees")
-  elif distance < 0 and distance is not None:
+  elif distance is not None and (distance < 0).any():
     logger.error("distance is negative")
     
   # find the Arenou paramaters in the Appendix of Arenou et al. (1992)
-  alpha, beta, gamma, rr0, saa = _getarenouparams(ll, bb)
-  logger.info("Arenou params: alpha = %.2f, beta = %.2f, gamma = %.2f, r0 = %.2f and saa = %.2f" %(alpha, beta, gamma, rr0, saa))
+  alpha, beta, gamma, rr0, saa = _getarenouparams_multi(ll, bb)
+  if scalar:
+    logger.info("Arenou params: alpha = %.2f, beta = %.2f, gamma = %.2f, r0 = %.2f and saa = %.2f" %(alpha[0], beta[0], gamma[0], rr0[0], saa[0]))
   
   # compute the visual extinction from the Arenou paramaters using Equation 5
   # and 5bis
@@ -190,15 +326,52 @@ def findext_arenou(ll, bb, distance=None, redlaw='cardelli1989', Rv=3.1, norm='A
     av = alpha*rr0 + beta*rr0**2.
   else:
     distance = distance/1e3 # to kparsec
-    if distance <= rr0:
-      av = alpha*distance + beta*distance**2.
-    else:
-      av = alpha*rr0 + beta*rr0**2. + (distance-rr0)*gamma
+    av = where(distance <= rr0, alpha*distance + beta*distance**2.,
+               alpha*rr0 + beta*rr0**2. + (distance-rr0)*gamma)
   
-  #-- Marshall is standard in Ak, but you can change this:
-  redwave, redflux = get_law(redlaw,Rv=Rv,norm=norm,photbands=['JOHNSON.V'])
+  #-- Arenou is standard in Av, but you can change this:
+  av = av/_get_norm_factor(redlaw, Rv, norm, 'JOHNSON.V')
+  
+  return av[0] if scalar else av
+
+@memoized
+def _get_arenou_table():
+  """
+  Tabulate the Arenou parameters on a grid of 1x1 degree cells.
+  
+  The parameters in the Appendix of Arenou et al. (1992) are constant within
+  cells with integer boundaries in longitude and latitude, so evaluating
+  L{_getarenouparams} in the center of every cell gives an exact lookup table.
+  Cells that are not covered by the Appendix are filled with NaN.
+  
+  @return: table of alpha, beta, gamma, rr0 and saa (360 x 180 x 5)
+  @rtype: array
+  """
+  table = np.zeros((360, 180, 5))*np.nan
+  for i in range(360):
+    for j in range(180):
+      try:
+        table[i,j] = _getarenouparams(i+0.5, j-89.5)
+      except UnboundLocalError:
+        pass
+  return table
+
+def _getarenouparams_multi(ll, bb):
+  """
+  Input: arrays of galactic coordinates
+  Output: arrays of Arenou 1992 alpha, beta, gamma, rr0, saa
   
-  return av/redflux[0]
+  @param ll: Galactic Longitude (in degrees)
+  @type ll: array
+  @param bb: Galactic Lattitude (in degrees)
+  @type bb: array
+  @return: alpha, beta, gamma, rr0, saa
+  @rtype: 5 x N array
+  """
+  table = _get_arenou_table()
+  il = np.clip(floor(ll).astype(np.int64), 0, 359)
+  ib = np.clip(floor(bb+90.).astype(np.int64), 0, 179)
+  return table[il,ib].T
 
 def _getarenouparams(ll,bb):
   """
@@ -709,74 +882,97 @@ def findext_marshall(ll, bb, distance=None, redlaw='cardelli1989', Rv=3.1, norm=
         None
         
 
+    4. Whole catalogues are handled at once, positions outside the model
+       give NaN:
+       
+        >>> ak = findext_marshall([10.2,271.05,10.2], [9.0,-4.93,59.0], norm='Ak')
+
   @param ll: Galactic Longitude (in degrees) should be between 0 and 100 or 260 and 360 degrees
-  @type ll: float
+  @type ll: float or array
   @param bb: Galactic Lattitude (in degrees) should be between -10 and 10 degrees
-  @type bb: float
+  @type bb: float or array
   @param distance: Distance to the source (in parsecs)
-  @type distance: float
+  @type distance: float or array
   @param redlaw: the used reddening law (standard: 'cardelli1989')
   @type redlaw: str
   @param Rv: Av/E(B-V) (standard: 3.1)
   @type Rv: float
   @return: The extinction in K-band
-  @rtype: float
+  @rtype: float or array
   """
+  scalar, ll, bb, distance = _prepare_coordinates(ll, bb, distance)
   
   # get Marshall data
-  data_ma, units_ma, comments_ma = get_marshall_data()
+  tree, nb, rr, ext = _get_marshall_index()
   
   # Check validity of the coordinates 
-  if (ll > 100. and ll < 260.) or ll < 0 or ll > 360:
-    Av = None
+  valid = -(((ll > 100.) & (ll < 260.)) | (ll < 0) | (ll > 360))
+  if not valid.all():
     logger.error("Galactic longitude invalid")
-    return Av
-  elif bb > 10. or bb < -10.:
-    Av = None
+  lat_valid = (bb <= 10.) & (bb >= -10.)
+  if not lat_valid.all():
     logger.error("Galactic lattitude invalid")
-    return Av
+  valid = valid & lat_valid
+  if scalar and not valid[0]:
+    return None
   
   # Find the galactic lattitude and longitude of the model, closest to your star
-  dist = np.sqrt((data_ma.GLAT - bb)**2. + (data_ma.GLON - ll)**2.)
-  kma  = np.where(dist == dist.min())
+  dist, kma = tree.query(np.column_stack([ll, bb]))
   
-  if min(dist) > .5:
+  if (dist[valid] > .5).any():
     logger.error("Could not find a good model value")
-    return Av
-  
-  # find the correct index for the distance
-  nb    = data_ma.nb[kma]
-  rr = [] ; e_rr = [] ; ext = [] ; e_ext = []
-  for i in np.arange(nb)+1.:
-    rr.append(data_ma["r%i"%i][kma])
-    e_rr.append(data_ma["e_r%i"%i][kma])
-    ext.append(data_ma["ext%i"%i][kma])
-    e_ext.append(data_ma["e_ext%i"%i][kma])
-  rr = np.array(rr)[:,0] ; e_rr = np.array(e_rr)[:,0] ; ext = np.array(ext)[:,0] ; e_ext = np.array(e_ext)[:,0]  
+  valid = valid & (dist <= .5)
+  if scalar and not valid[0]:
+    return None
+  
+  # the distance bins of every sightline, padded with NaN beyond the last bin
+  nb  = nb[kma]
+  rr  = rr[kma]
+  ext = ext[kma]
+  rows = arange(len(kma))
+  rlast = rr[rows,nb-1]
+  elast = ext[rows,nb-1]
   
   # Interpolate linearly in distance. If beyond furthest bin, keep that value.
   if distance is None:
     logger.info("No distance given")
-    dd = max(rr)
-    ak = ext[-1]
+    ak = elast
   else:
     dd = distance/1e3
-    
-  if dd < min(rr):
-    logger.info("Distance below distance to first bin")
-    ak = (dd/rr[0])*ext[0]
-  elif dd > max(rr):
-    logger.info("Distance more than distance to last bin")
-    ak = ext[-1]
-    dd = max(rr)
-  else:
-    logger.info("Interpolating linearly")
-    ak = sc.interp(dd, rr, ext)
+    # index of the first bin beyond the distance
+    upper = np.clip((rr <= dd[:,None]).sum(axis=1), 1, np.maximum(nb-1, 1))
+    r1, r2 = rr[rows,upper-1], rr[rows,upper]
+    e1, e2 = ext[rows,upper-1], ext[rows,upper]
+    with np.errstate(invalid='ignore', divide='ignore'):
+      ak = e1 + (dd-r1)/(r2-r1)*(e2-e1)
+      ak = where(dd < rr[:,0], (dd/rr[:,0])*ext[:,0], ak)
+    ak = where(dd >= rlast, elast, ak)
+  ak = where(valid, ak, np.nan)
   
   #-- Marshall is standard in Ak, but you can change this:
-  #redwave, redflux = get_law(redlaw,Rv=Rv,wave_units='micron',norm='Av', wave=array([0.54,2.22]))
-  redwave, redflux = get_law(redlaw,Rv=Rv,norm=norm,photbands=['JOHNSON.K'])
-  return ak/redflux[0]
+  ak = ak/_get_norm_factor(redlaw, Rv, norm, 'JOHNSON.K')
+  return ak[0] if scalar else ak
+
+@memoized
+def _get_marshall_index():
+  """
+  Build the spatial index over the sightlines of the Marshall model.
+  
+  @return: KD-tree over (longitude, lattitude) of the sightlines, number of
+  distance bins per sightline, and distances and extinctions of the bins
+  (Nsightlines x Nbins, padded with NaN)
+  @rtype: cKDTree, array, array, array
+  """
+  data_ma, units_ma, comments_ma = get_marshall_data()
+  tree = spatial.cKDTree(np.column_stack([data_ma.GLON, data_ma.GLAT]))
+  nb   = array(data_ma.nb, int)
+  rr   = np.zeros((len(nb), max(nb)))*np.nan
+  ext  = np.zeros((len(nb), max(nb)))*np.nan
+  for i in range(max(nb)):
+    has_bin = nb > i
+    rr[has_bin,i]  = data_ma["r%i"%(i+1)][has_bin]
+    ext[has_bin,i] = data_ma["ext%i"%(i+1)][has_bin]
+  return tree, nb, rr, ext
 
 #}
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -801,21 +997,6 @@ def findext_marshall(ll, bb, distance=None, redlaw='cardelli1989', Rv=3.1, norm=
 # and has not been used to create validated data sets of any type.
 # Please send bug reports to CGIS@ZWICKY.GSFC.NASA.GOV.
 
-avdisk      = pf.getdata(config.get_datafile('drimmel',"avdisk.fits"      ))
-avloc       = pf.getdata(config.get_datafile('drimmel',"avloc.fits"       ))
-avspir      = pf.getdata(config.get_datafile('drimmel',"avspir.fits"      ))
-avdloc      = pf.getdata(config.get_datafile('drimmel',"avdloc.fits"      ))
-avori       = pf.getdata(config.get_datafile('drimmel',"avori.fits"       ))
-coordinates = pf.getdata(config.get_datafile('drimmel',"coordinates.fits" ))
-avgrid      = pf.getdata(config.get_datafile('drimmel',"avgrid.fits"      ))
-avori2      = pf.getdata(config.get_datafile('drimmel',"avori2.fits"      ))
-rf_allsky   = pf.getdata(config.get_datafile('drimmel',"rf_allsky.fits"   ))
-glat        = rf_allsky.glat
-glng        = rf_allsky.glng
-ncomp       = rf_allsky.ncomp
-pnum        = rf_allsky.pnum
-rfac        = rf_allsky.rfac
-
 g2e         = array([[-0.054882486, -0.993821033, -0.096476249], [0.494116468, -0.110993846,  0.862281440], [-0.867661702, -0.000346354,  0.497154957]])
 
 def findext_drimmel(lng, lat, distance=None, rescaling=True,
@@ -848,20 +1029,25 @@ def findext_drimmel(lng, lat, distance=None, rescaling=True,
         Ak at lng = 271.05, lat = -4.93 and distance = 144.65 parsecs is 0.02 magnitude
 
 
+    3. Whole catalogues are handled at once:
+    
+        >>> av = findext_drimmel([10.2,271.05], [9.0,-4.93], distance=[1000.,144.65])
+
   @param lng: Galactic Longitude (in degrees)
-  @type lng: float
+  @type lng: float or array
   @param lat: Galactic Lattitude (in degrees)
-  @type lat: float
+  @type lat: float or array
   @param distance: Distance to the source (in parsecs)
-  @type distance: float
+  @type distance: float or array
   @param rescaling: Rescaling needed or not?
   @type rescaling: boolean
   @return: extinction in V band with/without rescaling
-  @rtype: float
+  @rtype: float or array
   """
+  scalar, lng, lat, distance = _prepare_coordinates(lng, lat, distance)
+  
   # Constants
   deg2rad = pi/180. # convert degrees to rads
-  nsky    = 393216  # number of COBE pixels
   
   # Sun's coordinates (get from dprms)
   xsun    = -8.0
@@ -869,23 +1055,22 @@ def findext_drimmel(lng, lat, distance=None, rescaling=True,
   
   # if distance is not given, make it large and put it in kiloparsec
   if distance is None:
-    d = 1e10
+    d = 1e10*ones(len(lng))
   else:
     d = distance/1e3
   
-  # build skymaps of rescaling parameters for each component
-  dfac       = ones(nsky)
-  sfac       = ones(nsky)
-  lfac       = ones(nsky)
-  indx       = where(ncomp == 1)
-  dfac[indx] = rfac[indx]
-  indx       = where(ncomp == 2)
-  sfac[indx] = rfac[indx]
-  indx       = where(ncomp == 3)
-  lfac[indx] = rfac[indx]
+  # the dust grids
+  avdisk = get_dustmap('avdisk')
+  avspir = get_dustmap('avspir')
+  avdloc = get_dustmap('avdloc')
+  avori  = get_dustmap('avori')
+  avori2 = get_dustmap('avori2')
+  
+  # skymaps of rescaling parameters for each component
+  dfac, sfac, lfac = _get_drimmel_rescaling()
   
   # define abs
-  num     = array(d).size
+  num     = d.size
   out     = zeros(num)
   avloc   = zeros(num)
   abspir  = zeros(num)
@@ -893,6 +1078,7 @@ def findext_drimmel(lng, lat, distance=None, rescaling=True,
   
   l = lng*deg2rad # [radians]
   b = lat*deg2rad # [radians]
+  sinb, cosl, sinl = sin(b), cos(l), sin(l)
   
   # Now for UIDL code:
   # -find the index of the corresponding COBE pixel
@@ -904,24 +1090,19 @@ def findext_drimmel(lng, lat, distance=None, rescaling=True,
   pxindex        = _ll2pix(lng, lat, res)
   xout, yout     = _pix2xy(pxindex, res, sixpack=True)
   tblindex       = vectoarr[xout, yout] # calculate the maximum distance in the grid
-  dmax           = ones(num)*100.
-  if b != 0.:
-    dmax = .49999/abs(sin(b)) - zsun/sin(b)
-  if cos(l) != 0.:
-    dmax = min([dmax,(14.9999/abs(cos(l)) - xsun/cos(l))])
-  if sin(l) != 0.:
-    dmax = min([dmax, 14.9999/abs(sin(l))])
+  with np.errstate(divide='ignore', invalid='ignore'):
+    dmax = ones(num)*100.
+    dmax = where(sinb != 0., .49999/abs(sinb) - zsun/sinb, dmax)
+    dmax = where(cosl != 0., np.minimum(dmax, 14.9999/abs(cosl) - xsun/cosl), dmax)
+    dmax = where(sinl != 0., np.minimum(dmax, 14.9999/abs(sinl)), dmax)
   
   # replace distance with dmax when greater
-  r    = array([d])
-  indx = where(array([d]) > dmax)[0]
-  if len(indx) > 0:
-    r[indx] = dmax
+  r = where(d > dmax, dmax, d)
   
   # heliocentric cartesian coordinates
-  x = array([r*cos(b)*cos(l)])
-  y = array([r*cos(b)*sin(l)])
-  z = array([r*sin(b) + zsun])
+  x = r*cos(b)*cosl
+  y = r*cos(b)*sinl
+  z = r*sinb + zsun
 
   # for stars in Solar neighborhood
   i  = where(logical_and(abs(x) < 1.,abs(y) < 2.))[0]
@@ -976,27 +1157,20 @@ def findext_drimmel(lng, lat, distance=None, rescaling=True,
   #larger orion arm grid 
   if nj > 0:
     # calculate the allowed maximum distance for larger orion grid
-    dmax = 100.
-    if b != 0.:
-      dmax = .49999/abs(sin(b)) - zsun/sin(b)
-    if cos(l) > 0.:
-      dmax = min([dmax, 2.374999/abs(cos(l))])
-    if cos(l) < 0.:
-      dmax = min([dmax, 1.374999/abs(cos(l))])
-    if sin(l) != 0.:
-      dmax = min([dmax, 3.749999/abs(sin(l))])
+    with np.errstate(divide='ignore', invalid='ignore'):
+      dmax = ones(num)*100.
+      dmax = where(sinb != 0., .49999/abs(sinb) - zsun/sinb, dmax)
+      dmax = where(cosl > 0., np.minimum(dmax, 2.374999/abs(cosl)), dmax)
+      dmax = where(cosl < 0., np.minimum(dmax, 1.374999/abs(cosl)), dmax)
+      dmax = where(sinl != 0., np.minimum(dmax, 3.749999/abs(sinl)), dmax)
       
     # replace distance with dmax when greater
-    r1    = array([d])
-    indx  = where(array([d]) >= dmax)[0]
-    n     = len(indx)
-    if n > 0:
-      r1[indx] = dmax
+    r1 = where(d >= dmax, dmax, d)
     
     # galactocentric centric cartesian coordinates
-    x1 = array([r1*cos(b)*cos(l) + xsun])
-    y1 = array([r1*cos(b)*sin(l)])
-    z1 = array([r1*sin(b) + zsun])
+    x1 = r1*cos(b)*cosl + xsun
+    y1 = r1*cos(b)*sinl
+    z1 = r1*sinb + zsun
     
     # define the grid
     dx = 0.05
@@ -1038,10 +1212,35 @@ def findext_drimmel(lng, lat, distance=None, rescaling=True,
   else:
     out = (absdisk + abspir + avloc).flatten()
   
-  #-- Marshall is standard in Ak, but you can change this:
-  redwave, redflux = get_law(redlaw,Rv=Rv,norm=norm,photbands=['JOHNSON.V'])
+  #-- Drimmel is standard in Av, but you can change this:
+  out = out/_get_norm_factor(redlaw, Rv, norm, 'JOHNSON.V')
   
-  return(out/redflux[0])
+  return out[0] if scalar else out
+
+@memoized
+def _get_drimmel_rescaling(nsky=393216):
+  """
+  Build skymaps of the rescaling parameters for the disk, spiral arm and local
+  component of the Drimmel model.
+  
+  @param nsky: number of COBE pixels
+  @type nsky: int
+  @return: rescaling factors of the disk, spiral arms and local component
+  @rtype: 3 x array
+  """
+  rf_allsky  = get_dustmap('rf_allsky')
+  ncomp      = rf_allsky.ncomp
+  rfac       = rf_allsky.rfac
+  dfac       = ones(nsky)
+  sfac       = ones(nsky)
+  lfac       = ones(nsky)
+  indx       = where(ncomp == 1)
+  dfac[indx] = rfac[indx]
+  indx       = where(ncomp == 2)
+  sfac[indx] = rfac[indx]
+  indx       = where(ncomp == 3)
+  lfac[indx] = rfac[indx]
+  return dfac, sfac, lfac
 
 def _pix2xy(pixel, resolution, sixpack=0):
   """
@@ -1059,7 +1258,7 @@ def _pix2xy(pixel, resolution, sixpack=0):
   newshape   = []
   for s in pixel.shape:
     if s > 1:
-      newshape.append()
+      newshape.append(s)
   pixel.shape = newshape
   pix_sz = (pixel)
   
@@ -1082,19 +1281,14 @@ def _rastr(pixel,resolution):
   n         = pixel.size
   i0        = 3
   j0        = 2
-  offx      = [0,0,1,2,2,1]
-  offy      = [1,0,0,0,1,1]
+  offx      = array([0,0,1,2,2,1])
+  offy      = array([1,0,0,0,1,1])
   fij       = _pix2fij(pixel,resolution)
   cube_side = 2**(resolution-1)
   lenc      = i0*cube_side
-  if n > 1:
-    x_out = offx[fij[0,:]] * cube_side + fij[1,:]
-    x_out = lenc - (x_out+1)
-    y_out = offy[fij[0,:]] * cube_side + fij[2,:]
-  else:
-    x_out = offx[fij[0]] * cube_side + fij[1]
-    x_out = lenc - (x_out+1)
-    y_out = offy[fij[0]] * cube_side + fij[2]
+  x_out = offx[fij[0,:]] * cube_side + fij[1,:]
+  x_out = lenc - (x_out+1)
+  y_out = offy[fij[0,:]] * cube_side + fij[2,:]
   return(x_out, y_out)
 
 def _pix2fij(pixel,resolution):
@@ -1105,7 +1299,7 @@ def _pix2fij(pixel,resolution):
   SMOLDERS SEAL OF APPROVAL
   """
   # get number of pixels
-  pixel        = array(pixel)
+  pixel        = array(pixel, int).ravel()
   n            = pixel.size
   output       = array(zeros((3,n)), int)
   res1         = resolution - 1
@@ -1117,20 +1311,12 @@ def _pix2fij(pixel,resolution):
   pow_2       = 2**arange(16)
   ii          = array(zeros(n), int)
   jj          = array(zeros(n), int)
-  #
-  if n > 1:
-    for i in arange(n):
-      for bit in arange(res1):
-        ii[i] = ii[i] | (pow_2[bit]*(1 & fpix))
-        fpix  = fpix >> 1
-        jj[i] = jj[i] | (pow_2[bit]*(1 & fpix))
-        fpix  = fpix >> 1
-  else:
-    for bit in arange(res1):
-        ii    = ii | (pow_2[bit]*(1 & fpix))
-        fpix  = fpix >> 1
-        jj    = jj | (pow_2[bit]*(1 & fpix))
-        fpix  = fpix >> 1
+  # de-interleave the bits of all pixels at once
+  for bit in arange(res1):
+    ii    = ii | (pow_2[bit]*(1 & fpix))
+    fpix  = fpix >> 1
+    jj    = jj | (pow_2[bit]*(1 & fpix))
+    fpix  = fpix >> 1
   output[1,:] = ii
   output[2,:] = jj
   return output
@@ -1165,19 +1351,16 @@ def _ll2uv(lng, lat):
   SMOLDERS SEAL OF APPROVAL
   
   @param lng : galactic longitude
-  @type  lng : float 
+  @type  lng : float or array
   @param lat : galactic lattitude
-  @type  lat : float
-  @return      : unitvector
+  @type  lat : float or array
+  @return      : unitvector (3, or N x 3 for array input)
   @rtype       : ndarray
   """
-  vector = zeros(3)
   d2r    = pi/180
-  lng = lng * d2r
-  lat = lat * d2r
-  vector[0] = cos(lat) * cos(lng)
-  vector[1] = cos(lat) * sin(lng)
-  vector[2] = sin(lat)
+  lng = np.asarray(lng) * d2r
+  lat = np.asarray(lat) * d2r
+  vector = array([cos(lat) * cos(lng), cos(lat) * sin(lng), sin(lat)]).T
   return vector
 
 def _galvec2eclvec(in_uvec):
@@ -1207,14 +1390,12 @@ def _axisxy(vector):
   abs_zx = abs(vec2/vec0)
   abs_zy = abs(vec2/vec1)
   #
-  nface = zeros(len(vec0))
-  for i in arange(len(vec0)):
-    nface[i] = (0 * (abs_zx[i] >= 1 and abs_zy[i] >= 1 and vec2[i] >= 0) +
-                5 * (abs_zx[i] >= 1 and abs_zy[i] >= 1 and vec2[i] <  0) +
-                1 * (abs_zx[i] <  1 and abs_yx[i] <  1 and vec0[i] >= 0) +
-                3 * (abs_zx[i] <  1 and abs_yx[i] <  1 and vec0[i] <  0) +
-                2 * (abs_zy[i] <  1 and abs_yx[i] >= 1 and vec1[i] >= 0) +
-                4 * (abs_zy[i] <  1 and abs_yx[i] >= 1 and vec1[i] <  0))
+  nface = (0 * ((abs_zx >= 1) & (abs_zy >= 1) & (vec2 >= 0)) +
+           5 * ((abs_zx >= 1) & (abs_zy >= 1) & (vec2 <  0)) +
+           1 * ((abs_zx <  1) & (abs_yx <  1) & (vec0 >= 0)) +
+           3 * ((abs_zx <  1) & (abs_yx <  1) & (vec0 <  0)) +
+           2 * ((abs_zy <  1) & (abs_yx >= 1) & (vec1 >= 0)) +
+           4 * ((abs_zy <  1) & (abs_yx >= 1) & (vec1 <  0)))
   #
   nface_0 = (nface == 0)*1.
   nface_1 = (nface == 1)*1.
@@ -1237,34 +1418,23 @@ def _fij2pix(fij,res):
   n-element pixel array for a given resolution.
   """
   #get the number of pixels
-  fij     = array(fij)
-  n       = fij.size/3
+  fij     = array(fij).reshape((3,-1))
+  n       = fij.shape[1]
   # generate output pixel and intermediate pixel arrays
   pixel   = array(zeros(n), dtype=int)
   pixel_1 = array(zeros(n), dtype=int)
   # get input column and row numbers
-  if n > 1:
-    ff = array(fij[0,:], dtype=int)
-    ii = array(fij[1,:], dtype=int)
-    jj = array(fij[2,:], dtype=int)
-  else:
-    ff = int(fij[0])
-    ii = int(fij[1])
-    jj = int(fij[2])
+  ff = array(fij[0,:], dtype=int)
+  ii = array(fij[1,:], dtype=int)
+  jj = array(fij[2,:], dtype=int)
   # calculate the number of pixels in a face
   num_pix_face = 4**(res-1)
   pow_2        = 2**arange(16)
   # if col bit set then set corresponding even bit in pixel_l
   # if row bit set then set corresponding odd bit in pixel_l
-  if n > 1:
-    for i in arange(n):
-      for bit in arange(res-1):
-        pixel_1[i] = pixel_1[i] | ((pow_2[bit] & ii[i]) << bit)
-        pixel_1[i] = pixel_1[i] | ((pow_2[bit] & jj[i]) << (bit+1))
-  else:
-    for bit in arange(res-1):
-      pixel_1 = pixel_1 | ((pow_2[bit] & ii) << bit)
-      pixel_1 = pixel_1 | ((pow_2[bit] & jj) << (bit+1))
+  for bit in arange(res-1):
+    pixel_1 = pixel_1 | ((pow_2[bit] & ii) << bit)
+    pixel_1 = pixel_1 | ((pow_2[bit] & jj) << (bit+1))
   # add face number offset
   pixel = ff*num_pix_face + pixel_1
   return pixel
@@ -1285,11 +1455,8 @@ def _uv2pix(vector, resolution):
   ib           = array([2.**res1 - 1]*n_vec, dtype=int)
   ja           = array(y*num_pix_side, dtype=int)
   jb           = array([2.**res1 - 1]*n_vec, dtype=int)
-  i            = zeros(n_vec)
-  j            = zeros(n_vec)
-  for k in arange(n_vec):
-    i[k] = min([ia[k],ib[k]])
-    j[k] = min([ja[k],jb[k]])
+  i            = np.minimum(ia, ib)
+  j            = np.minimum(ja, jb)
   pixel        = _fij2pix(array([face,i,j]),resolution)
   return pixel
 
@@ -1300,9 +1467,9 @@ def _ll2pix(lng, lat, res=9):
   
   Input
   @param lng     : galactic longitude
-  @type  lng     : float 
+  @type  lng     : float or array
   @param lat     : galactic lattitude
-  @type  lat     : float
+  @type  lat     : float or array
   @return: output coordinate array
   @rtype: ndarray
   
@@ -1346,22 +1513,13 @@ def _trint(mm,x,y,z,missing=None):
 # FOREGROUNDS"
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-@memoized
 def get_schlegel_data_south():
-  # Read in the Schlegel data of the southern hemisphere
-  dustname = config.get_datafile('schlegel',"SFD_dust_4096_sgp.fits")
-  maskname = config.get_datafile('schlegel',"SFD_mask_4096_sgp.fits")
-  data     = pf.getdata(dustname)
-  mask     = pf.getdata(maskname)
-  return data, mask
+  # Get the (memory mapped) Schlegel data of the southern hemisphere
+  return get_dustmap('dust_south'), get_dustmap('mask_south')
 
 def get_schlegel_data_north():
-  # Read in the Schlegel data of the northern hemisphere
-  dustname = config.get_datafile('schlegel',"SFD_dust_4096_ngp.fits")
-  maskname = config.get_datafile('schlegel',"SFD_mask_4096_ngp.fits")
-  data     = pf.getdata(dustname)
-  mask     = pf.getdata(maskname)
-  return data, mask
+  # Get the (memory mapped) Schlegel data of the northern hemisphere
+  return get_dustmap('dust_north'), get_dustmap('mask_north')
 
 def _lb2xy_schlegel(ll, bb):
   """
@@ -1374,16 +1532,15 @@ def _lb2xy_schlegel(ll, bb):
   
   Input
   @param ll     : galactic longitude
-  @type  ll     : float 
+  @type  ll     : float or array
   @param bb     : galactic lattitude
-  @type  bb     : float
+  @type  bb     : float or array
   @return: output coordinate array
   @rtype: ndarray
   """
   deg2rad = pi/180. # convert degrees to rads
 
-  if bb <= 0  : hs = -1.
-  elif bb >  0: hs = +1.
+  hs = where(np.asarray(bb) <= 0, -1., +1.)
   
   yy =  2048 * sqrt(1. - hs * sin(bb*deg2rad)) * cos(ll*deg2rad) + 2047.5
   xx = -2048 * hs * sqrt(1 - hs * sin(bb*deg2rad)) * sin(ll*deg2rad) + 2047.5
@@ -1406,7 +1563,11 @@ def findext_schlegel(ll, bb, distance = None, redlaw='cardelli1989', Rv=3.1, nor
   Then we convert the E(B-V) to Av. Standard we use Av = E(B-V)*Rv with Rv=3.1, but the value of Rv can be given as a keyword.
 
   ! WARNING: the schlegel maps are not usefull when |b| < 5 degrees !
+  
+  Longitudes, latitudes and distances can also be given as arrays, the maps
+  of both hemispheres are then read only if needed.
   """
+  scalar, ll, bb, distance = _prepare_coordinates(ll, bb, distance)
   deg2rad = pi/180. # convert degrees to rads
   dd = distance
   if distance is not None:
@@ -1416,20 +1577,14 @@ def findext_schlegel(ll, bb, distance = None, redlaw='cardelli1989', Rv=3.1, nor
   # first get the right pixel coordinates
   xx, yy = _lb2xy_schlegel(ll,bb)
   
-  # read in the right map:
-  if bb <= 0:
-    data, mask = get_schlegel_data_south()
-  elif bb >  0:
-    data, mask = get_schlegel_data_north()
-
-  if abs(bb) < 10.:
+  if (abs(bb) < 10.).any():
     logger.warning("Schlegel is not good for lattitudes > 10 degrees")
     
   # the xy-coordinates are:
-  xl = floor(xx)
-  yl = floor(yy)
-  xh = xl + 1.
-  yh = yl + 1.
+  xl = array(floor(xx), int)
+  yl = array(floor(yy), int)
+  xh = xl + 1
+  yh = yl + 1
   
   # the weights are just the distances to the points
   w1 = (xl-xx)**2 + (yl-yy)**2
@@ -1437,23 +1592,27 @@ def findext_schlegel(ll, bb, distance = None, redlaw='cardelli1989', Rv=3.1, nor
   w3 = (xh-xx)**2 + (yl-yy)**2
   w4 = (xh-xx)**2 + (yh-yy)**2
   
-  # the values of these points are:
-  v1 = data[xl, yl]
-  v2 = data[xl, yh]
-  v3 = data[xh, yl]
-  v4 = data[xh, yh]  
-  f1 = mask[xl, yl]
-  f2 = mask[xl, yh]
-  f3 = mask[xh, yl]
-  f4 = mask[xh, yh]
-  
-  ebv = (w1*v1 + w2*v2 + w3*v3 + w4*v4) / (w1 + w2 + w3 + w4)
-  
-  # Check flags at the right pixels
-  logger.info("flag of pixel 1 is: %i" %f1)
-  logger.info("flag of pixel 2 is: %i" %f2)
-  logger.info("flag of pixel 3 is: %i" %f3)
-  logger.info("flag of pixel 4 is: %i" %f4)
+  # read in the right map for every hemisphere, and get the values of
+  # these points
+  ebv = zeros(len(ll))
+  for get_data, in_hemisphere in [(get_schlegel_data_south, bb <= 0),
+                                  (get_schlegel_data_north, bb >  0)]:
+    if not in_hemisphere.any():
+      continue
+    data, mask = get_data()
+    h  = in_hemisphere
+    v1 = data[xl[h], yl[h]]
+    v2 = data[xl[h], yh[h]]
+    v3 = data[xh[h], yl[h]]
+    v4 = data[xh[h], yh[h]]
+    ebv[h] = (w1[h]*v1 + w2[h]*v2 + w3[h]*v3 + w4[h]*v4) / (w1[h] + w2[h] + w3[h] + w4[h])
+    
+    # Check flags at the right pixels
+    if scalar:
+      logger.info("flag of pixel 1 is: %i" %mask[xl[0], yl[0]])
+      logger.info("flag of pixel 2 is: %i" %mask[xl[0], yh[0]])
+      logger.info("flag of pixel 3 is: %i" %mask[xh[0], yl[0]])
+      logger.info("flag of pixel 4 is: %i" %mask[xh[0], yh[0]])
   
   if dd is not None:
     ebv = ebv * (1. - exp(-10. * dd * sin(abs(bb*deg2rad))))
@@ -1461,10 +1620,10 @@ def findext_schlegel(ll, bb, distance = None, redlaw='cardelli1989', Rv=3.1, nor
   # if Rv is given, by definition we find Av = Ebv*Rv
   av = ebv*Rv
   
-  #-- Marshall is standard in Ak, but you can change this:
-  redwave, redflux = get_law(redlaw,Rv=Rv,norm=norm,photbands=['JOHNSON.V'])
+  #-- Schlegel is standard in Av, but you can change this:
+  av = av/_get_norm_factor(redlaw, Rv, norm, 'JOHNSON.V')
   
-  return av/redflux[0]
+  return av[0] if scalar else av
   
 #}
 
@@ -315,9 +315,16 @@ be updated. Make sure to add any additional information on the new filters
 manually in that file (e.g. is t a CCD or bolometer, what are the zeropoint
 magnitudes etc).
 
+All response curves and zeropoints are collected in one binary, memory mapped
+file (C{passbands.db}, see L{get_database}). It is rebuilt automatically the
+first time a filter is requested after the C{filters} directory or
+C{zeropoints.dat} has changed.
+
 """
 import os
 import glob
+import fnmatch
+import cPickle
 import pyfits
 import logging
 import numpy as np
@@ -326,6 +333,7 @@ from ivs import config
 from ivs.aux.decorators import memoized
 from ivs.aux import decorators
 from ivs.aux import loggers
+from ivs.aux import numpy_ext
 from ivs.io import ascii
 
 basedir = os.path.dirname(__file__)
@@ -335,6 +343,11 @@ logger.addHandler(loggers.NullHandler())
 
 custom_filters = {'_prefer_file':True}
 
+#-- binary passband database, built from the ASCII response curves and
+#   zeropoints.dat and loaded lazily (see L{get_database})
+dbfile = 'passbands.db'
+_database = {}
+
 #{ response curves
 @memoized
 def get_response(photband):
@@ -362,6 +375,11 @@ def get_response(photband):
     prefer_file = custom_filters['_prefer_file']
     if photband=='OPEN.BOL':
         return np.array([1,1e10]),np.array([1/(1e10-1),1/(1e10-1)])    
+    #-- the passband database holds the curves of all files, sorted in wavelength
+    db = get_database()
+    if db is not None and photband in db['index'] and (prefer_file or not photband in custom_filters):
+        start,end = db['offsets'][db['index'][photband]:db['index'][photband]+2]
+        return np.array(db['data'][0,start:end]),np.array(db['data'][1,start:end])
     #-- either get from file or get from dictionary
     photfile = os.path.join(basedir,'filters',photband)
     photfile_is_file = os.path.isfile(photfile)
@@ -447,7 +465,7 @@ def add_custom_filter(wave,response,**kwargs):
         if 'lit' in name:
             myrow[name] = 0
         myrow[name] = kwargs.pop(name,myrow[name])
-    del decorators.memory[__name__]
+    decorators.clear_memoization(keys=[__name__])
     #-- add info:
     custom_filters[photband]['zp'] = myrow
     logger.debug('Added photband {0} to the predefined set'.format(photband))
@@ -504,7 +522,12 @@ def list_response(name='*',wave_range=(-np.inf,+np.inf)):
         name_ = '*' + name + '*'
     else:
         name_ = name
-    curve_files = sorted(glob.glob(os.path.join(basedir,'filters',name_.upper())))
+    db = get_database()
+    if db is not None:
+        curve_files = fnmatch.filter(db['photbands'],name_.upper())
+    else:
+        curve_files = glob.glob(os.path.join(basedir,'filters',name_.upper()))
+    curve_files = sorted(curve_files)
     curve_files = sorted(curve_files+[key for key in custom_filters.keys() if ((name in key) and not (key=='_prefer_file'))])
     curve_files = [cf for cf in curve_files if not ('HUMAN' in cf or 'EYE' in cf) ]
     #-- select in correct wavelength range
@@ -597,12 +620,26 @@ def eff_wave(photband,model=None,det_type=None):
     these into account to calculate the `true' effective wavelength (e.g., 
     Van Der Bliek, 1996), eq 2.
     
+    The model fluxes can also be a 2D array with one model per row (all on the
+    same wavelength grid), in which case the effective wavelengths of all
+    passbands are computed for all models at once:
+    
+    >>> wave = np.logspace(3,5,1000)
+    >>> fluxes = np.array([wave**-4,wave**-2])
+    >>> eff_wave(['2MASS.J','2MASS.KS'],model=(wave,fluxes)).shape
+    (2, 2)
+    
+    Unless C{det_type} is given, the detector type of every passband is taken
+    from the zeropoint file (or C{CCD} if the passband is not listed there).
+    
     @param photband: photometric passband
     @type photband: str ('SYSTEM.FILTER') or array/list of str
     @param model: model wavelength and fluxes
-    @type model: tuple of 1D arrays (wave,flux)
+    @type model: tuple of 1D arrays (wave,flux), or 1D and 2D array
+    @param det_type: detector type (C{CCD} or C{BOL})
+    @type det_type: str
     @return: effective wavelength [A]
-    @rtype: float or numpy array
+    @rtype: float or numpy array (Nmodels x Nphotbands for 2D model fluxes)
     """
     
     #-- if photband is a string, it's the name of a photband: put it in a container
@@ -615,45 +652,79 @@ def eff_wave(photband,model=None,det_type=None):
     #-- else, it is a container
     else:
         single_band = False
-        
-    my_eff_wave = []
-    for iphotband in photband:
-        try:
-            wave,response = get_response(iphotband)
-            #-- bolometric or ccd?
-            if det_type is None and len(get_info([iphotband])):
-                det_type = get_info([iphotband])['type'][0]
-            elif det_type is None:
-                det_type = 'CCD'
-            if model is None:
-                #this_eff_wave = np.average(wave,weights=response)
-                if det_type=='BOL':
-                    this_eff_wave = np.sqrt(np.trapz(response,x=wave)/np.trapz(response/wave**2,x=wave))
-                else:
-                    this_eff_wave = np.sqrt(np.trapz(wave*response,x=wave)/np.trapz(response/wave,x=wave))
-            else:
-                #-- interpolate response curve onto higher resolution model and
-                #   take weighted average
-                is_response = response>1e-10
-                start_response,end_response = wave[is_response].min(),wave[is_response].max()
-                fluxm = np.sqrt(10**np.interp(np.log10(wave),np.log10(model[0]),np.log10(model[1])))
-                
-                if det_type=='CCD':
-                    this_eff_wave = np.sqrt(np.trapz(wave*fluxm*response,x=wave) / np.trapz(fluxm*response/wave,x=wave))
-                elif det_type=='BOL':
-                    this_eff_wave = np.sqrt(np.trapz(fluxm*response,x=wave) / np.trapz(fluxm*response/wave**2,x=wave))     
-        #-- if the photband is not defined:
-        except IOError:
-            this_eff_wave = np.nan
-        my_eff_wave.append(this_eff_wave)
     
-    if single_band:
-        my_eff_wave = my_eff_wave[0]
+    wave,num,den,offsets = _get_eff_wave_weights(tuple(photband),det_type=det_type)
+    if model is None:
+        fluxm = np.ones((1,len(wave)))
     else:
-        my_eff_wave = np.array(my_eff_wave,float)
+        #-- interpolate all models in log space onto the response curves
+        fluxm = np.log10(np.atleast_2d(model[1]))
+        fluxm = np.sqrt(10**numpy_ext.interp_rows(np.log10(wave),np.log10(model[0]),fluxm))
+    
+    #-- the trapezoidal integrals are sums over the segment of each passband
+    numerator = np.zeros((len(fluxm),len(photband)))
+    denominator = np.zeros((len(fluxm),len(photband)))
+    defined = np.diff(offsets)>0
+    if np.any(defined):
+        starts = offsets[:-1][defined]
+        numerator[:,defined] = np.add.reduceat(fluxm*num,starts,axis=1)
+        denominator[:,defined] = np.add.reduceat(fluxm*den,starts,axis=1)
+    #-- undefined passbands get NaN
+    denominator[:,-defined] = np.nan
+    my_eff_wave = np.sqrt(numerator/denominator)
+    
+    if model is None or np.ndim(model[1])==1:
+        my_eff_wave = my_eff_wave[0]
+    if single_band:
+        my_eff_wave = my_eff_wave[...,0]
+        if not my_eff_wave.ndim:
+            my_eff_wave = float(my_eff_wave)
     
     return my_eff_wave
 
+@memoized
+def _get_eff_wave_weights(photbands,det_type=None):
+    """
+    Precompute the integration weights of the effective wavelengths.
+    
+    All response curves are concatenated, such that the trapezoidal integrals
+    of L{eff_wave} reduce to weighted sums over the segment of each passband.
+    Passbands that are not defined get an empty segment.
+    
+    @param photbands: photometric passbands
+    @type photbands: tuple of str
+    @param det_type: detector type (C{CCD} or C{BOL}), or None to take it from
+    the zeropoint file
+    @type det_type: str
+    @return: concatenated wavelengths, weights of the numerator and
+    denominator, segment offsets
+    @rtype: 4 x array
+    """
+    waves,num,den,offsets = [],[],[],[0]
+    for photband in photbands:
+        try:
+            wave,response = get_response(photband)
+        except IOError:
+            wave,response = np.zeros(0),np.zeros(0)
+        this_det_type = det_type
+        if this_det_type is None:
+            info = get_info([photband])
+            this_det_type = len(info) and info['type'][0] or 'CCD'
+        #-- trapezoidal integration weights
+        step = np.diff(wave)/2.
+        trapz = np.zeros(len(wave))
+        trapz[:-1]+= step
+        trapz[1:]+= step
+        if this_det_type=='BOL':
+            num.append(trapz*response)
+            den.append(trapz*response/wave**2)
+        else:
+            num.append(trapz*wave*response)
+            den.append(trapz*response/wave)
+        waves.append(wave)
+        offsets.append(offsets[-1]+len(wave))
+    return np.hstack(waves),np.hstack(num),np.hstack(den),np.array(offsets)
+
 @memoized
 def get_info(photbands=None):
     """
@@ -676,8 +747,12 @@ def get_info(photbands=None):
     @return: record array containing all information on the requested photbands.
     @rtype: record array
     """
-    zp_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),'zeropoints.dat')
-    zp = ascii.read2recarray(zp_file)
+    db = get_database()
+    if db is not None:
+        zp = db['zeropoints'].copy()
+    else:
+        zp_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),'zeropoints.dat')
+        zp = ascii.read2recarray(zp_file)
     for iph in custom_filters:
         if iph=='_prefer_file': continue
         if 'zp' in custom_filters[iph]:
@@ -738,8 +813,136 @@ def update_info(zp=None):
     zp = np.hstack([zp,new_zp])
     sa = np.argsort(zp['photband'])
     ascii.write_array(zp[sa],'zeropoints.dat',header=True,auto_width=True,comments=['#'+line for line in comms[:-2]],use_float='%g')
+    #-- the passband database is rebuilt on next use
+    _database.clear()
     
 
+#}
+#{ Passband database
+
+def _database_filename():
+    """
+    Return the location of the passband database.
+    
+    The database lives next to this module, unless that directory is not
+    writable. In that case, it is kept in C{~/.ivs/cache}.
+    """
+    if os.access(basedir,os.W_OK):
+        return os.path.join(basedir,dbfile)
+    return os.path.join(os.path.expanduser(os.path.join('~','.ivs','cache')),dbfile)
+
+def _curve_files():
+    """
+    Return the response curve files in the C{filters} directory.
+    
+    Only regular files named C{SYSTEM.FILTER} are response curves: hidden
+    files, editor backups, files without a system prefix (e.g. a README) and
+    subdirectories are skipped.
+    
+    @return: sorted list of filenames
+    @rtype: list of str
+    """
+    curve_files = []
+    for curve_file in sorted(glob.glob(os.path.join(basedir,'filters','*'))):
+        name = os.path.basename(curve_file)
+        if not os.path.isfile(curve_file) or name.startswith('.') or name.endswith('~') or not '.' in name:
+            continue
+        curve_files.append(curve_file)
+    return curve_files
+
+def _sources_mtime():
+    """
+    Return the last modification time of the ASCII passband sources.
+    
+    This is the most recent modification time of the response curves and
+    C{zeropoints.dat}. The C{filters} directory itself is included too, so
+    that removing a curve also triggers a rebuild.
+    """
+    sources = _curve_files()+[os.path.join(basedir,'filters'),os.path.join(basedir,'zeropoints.dat')]
+    return max([os.path.getmtime(source) for source in sources])
+
+def build_database(filename=None):
+    """
+    Collect all response curves and C{zeropoints.dat} in one binary file.
+    
+    The file starts with three 8-byte integers (offset of the data block,
+    length of the header and total number of wavelength points), followed by
+    a pickled header with the names of the passbands, the offset of each curve
+    in the data block and the contents of C{zeropoints.dat}. The data block
+    itself is a 2xN float array with the concatenated (wavelength-sorted)
+    wavelengths and responses, aligned so that it can be memory mapped.
+    
+    There is no need to call this function directly: the database is rebuilt
+    automatically when the response curves or zeropoints are newer.
+    
+    @param filename: name of the database file (defaults to L{dbfile} in the
+    module directory)
+    @type filename: str
+    @return: name of the database file
+    @rtype: str
+    """
+    if filename is None:
+        filename = _database_filename()
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    curve_files = _curve_files()
+    photbands,offsets,waves,responses = [],[0],[],[]
+    for curve_file in curve_files:
+        wave,response = ascii.read2array(curve_file).T[:2]
+        sa = np.argsort(wave)
+        photbands.append(os.path.basename(curve_file))
+        waves.append(wave[sa])
+        responses.append(response[sa])
+        offsets.append(offsets[-1]+len(wave))
+    zp = ascii.read2recarray(os.path.join(basedir,'zeropoints.dat'))
+    header = cPickle.dumps(dict(photbands=photbands,offsets=np.array(offsets),zeropoints=zp),-1)
+    data = np.array([np.hstack(waves),np.hstack(responses)],'<f8')
+    #-- align the data block on 8 bytes after the preamble and header
+    data_offset = 24+len(header)
+    data_offset+= (-data_offset)%8
+    #-- write to a temporary file first, so that other processes never see a
+    #   half-written database
+    tmpname = '{0}.{1}'.format(filename,os.getpid())
+    with open(tmpname,'wb') as ff:
+        ff.write(np.array([data_offset,len(header),data.shape[1]],'<i8').tostring())
+        ff.write(header)
+        ff.write('\x00'*(data_offset-24-len(header)))
+        data.tofile(ff)
+    os.rename(tmpname,filename)
+    logger.info('Built passband database {0} ({1} curves)'.format(filename,len(photbands)))
+    return filename
+
+def get_database():
+    """
+    Return the passband database, building or refreshing it if necessary.
+    
+    The response curves are memory mapped, so loading the database is almost
+    free and forked processes share the same pages. If the database cannot be
+    built, C{None} is returned and the ASCII files are read instead.
+    
+    @return: dictionary with keys C{photbands}, C{index} (photband to curve
+    number), C{offsets}, C{zeropoints} and C{data} (2xN memmap)
+    @rtype: dict
+    """
+    if _database:
+        return _database
+    filename = _database_filename()
+    try:
+        if not os.path.isfile(filename) or os.path.getmtime(filename)<_sources_mtime():
+            build_database(filename)
+    except (IOError,OSError):
+        logger.warning('Cannot build passband database {0}, reading response curves from files'.format(filename))
+        return None
+    with open(filename,'rb') as ff:
+        data_offset,header_length,npoints = np.fromstring(ff.read(24),'<i8')
+        header = cPickle.loads(ff.read(header_length))
+    header['index'] = dict([(photband,i) for i,photband in enumerate(header['photbands'])])
+    header['data'] = np.memmap(filename,dtype='<f8',mode='r',offset=int(data_offset),shape=(2,int(npoints)))
+    _database.update(header)
+    return _database
+
+#}
 
 if __name__=="__main__":
     import sys
@@ -8,6 +8,7 @@ import pyfits
 import itertools
 import re
 import copy
+from multiprocessing import Pool,cpu_count
 
 import numpy as np
 from numpy import inf
@@ -19,9 +20,10 @@ from ivs.sed import model
 from ivs.sed import filters
 from ivs.sed.decorators import iterate_gridsearch,parallel_gridsearch
 from ivs.sigproc import fit as sfit
+from ivs.sigproc import interpol
 from ivs.aux import numpy_ext
 from ivs.aux import progressMeter
-from ivs.aux.decorators import make_parallel
+from ivs.aux.decorators import make_parallel,memoized
 from ivs.units import constants
 
 logger = logging.getLogger("SED.FIT")
@@ -187,6 +189,152 @@ def get_PCA_parameters(obsT,calib,P,means,stds,e_obsT=None,mc=None):
 
 #}
 
+#{ PCA emulator
+
+@memoized(maxsize=4)
+def get_PCA_emulator(photbands,explained=0.99999,ncomp=None,**kwargs):
+    """
+    Compress the integrated photometry of a grid with a PCA.
+
+    The log-fluxes (and log-luminosities) of the pixel grid (see
+    C{model._get_pix_grid}) are standardised per passband and projected on
+    their principal components. Only the first C{ncomp} components, or as many
+    as needed to explain a fraction C{explained} of the variance, are kept.
+    The coefficients of these components are stored on the same pixel grid,
+    so evaluating the emulator means interpolating C{ncomp} numbers instead
+    of one per passband (see L{get_itable_pca}).
+
+    The emulator is computed once per set of passbands and grid settings.
+    Extra keyword arguments (grid and ranges) are passed to
+    C{model._get_pix_grid}.
+
+    @param photbands: names of the photometric passbands
+    @type photbands: list of str
+    @param explained: fraction of the variance to explain
+    @type explained: float
+    @param ncomp: number of components to keep (overrides C{explained})
+    @type ncomp: int
+    @return: emulator: axis values and names (C{axis_values}, C{cols}),
+    coefficient grid (C{coeffs}), loadings, means and standard deviations
+    @rtype: dict
+    """
+    kwargs.setdefault('clear_memory',False)
+    axis_values,gridpnts,pixelgrid,cols = model._get_pix_grid(list(photbands),
+                                                  include_Labs=True,**kwargs)
+    shape = pixelgrid.shape
+    A = pixelgrid.reshape(-1,shape[-1])
+    #-- gaps in the grid are not taken into account
+    valid = np.isfinite(A).all(axis=1)
+    means = A[valid].mean(axis=0)
+    stds = A[valid].std(axis=0)
+    stds[stds==0] = 1.
+    A_st = (A[valid]-means)/stds
+    #-- the principal components follow from the covariance matrix, which is
+    #   only as large as the number of passbands squared
+    eigvals,eigvecs = np.linalg.eigh(np.dot(A_st.T,A_st))
+    order = np.argsort(eigvals)[::-1]
+    eigvals,P = eigvals[order],eigvecs[:,order].T
+    explained_var = np.cumsum(eigvals)/eigvals.sum()
+    if ncomp is None:
+        ncomp = min(explained_var.searchsorted(explained)+1,len(eigvals))
+    P = P[:ncomp]
+    coeffs = np.inf*np.ones((len(A),ncomp))
+    coeffs[valid] = np.dot(A_st,P.T)
+    coeffs = coeffs.reshape(shape[:-1]+(ncomp,))
+    logger.info('PCA emulator: %d components explain %.5f%% of the variance of %d passbands'%(ncomp,explained_var[ncomp-1]*100,len(photbands)))
+    return dict(axis_values=axis_values,cols=cols,coeffs=coeffs,loadings=P,
+                means=means,stds=stds)
+
+
+def _evaluate_PCA_emulator(emulator,values):
+    """
+    Evaluate a PCA emulator.
+
+    @param emulator: emulator (see L{get_PCA_emulator})
+    @type emulator: dict
+    @param values: parameters (one row per axis in C{emulator['cols']})
+    @type values: Npar x N array
+    @return: fluxes and luminosities (Nbands+1 x N)
+    @rtype: array
+    """
+    coeffs = interpol.interpolate(values,emulator['axis_values'],emulator['coeffs'])
+    logflux = np.dot(emulator['loadings'].T,coeffs)
+    logflux = logflux*emulator['stds'][:,None] + emulator['means'][:,None]
+    return 10**logflux
+
+
+def get_itable_pca(teff=None,logg=None,ebv=None,z=0.,rv=3.1,photbands=None,**kwargs):
+    """
+    Retrieve integrated photometry via the PCA emulator of a grid.
+
+    This can be used as a drop-in replacement for C{model.get_itable_pix} in
+    L{igrid_search_pix} and L{iminimize} (set C{model_func='pca'}). Contrary
+    to C{model.get_itable_pix}, fixed (scalar) parameters do not select a
+    subgrid: the emulator is built once on the grid (within the ranges
+    given), and evaluated anywhere inside it.
+
+    Use L{report_PCA_emulator} to check the accuracy of the emulator.
+
+    @param photbands: names of the photometric passbands
+    @type photbands: list of str
+    @keyword explained: fraction of the variance to explain
+    @type explained: float
+    @keyword ncomp: number of components to keep
+    @type ncomp: int
+    @keyword rad: radius
+    @type rad: float or array
+    @return: fluxes (Nbands(xN)), absolute luminosities
+    @rtype: array, float/array
+    """
+    rad = kwargs.pop('rad',None)
+    kwargs.pop('wave_units',None)
+    emulator = get_PCA_emulator(list(photbands),**kwargs)
+    scalar = not hasattr(teff,'__iter__')
+    pars = dict(teff=teff,logg=logg,ebv=0. if ebv is None else ebv,z=z,rv=rv)
+    N = max([len(np.atleast_1d(pars[col])) for col in emulator['cols']]+[1])
+    values = np.array([np.ones(N)*pars[col] for col in emulator['cols']])
+    output = _evaluate_PCA_emulator(emulator,values)
+    flux,Labs = output[:-1],output[-1]
+    if rad is not None:
+        flux,Labs = flux*rad**2,Labs*rad**2
+    if scalar:
+        return flux[:,0],Labs[0]
+    return flux,Labs
+
+
+def report_PCA_emulator(photbands,points=1000,**kwargs):
+    """
+    Compare a PCA emulator with exact interpolation in the pixel grid.
+
+    Both are evaluated in C{points} random points within the grid. Points
+    that fall in a gap of the grid are skipped.
+
+    @param photbands: names of the photometric passbands
+    @type photbands: list of str
+    @param points: number of random points
+    @type points: int
+    @return: passbands (and 'Labs'), median and maximum relative error per
+    passband, number of components
+    @rtype: dict
+    """
+    emulator = get_PCA_emulator(list(photbands),**kwargs)
+    kwargs.pop('explained',None),kwargs.pop('ncomp',None)
+    kwargs.setdefault('clear_memory',False)
+    axis_values,gridpnts,pixelgrid,cols = model._get_pix_grid(list(photbands),
+                                                  include_Labs=True,**kwargs)
+    values = np.array([np.random.uniform(av.min(),av.max(),points) for av in axis_values])
+    exact = 10**interpol.interpolate(values,axis_values,pixelgrid)
+    emulated = _evaluate_PCA_emulator(emulator,values)
+    keep = np.isfinite(exact).all(axis=0) & np.isfinite(emulated).all(axis=0)
+    rel_error = np.abs(emulated[:,keep]/exact[:,keep]-1)
+    report = dict(photbands=list(photbands)+['Labs'],median=np.median(rel_error,axis=1),
+                  max=rel_error.max(axis=1),ncomp=emulator['loadings'].shape[0])
+    for photband,med,mx in zip(report['photbands'],report['median'],report['max']):
+        logger.info('PCA emulator %s: median relative error %.3g, max %.3g'%(photband,med,mx))
+    return report
+
+#}
+
 #{ Grid search
 
 def stat_chi2(meas,e_meas,colors,syn,full_output=False, **kwargs):
@@ -207,7 +355,14 @@ def stat_chi2(meas,e_meas,colors,syn,full_output=False, **kwargs):
     @type syn: 1D array
     @param full_output: set to True if you want individual chisq
     @type full_output: boolean
-    @return: chi-square, scale, e_scale
+    @keyword keep: only return the C{keep} best grid points (many measurements only)
+    @type keep: int
+    @keyword chi2_limit: only return the grid points with a lower chi-square (many measurements only)
+    @type chi2_limit: float
+    @keyword blocksize: number of grid points processed at once (many measurements only)
+    @type blocksize: int
+    @return: chi-square, scale, e_scale (, index of the selected grid points
+    if C{keep} or C{chi2_limit} is given)
     @rtype: float,float,float
     """
     #-- if syn represents only one measurement
@@ -231,6 +386,10 @@ def stat_chi2(meas,e_meas,colors,syn,full_output=False, **kwargs):
             return chisq,meas/syn,meas/e_meas
         else:
             return chisq.sum(),scale,e_scale
+    #-- if syn is many measurements, we process them in blocks (unless the
+    #   individual chi2 values are needed)
+    elif not full_output:
+        return _stat_chi2_blocks(meas,e_meas,colors,syn,**kwargs)
     #-- if syn is many measurements, we need to vectorize this:
     else:
         if sum(-colors) > 0:
@@ -256,6 +415,116 @@ def stat_chi2(meas,e_meas,colors,syn,full_output=False, **kwargs):
             return chisq.sum(axis=0),scale,e_scale
 
 
+def _stat_chi2_blocks(meas,e_meas,colors,syn,distance=None,keep=None,chi2_limit=None,
+                      blocksize=None,**kwargs):
+    """
+    Calculate Chi2 and angular diameter for many grid points, block per block.
+    
+    Gives the same results as the vectorized version of L{stat_chi2}, but the
+    grid points are processed in blocks of C{blocksize} (by default such that a
+    block of synthetic fluxes is about 1MB), using preallocated buffers and
+    in-place operations. Hence, the memory use does not scale with
+    the number of passbands times the number of grid points.
+    
+    Optionally, only the C{keep} best grid points and/or the grid points with
+    a chi-square below C{chi2_limit} are retained while streaming through the
+    grid. In that case, also their indices are returned (sorted on chi-square).
+    
+    Like L{stat_chi2}, other keywords are ignored. The synthetic fluxes may be
+    of any float type, the calculations are done in double precision.
+    
+    @return: chi-square, scale, e_scale (, index)
+    @rtype: 3 (or 4) x 1D array
+    """
+    meas,e_meas = np.ravel(meas),np.ravel(e_meas)
+    colors = np.asarray(colors,bool)
+    absol = -colors
+    nabs,ncol = absol.sum(),colors.sum()
+    iabs,icol = np.flatnonzero(absol),np.flatnonzero(colors)
+    N = syn.shape[1]
+    if blocksize is None:
+        blocksize = max(64,2**17//len(meas))
+    blocksize = min(blocksize,N)
+    select = keep is not None or chi2_limit is not None
+    
+    #-- constant parts and preallocated buffers
+    meas_abs,meas_col = meas[absol].reshape(-1,1),meas[colors].reshape(-1,1)
+    e_abs,e_col = e_meas[absol].reshape(-1,1),e_meas[colors].reshape(-1,1)
+    weights = (meas/e_meas)[absol]
+    syn_abs = np.empty((nabs,blocksize))
+    ratio = np.empty((nabs,blocksize))
+    syn_col = np.empty((ncol,blocksize))
+    if select:
+        chisqs,scales,e_scales = np.empty(blocksize),np.empty(blocksize),np.empty(blocksize)
+        kept = []
+    else:
+        chisqs,scales,e_scales = np.empty(N),np.empty(N),np.empty(N)
+    
+    for start in xrange(0,N,blocksize):
+        n = min(blocksize,N-start)
+        out = slice(0,n) if select else slice(start,start+n)
+        block = syn[:,start:start+n]
+        chisq,scale,e_scale = chisqs[out],scales[out],e_scales[out]
+        chisq[:] = 0.
+        #-- absolute fluxes: scale factor and its error
+        if nabs:
+            S,R = syn_abs[:,:n],ratio[:,:n]
+            S[:] = block[iabs]
+            if distance is not None:
+                scale[:] = 1./distance**2
+                e_scale[:] = scale/100.
+            else:
+                np.divide(meas_abs,S,R)
+                np.dot(weights,R,out=scale)
+                np.divide(scale,weights.sum(),scale)
+                np.subtract(R,scale,R)
+                np.multiply(R,R,R)
+                np.dot(weights,R,out=e_scale)
+                np.divide(e_scale,weights.sum(),e_scale)
+                np.sqrt(e_scale,e_scale)
+            #-- we don't need to scale the colors, only the absolute fluxes
+            np.multiply(S,scale,S)
+            np.subtract(S,meas_abs,S)
+            np.divide(S,e_abs,S)
+            np.multiply(S,S,S)
+            chisq += S.sum(axis=0)
+        else:
+            scale[:] = 0.
+            e_scale[:] = 0.
+        #-- colors
+        if ncol:
+            C = syn_col[:,:n]
+            C[:] = block[icol]
+            np.subtract(C,meas_col,C)
+            np.divide(C,e_col,C)
+            np.multiply(C,C,C)
+            chisq += C.sum(axis=0)
+        #-- only retain the requested grid points
+        if select:
+            index = np.arange(start,start+n)
+            if chi2_limit is not None:
+                ok = chisq<=chi2_limit
+                index,chisq,scale,e_scale = index[ok],chisq[ok],scale[ok],e_scale[ok]
+            kept.append((index,chisq.copy(),scale.copy(),e_scale.copy()))
+            if keep is not None and sum([len(k[0]) for k in kept])>2*keep:
+                kept = [_select_best(kept,keep)]
+    
+    if select:
+        kept = _select_best(kept,keep)
+        return kept[1],kept[2],kept[3],kept[0]
+    return chisqs,scales,e_scales
+
+def _select_best(blocks,keep=None):
+    """
+    Merge blocks of (index, chisq, scale, e_scale) and keep the best ones,
+    sorted on chisq.
+    """
+    index,chisq,scale,e_scale = [np.hstack([block[i] for block in blocks]) for i in range(4)]
+    order = np.argsort(chisq,kind='mergesort')
+    if keep is not None:
+        order = order[:keep]
+    return index[order],chisq[order],scale[order],e_scale[order]
+
 def generate_grid_single_pix(photbands, points=None, clear_memory=True, **kwargs):                     
     """
     Generate a grid of parameters.
@@ -395,6 +664,7 @@ def generate_grid_pix(photbands, points=None, clear_memory=False,**kwargs):
     
     #-- For each component get the grid from grid_single_pix
     pars, npoints = {}, +inf
+    components = sorted(components)
     for i, (comp, grid) in enumerate(zip(components, model.defaults_multiple)):
         ranges_ = {}
         for par in parameters:
@@ -864,17 +1134,88 @@ def igrid_search_pix(meas,e_meas,photbands, constraints={},**kwargs):
         @rtype: array
         """
         model_func = kwargs.pop('model_func',model.get_itable_pix)
+        if model_func=='pca':
+            model_func = get_itable_pca
         stat_func = kwargs.pop('stat_func',stat_chi2)
         colors = np.array([filters.is_color(photband) for photband in photbands],bool)
+        statkws = {}
+        if constraints.get('distance',None) is not None:
+            statkws['distance'] = constraints['distance']
+        #-- grid points that violate the constraints of a multiple system are
+        #   not interpolated
+        keep = constraint_mask(constraints,**kwargs)
+        if keep is not None and not keep.all():
+            N = len(keep)
+            kwargs = dict([(key,value[keep] if _is_grid_column(value,N) else value) \
+                                        for key,value in kwargs.items()])
+            logger.info('Constraints reject %d of %d grid points'%(N-keep.sum(),N))
         #-- run over the grid, retrieve synthetic fluces and compare with
         #   observations.
-        syn_flux,lumis = model_func(photbands=photbands,**kwargs)
-        chisqs,scales,e_scales = stat_func(meas.reshape(-1,1),\
-                                           e_meas.reshape(-1,1),\
-                                           colors,syn_flux, **constraints)
+        if keep is None or keep.any():
+            syn_flux,lumis = model_func(photbands=photbands,**kwargs)
+            chisqs,scales,e_scales = stat_func(meas.reshape(-1,1),\
+                                               e_meas.reshape(-1,1),\
+                                               colors,syn_flux, **statkws)
+        if keep is not None and not keep.all():
+            output = [np.inf*np.ones(N),np.zeros(N),np.zeros(N),np.zeros(N)]
+            if keep.any():
+                for out,values in zip(output,[chisqs,scales,e_scales,lumis]):
+                    out[keep] = values
+            chisqs,scales,e_scales,lumis = output
         #-- return results
         return chisqs,scales,e_scales,lumis
 
+
+def _is_grid_column(value,N):
+    """
+    Check whether a keyword argument is an array with one value per grid point.
+    """
+    return isinstance(value,np.ndarray) and value.ndim==1 and len(value)==N
+
+
+def constraint_mask(constraints,**pars):
+    """
+    Select the grid points of a binary system that satisfy the constraints.
+    
+    The following constraints are supported, as (low,high) ranges:
+        - C{radius_ratio}: ratio of the radii (rad2/rad)
+        - C{mass_ratio}: ratio of the masses (M2/M1), with the masses derived
+        from the surface gravities and radii
+    
+    Besides, the reddening (C{ebv}, C{rv}) and metallicity (C{z}) of both
+    components need to be equal. Masses and distance are not a selection: the
+    radii follow from the masses in L{generate_grid_pix}, and the distance sets
+    the scale factor in L{stat_chi2}.
+    
+    >>> pars = dict(logg=np.array([4.,4.]),rad=np.array([1.,1.]),
+    ...             logg2=np.array([4.,4.]),rad2=np.array([0.5,2.]))
+    >>> print(constraint_mask(dict(radius_ratio=(0.1,1)),**pars))
+    [ True False]
+    
+    @param constraints: constraints
+    @type constraints: dict
+    @return: boolean array (True for valid points), or None if the grid is not
+    a binary grid
+    @rtype: array
+    """
+    if not 'rad2' in pars or not _is_grid_column(pars.get('rad',None),len(pars['rad2'])):
+        return None
+    keep = np.ones(len(pars['rad']),bool)
+    for name in ['ebv','rv','z']:
+        if _is_grid_column(pars.get(name,None),len(keep)) and \
+           _is_grid_column(pars.get(name+'2',None),len(keep)):
+            keep &= pars[name]==pars[name+'2']
+    if constraints.get('radius_ratio',None) is not None:
+        low,high = constraints['radius_ratio']
+        ratio = pars['rad2']/pars['rad']
+        keep &= (low<=ratio) & (ratio<=high)
+    if constraints.get('mass_ratio',None) is not None:
+        low,high = constraints['mass_ratio']
+        #-- M = g R**2 / G
+        ratio = 10**(pars['logg2']-pars['logg'])*(pars['rad2']/pars['rad'])**2
+        keep &= (low<=ratio) & (ratio<=high)
+    return keep
+
 @parallel_gridsearch
 @make_parallel
 def igrid_search(meas,e_meas,photbands,*args,**kwargs):
@@ -945,6 +1286,120 @@ def igrid_search(meas,e_meas,photbands,*args,**kwargs):
     else:
         return chisqs,scales,e_scales,lumis
 
+#-- synthetic photometry shared with the processes of a Monte Carlo grid search
+_mc_grid = {}
+
+def _igrid_search_mc_chunk(meas):
+    """
+    Grid search for a block of (perturbed) measurements at once.
+    
+    The chi2 of L{stat_chi2} is expanded in sums over the passbands, so that
+    it is computed for all realisations and grid points with matrix products,
+    without temporary arrays of size realisations x passbands x grid points.
+    
+    @param meas: realisations x passbands array of measurements
+    @type meas: 2D array
+    @return: index of the best grid point, chi2, scale and error on the scale
+    for each realisation
+    @rtype: 4 x 1D array
+    """
+    syn = _mc_grid['syn_flux']
+    colors = _mc_grid['colors']
+    w2 = 1./_mc_grid['e_meas']**2
+    #-- colors: sum (syn-meas)**2/e**2
+    chisqs = np.dot(w2[colors], syn[colors]**2) \
+            -2*np.dot(meas[:,colors]*w2[colors], syn[colors]) \
+            + np.dot(meas[:,colors]**2, w2[colors]).reshape(-1,1)
+    #-- absolute fluxes: the scale is the weighted average of meas/syn with
+    #   weights meas/e_meas, and sum (scale*syn-meas)**2/e**2
+    absol = -colors
+    if absol.any():
+        weights = meas[:,absol]/_mc_grid['e_meas'][absol]
+        sum_weights = weights.sum(axis=1).reshape(-1,1)
+        scales = np.dot(weights*meas[:,absol], 1./syn[absol]) / sum_weights
+        e_scales = np.dot(weights*meas[:,absol]**2, 1./syn[absol]**2) / sum_weights - scales**2
+        e_scales = np.sqrt(np.where(e_scales<0, 0., e_scales))
+        chisqs += scales**2*np.dot(w2[absol], syn[absol]**2) \
+                  -2*scales*np.dot(meas[:,absol]*w2[absol], syn[absol]) \
+                  + np.dot(meas[:,absol]**2, w2[absol]).reshape(-1,1)
+    else:
+        scales = e_scales = np.zeros_like(chisqs)
+    chisqs[np.isnan(chisqs)] = np.inf
+    best = chisqs.argmin(axis=1)
+    rows = np.arange(len(meas))
+    return best, chisqs[rows,best], scales[rows,best], e_scales[rows,best]
+
+def igrid_search_mc(meas, e_meas, photbands, realisations=1000, points=100000,
+                    disturb=True, threads=1, maxmem=256*2**20, **kwargs):
+    """
+    Monte Carlo grid search: fit many perturbed realisations of the measurements.
+    
+    The grid of parameters is generated (with L{generate_grid_pix}) and the
+    synthetic photometry is interpolated only once. All realisations are then
+    compared with it at the same time, in blocks of realisations that are
+    small enough to keep the memory use of each process below C{maxmem}
+    bytes. The blocks are distributed over C{threads} processes.
+    
+    The last realisation is always the unperturbed measurement.
+    
+    @param meas: the measurements that have to be compared with the models
+    @type meas: 1D numpy array of floats
+    @param e_meas: errors on the measurements
+    @type e_meas: 1D numpy array of floats
+    @param photbands: names of the photometric passbands
+    @type photbands: 1D numpy array of strings
+    @param realisations: number of realisations
+    @type realisations: int
+    @param points: number of grid points
+    @type points: int
+    @param disturb: perturb the measurements with their errors
+    @type disturb: bool
+    @param threads: number of processes (or 'max')
+    @type threads: int or str
+    @param maxmem: approximate memory limit per process (bytes)
+    @type maxmem: int
+    @return: best fitting parameters, labs, chisq, scale and escale of all
+    realisations
+    @rtype: dict of arrays
+    """
+    colors = np.array([filters.is_color(photband) for photband in photbands],bool)
+    pars = generate_grid_pix(photbands,points=points,**kwargs)
+    syn_flux,lumis = model.get_itable_pix(photbands=photbands,**pars)
+    
+    #-- perturb the measurements
+    allmeas = np.resize(meas,(realisations,len(meas)))
+    if disturb:
+        allmeas[:-1] = allmeas[:-1] + np.random.normal(size=(realisations-1,len(meas)))*e_meas
+    
+    #-- a handful of realisations x grid points arrays are needed at once
+    chunksize = max(1,int(maxmem / (8*6*syn_flux.shape[1])))
+    chunks = [allmeas[i:i+chunksize] for i in range(0,realisations,chunksize)]
+    logger.info('MC grid search: %d realisations on %d grid points (%d blocks)'%\
+                   (realisations,syn_flux.shape[1],len(chunks)))
+    
+    #-- share the grid with the processes
+    _mc_grid.update(syn_flux=syn_flux,colors=colors,e_meas=np.asarray(e_meas,float))
+    if threads=='max':
+        threads = cpu_count()
+    threads = min(int(threads),len(chunks))
+    try:
+        if threads>1:
+            pool = Pool(threads)
+            try:
+                results = pool.map(_igrid_search_mc_chunk,chunks)
+            finally:
+                pool.terminate()
+        else:
+            results = [_igrid_search_mc_chunk(chunk) for chunk in chunks]
+    finally:
+        _mc_grid.clear()
+    best,chisqs,scales,e_scales = [np.hstack(res) for res in zip(*results)]
+    
+    #-- collect the results
+    output = dict([(key,pars[key][best]) for key in pars])
+    output.update(labs=lumis[best],chisq=chisqs,scale=scales,escale=e_scales)
+    return output
+
 #}
 
 #{ Fitting: minimizer
@@ -972,21 +1427,21 @@ def create_parameter_dict(**pars):
     
     return result
 
-def _get_info_from_minimizer(minimizers, startpars, photbands, meas, e_meas, **fitkws):
+def _get_info_from_minimizer(minimizers, startpars, models, photbands, meas, e_meas, **fitkws):
     scales, lumis, chisqrs, nfevs, allpars = [], [], [], [], {}
     for n in fitkws['pnames']:
         allpars[n] = np.array([])
         allpars[n+'start'] = np.array([])
-    for mini, start in zip(minimizers, startpars):
+    for mini, fmodel, start in zip(minimizers, models, startpars):
         chisqrs.append(mini.chisqr)
         nfevs.append(mini.nfev)
         
-        val, err = mini.model.get_parameters(full_output=False)
+        val, err = fmodel.get_parameters(full_output=False)
         for n, v in zip(fitkws['pnames'], val):
             allpars[n] = np.append(allpars[n], [v])
             allpars[n+'start'] = np.append(allpars[n+'start'], [start[n].value])
         
-        synth, lum = mini.model.evaluate(photbands, **fitkws)
+        synth, lum = fmodel.evaluate(photbands, **fitkws)
         distance = fitkws['distance'] if 'distance' in fitkws else None
         if distance != None:
             scale = 1/distance**2
@@ -1007,7 +1462,52 @@ def _iminimize_model(varlist, x, *args, **kws):
     pars.update(kws)
     #print pars
     return model.get_itable_pix(wave_units=None, photbands=x, **pars)
-    
+
+def _iminimize_model_pca(varlist, x, *args, **kws):
+    """
+    Same as L{_iminimize_model}, but via the PCA emulator (see L{get_itable_pca}).
+    """
+    pnames = kws.pop('pnames')
+    pars = {}
+    for n, v in zip(pnames, varlist):
+        pars[n] = np.array([v])
+    pars.update(kws)
+    return get_itable_pca(photbands=x, **pars)
+
+def _iminimize_jacobian(varlist, x, *args, **kws):
+    """
+    Synthetic fluxes and their partial derivatives to the fit parameters, in
+    the order of C{pnames} (zero for parameters the grid does not depend on).
+    """
+    pnames = kws.pop('pnames')
+    pars = {}
+    for n, v in zip(pnames, varlist):
+        pars[n] = np.array([v])
+    pars.update(kws)
+    synth, Labs, dsynth = model.get_itable_pix(wave_units=None, photbands=x,
+                                               derivatives=True, **pars)
+    synth = synth[:,0]
+    dsynth = np.array([dsynth[n][:,0] if n in dsynth else np.zeros_like(synth) \
+                                                            for n in pnames]).T
+    return synth, dsynth
+
+def _iminimize_residuals_jacobian(jac, meas, weights=None, **kwargs):
+    """
+    Jacobian of L{_iminimize_residuals}, the scale factor depends on the
+    synthetic fluxes too.
+    """
+    synth, dsynth = jac
+    e_meas = 1 / weights
+    if 'distance' in kwargs:
+        scale = 1/kwargs['distance']**2
+        dscale = np.zeros(dsynth.shape[1])
+    else:
+        ratio = (meas/synth)
+        weights = (meas/e_meas)
+        scale = np.average(ratio,weights=weights)
+        dscale = -np.dot(weights*ratio/synth, dsynth) / weights.sum()
+    return -(dsynth*scale + np.outer(synth, dscale)) / e_meas.reshape(-1,1)
+
 def _iminimize_residuals(synth, meas, weights=None, **kwargs):
     synth = synth[0][:,0] #select the flux.
     e_meas = 1 / weights
@@ -1029,35 +1529,68 @@ def iminimize(meas,e_meas,photbands, points=None, return_minimizer=False,**kwarg
     if the fitkws keyword is supplied, this dict will be made available to the 
     model_func (fit model) during the fitting process. The order of the parameters
     will also be made available as the 'pnames' keyword.
-    """
     
+    For the default model and residual functions, the jacobian is computed
+    analytically from the derivatives of the pixel-grid interpolation, instead
+    of by finite differences. The analytical jacobian is used by the
+    confidence interval calculations too. Set C{use_jacobian=False} to derive
+    it numerically (with steps set by C{epsfcn}), or provide your own with the
+    C{jac_func} (model) and C{res_jac_func} (residuals) keywords.
+    
+    When starting from a number of random C{points}, the starts can be run on
+    C{threads} processes. If C{dup_tol} is given, starts that run into a
+    minimum that is already found (within C{dup_tol}, relative to the
+    parameter ranges) are stopped.
+    
+    With C{model_func='pca'}, the synthetic photometry is computed with the
+    PCA emulator of the grid (see L{get_itable_pca}).
+    """
+
+    if kwargs.get('model_func',None)=='pca':
+        kwargs['model_func'] = _iminimize_model_pca
     kick_list = kwargs.pop('kick_list', None)
     constraints = kwargs.pop('constraints', dict())
+    use_jacobian = kwargs.pop('use_jacobian', True)
+    if not 'model_func' in kwargs and not 'res_func' in kwargs:
+        jacobian = kwargs.pop('jac_func', _iminimize_jacobian)
+        jacfunc = kwargs.pop('res_jac_func', _iminimize_residuals_jacobian)
+    else:
+        jacobian = kwargs.pop('jac_func', None)
+        jacfunc = kwargs.pop('res_jac_func', None)
+    if not use_jacobian:
+        jacobian, jacfunc = None, None
     fitmodel = kwargs.pop('model_func',_iminimize_model)
     residuals = kwargs.pop('res_func',_iminimize_residuals)
     epsfcn = kwargs.pop('epsfcn', 0.0005)# using ~3% step to derive jacobian.
+    threads = kwargs.pop('threads', 1)
+    dup_tol = kwargs.pop('dup_tol', None)
     
     #-- get the parameters
     parameters = create_parameter_dict(**kwargs)
         
     #-- setup the fitting model
     pnames = parameters.pop('names')
-    fmodel = sfit.Function(function=fitmodel, par_names=pnames)
+    fmodel = sfit.Function(function=fitmodel, par_names=pnames, jacobian=jacobian)
     fmodel.setup_parameters(**parameters)  
     
     #-- fit the model to the data
     fitkws = dict(pnames=pnames)
     fitkws.update(constraints)
+    gridkws = dict(weights=1/e_meas, kws=fitkws, resfunc=residuals, engine='leastsq', \
+                   epsfcn=epsfcn, points=points, parameters=kick_list, jacfunc=jacfunc, \
+                   threads=threads, dup_tol=dup_tol)
     if points == None:
         startpars = [copy.deepcopy(fmodel.parameters)]
         minimizer = sfit.minimize(photbands,meas, fmodel, weights=1/e_meas, kws=fitkws, \
                                       resfunc=residuals, engine='leastsq', epsfcn=epsfcn,\
-                                      ftol=0.001, xtol=0.001)
-        minimizer = [minimizer]
+                                      ftol=0.001, xtol=0.001, jacfunc=jacfunc)
+        minimizer, newmodels = [minimizer], [fmodel]
+    elif return_minimizer:
+        #-- the best fit of the grid, as used by the calculate ci methods
+        return sfit.grid_minimize(photbands, meas, fmodel, return_all=False, **gridkws)
     else:
         minimizer, startpars, newmodels, chisqr = sfit.grid_minimize(photbands, meas, fmodel, \
-                           weights=1/e_meas, kws=fitkws, resfunc=residuals, engine='leastsq', \
-                           epsfcn=epsfcn, points=points, parameters=kick_list, return_all=True)
+                                                        return_all=True, **gridkws)
     
     if return_minimizer:
         #-- return the actual minimizer used by the calculate ci methods
@@ -1065,7 +1598,7 @@ def iminimize(meas,e_meas,photbands, points=None, return_minimizer=False,**kwarg
     else:
         #-- for all other users return the actual results
         chisqr, nfev, scale, lumis, grid = _get_info_from_minimizer(minimizer, startpars,\
-                                                        photbands, meas, e_meas, **fitkws)
+                                          newmodels, photbands, meas, e_meas, **fitkws)
         ##-- collect all parameter info
         #val, err, vary, min, max, expr = fmodel.get_parameters(full_output=True)
         #pars = dict(name=pnames, value=val, cilow=min, cihigh=max)
@@ -1109,6 +1642,14 @@ def calculate_iminimize_CI2D(meas,e_meas,photbands, xpar, ypar, df=None, **kwarg
     You can provide limits on the parameters yourself, if none are 
     provided, the function will take care of it, but it might crash 
     if the limits are outside the model range.
+    
+    Every grid point is a fit with xpar and ypar fixed, started from the fit
+    of a neighbouring point. The fits can be run on C{threads} processes. With
+    C{refine} > 0, the grid is first computed every 2**refine points and then
+    only refined around the contours of the C{CI_levels} (in terms of
+    C{ci_red}), elsewhere C{ci_chi2} is interpolated (see
+    L{ivs.sigproc.fit.Minimizer.calculate_CI_2D}).
+    
     returns: x vals, y vals, ci values
     """
     maxiter = kwargs.pop('maxiter', 25)
@@ -1116,6 +1657,9 @@ def calculate_iminimize_CI2D(meas,e_meas,photbands, xpar, ypar, df=None, **kwarg
     if type(res) == int: res = (res,res)
     limits = kwargs.pop('limits', None)
     citype = kwargs.pop('type', 'prob')
+    threads = kwargs.pop('threads', 1)
+    refine = kwargs.pop('refine', 0)
+    CI_levels = kwargs.pop('CI_levels', (0.6827, 0.9545, 0.9973))
     
     mini = iminimize(meas,e_meas,photbands, return_minimizer=True, **kwargs)
     val, err, vary, low, high, expr = mini.model.get_parameters(full_output=True)
@@ -1153,14 +1697,17 @@ def calculate_iminimize_CI2D(meas,e_meas,photbands, xpar, ypar, df=None, **kwarg
     logger.debug('Recalculated grid limits to: \n\t%s: %s <-> %s \n\t%s %s <-> %s'%(xpar,
                  limits[0][0], limits[0][1], ypar, limits[1][0], limits[1][1]))
     
-    x,y,ci_chi2 = mini.calculate_CI_2D(xpar=xpar, ypar=ypar, res=res, limits=limits,
-                                       ctype='chi2')
-    
     #-- do the statistics
     N = mini.ndata
     if df == None: df = mini.nvarys
     k = N-df
     factor = max(mini.chisqr/k,1)
+    levels = factor*scipy.stats.distributions.chi2.ppf(CI_levels,k)
+    
+    x,y,ci_chi2 = mini.calculate_CI_2D(xpar=xpar, ypar=ypar, res=res, limits=limits,
+                                       ctype='chi2', threads=threads, refine=refine,
+                                       levels=levels)
+    
     ci_raw = scipy.stats.distributions.chi2.cdf(ci_chi2,k)
     ci_red = scipy.stats.distributions.chi2.cdf(ci_chi2/factor,k)
     
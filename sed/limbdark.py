@@ -111,11 +111,13 @@ Author: Pieter Degroote, with thanks to Steven Bloemen.
 """
 import logging
 import os
+import sys
 import itertools
+from multiprocessing import Pool
 try:
-    import pyfits as pf
+    import pyfits
 except:
-    import astropy.io.fits as pf
+    import astropy.io.fits as pyfits
 import numpy as np
 from scipy.optimize import leastsq,fmin
 from scipy.interpolate import splrep, splev
@@ -127,6 +129,7 @@ from ivs.sed import model
 from ivs.spectra import tools
 from ivs.units import constants
 from ivs.aux.decorators import memoized,clear_memoization
+from ivs.sigproc import interpol
 from ivs import config
 
 logger = logging.getLogger("SED.LIMBDARK")
@@ -438,8 +441,8 @@ def get_table(teff=None,logg=None,ebv=None,vrad=None,star=None,
     
     #-- redden if necessary
     if ebv is not None and ebv>0:
-        for i in range(len(mu)):
-            table[:,i] = reddening.redden(table[:,i],wave=wave,ebv=ebv,rtype='flux',**kwargs)
+        extinction = reddening.redden(np.ones_like(wave),wave=wave,ebv=ebv,rtype='flux',**kwargs)
+        table = table*extinction[:,None]
     
     #-- that's it!
     return mu,wave,table
@@ -470,49 +473,68 @@ def get_itable2(teff=None,logg=None,theta=None,mu=1,photbands=None,absolute=Fals
     else:
         return Imu
 
-@memoized
-def _get_itable_markers(photband,gridfile,
-                    teffrange=(-np.inf,np.inf),loggrange=(-np.inf,np.inf)):
+def get_itable(teff=None,logg=None,theta=None,mu=1,photbands=None,absolute=False,
+               ebv=None,vrad=None,return_coeffs=False,**kwargs):
     """
-    Get a list of markers to more easily retrieve integrated fluxes.
+    Retrieve passband-integrated intensities for (arrays of) stellar parameters.
+    
+    All parameters can be arrays (they are broadcast against each other), so
+    that the intensities of all surface elements of a star are computed in one
+    call:
+    
+    >>> teffs = np.linspace(9000,12000,100)
+    >>> mus = np.linspace(0.1,1,100)
+    >>> Imu = get_itable(teff=teffs,logg=4.0,mu=mus,photbands=['JOHNSON.V','JOHNSON.B'])
+    >>> print(Imu.shape)
+    (2, 100)
+    
+    With scalar parameters, one value per passband is returned.
+    
+    The LD coefficients and (the logarithm of) the central intensities are
+    interpolated linearly in a pixel grid that is built once per set of
+    passbands (see L{_get_pix_grid}).
+    
+    @param teff: effective temperature
+    @type teff: float or array
+    @param logg: logarithmic gravity (cgs)
+    @type logg: float or array
+    @param theta: limb angle (radians), overrides C{mu}
+    @type theta: float or array
+    @param mu: cosine of the limb angle (mu=1 is the center of the disk)
+    @type mu: float or array
+    @param photbands: photometric passbands
+    @type photbands: list of str
+    @param absolute: multiply with the central intensity
+    @type absolute: bool
+    @param ebv: reddening (only if the grid has an E(B-V) axis)
+    @type ebv: float or array
+    @param vrad: radial velocity (only if the grid has a vrad axis)
+    @type vrad: float or array
+    @param return_coeffs: also return the interpolated LD coefficients
+    @type return_coeffs: bool
+    @return: intensities (Nphotbands x N), (LD coefficients, Nphotbands x Ncoeffs x N)
+    @rtype: array(, array)
     """
-    clear_memoization()
-    
-    ff = pyfits.open(gridfile)
-    ext = ff[photband]
-    columns = ext.columns.names
-    names = ['teff','logg']
-    grid = [ext.data.field('teff'),
-            ext.data.field('logg')]
-    if 'ebv' in columns:
-        names.append('ebv')
-        grid.append(ext.data.field('ebv'))
-    if 'vrad' in columns:
-        names.append('vrad')
-        grid.append(ext.data.field('vrad'))
-    
-    grid_axes = [np.sort(list(set(i))) for i in grid]
-    
-    #-- we construct an array representing the teff-logg-ebv content, but
-    #   in one number: 50000400 means: 
-    #   T=50000,logg=4.0
-    N = len(grid[0])
-    markers = np.zeros(N,float)
-    gridpnts = np.zeros((N,len(grid)))
-    pars = np.zeros((N,5))
-    
-    for i,entries in enumerate(zip(*grid)):
-        markers[i] = encode(**{key:entry for key,entry in zip(names,entries)})
-        gridpnts[i]= entries
-        pars[i] = list(ext.data[i][-5:])
-    ff.close()
-    sa = np.argsort(markers)
-    print 'read in gridfile',gridfile
-    pars[:,-1] = np.log10(pars[:,-1])
-    return markers[sa],grid_axes,gridpnts[sa],pars[sa]
-        
-
-
+    if theta is not None:
+        mu = np.cos(theta)
+    scalar = not np.any([hasattr(x,'__iter__') for x in [teff,logg,mu,ebv,vrad]])
+    values = dict(zip(['teff','logg','ebv','vrad','mu'],
+                  np.broadcast_arrays(*[np.atleast_1d(x) for x in [teff,logg,
+                         0. if ebv is None else ebv,0. if vrad is None else vrad,mu]])))
+    axis_values,pixelgrid,names,law = _get_pix_grid(tuple(photbands),**kwargs)
+    pars = interpol.interpolate(np.array([values[name] for name in names],float),
+                                axis_values,pixelgrid)
+    #-- per passband: the coefficients of the law, and log of the central intensity
+    pars = pars.reshape((len(photbands),-1,len(values['mu'])))
+    coeffs,I_x1 = pars[:,:-1],10**pars[:,-1]
+    Imu = globals()['ld_%s'%(law)](values['mu'],np.swapaxes(coeffs,0,1))*np.ones_like(I_x1)
+    if absolute:
+        Imu = Imu*I_x1
+    if scalar:
+        Imu,coeffs = Imu[:,0],coeffs[:,:,0]
+    if return_coeffs:
+        return Imu,coeffs
+    return Imu
 
 def get_limbdarkening(teff=None,logg=None,ebv=None,vrad=None,z=None,photbands=None,normalised=False,**kwargs):
     """
@@ -555,10 +577,9 @@ def get_limbdarkening(teff=None,logg=None,ebv=None,vrad=None,z=None,photbands=No
         z = defaults['z']
     #-- retrieve model atmosphere for a given teff and logg
     mus,wave,table = get_table(teff=teff,logg=logg,ebv=ebv,vrad=vrad,z=z,**kwargs)
-    #-- compute intensity over the stellar disk, and normalise
-    intensities = np.zeros((len(mus),len(photbands)))
-    for i in range(len(mus)):
-        intensities[i] = model.synthetic_flux(wave,table[:,i],photbands)
+    #-- compute intensity over the stellar disk (all angles and passbands at
+    #   once), and normalise
+    intensities = model.synthetic_flux(wave,np.ascontiguousarray(table.T),photbands)
     if normalised:
         intensities/= intensities.max(axis=0)
     #-- or compute the intensity only for one angle:
@@ -796,38 +817,55 @@ def fit_law(mu,Imu,law='claret',fitmethod='equidist_r_leastsq'):
     
     
 def fit_law_to_grid(photband,vrads=[0],ebvs=[0],zs=[0],
-             law='claret',fitmethod='equidist_r_leastsq',**kwargs):
+             law='claret',fitmethod='equidist_r_leastsq',threads=1,**kwargs):
     """
     Gets the grid and fits LD law to all the models.
     
     Does not use mu=0 point in the fitting process.
+    
+    C{photband} can also be a list of passbands, in which case the intensities
+    of every model are integrated over all passbands at once. The models are
+    independent, and are distributed over C{threads} processes.
+    
+    @param photband: photometric passband(s)
+    @type photband: str or list of str
+    @param threads: number of processes
+    @type threads: int
+    @return: grid points (Nmodels x 5: teff, logg, ebv, vrad, z), LD
+    coefficients (Nmodels x Ncoeffs) and Imu1, SRS and dint (Nmodels x 3). The
+    last two get an extra first axis for the passbands if a list of passbands
+    was given.
+    @rtype: array, array, array
     """
+    single_band = isinstance(photband,str)
+    photbands = single_band and [photband] or list(photband)
     teffs, loggs = get_grid_dimensions(**kwargs)
-    teffs=teffs
-    loggs=loggs
-    grid_pars = []
-    grid_coeffs = []
-    Imu1s = []
-    logger.info('Fitting photband {}'.format(photband))
-    for teff_, logg_ in zip(teffs, loggs):
-        for ebv_,vrad_,z_ in itertools.product(ebvs,vrads,zs):
-            logger.info('teff={}, logg={}, ebv={}, vrad={}, z={}'.format(teff_, logg_,ebv_,vrad_,z_))
-            mu, Imu = get_limbdarkening(teff=teff_, logg=logg_, ebv=ebv_,vrad=vrad_,z=z_,photbands=[photband],**kwargs)
-            Imu1 = Imu.max()
-            Imu = Imu[:,0]/Imu1
-            coeffs,res,dflux = fit_law(mu[mu>0], Imu[mu>0],law=law,fitmethod=fitmethod)
-            grid_coeffs.append(coeffs)
-            grid_pars.append([teff_,logg_,ebv_,vrad_,z_])
-            Imu1s.append([Imu1,res,dflux])
+    grid_pars = [(teff_,logg_)+combo for teff_,logg_ in zip(teffs,loggs) \
+                                     for combo in itertools.product(ebvs,vrads,zs)]
+    tasks = [((i,),pars+(photbands,law,fitmethod,kwargs)) for i,pars in enumerate(grid_pars)]
+    logger.info('Fitting photband(s) {} ({} models)'.format(', '.join(photbands),len(tasks)))
+    if threads>1:
+        pool = Pool(threads)
+        results = pool.map(_fit_law_task,tasks)
+        pool.close()
+    else:
+        results = itertools.imap(_fit_law_task,tasks)
+    output = []
+    for task,result,error in results:
+        if error is not None:
+            raise ValueError(error)
+        output.append(result)
     #- wrap up results in nice arrays
-    grid_pars = np.array(grid_pars)
-    grid_coeffs = np.array(grid_coeffs)
-    Imu1s = np.array(Imu1s)
-    
+    output = np.array(output)
+    grid_pars = output[:,0,:5]
+    grid_coeffs = output[:,:,5:-3].swapaxes(0,1)
+    Imu1s = output[:,:,-3:].swapaxes(0,1)
+    if single_band:
+        return grid_pars, grid_coeffs[0], Imu1s[0]
     return grid_pars, grid_coeffs, Imu1s
     
 def generate_grid(photbands,vrads=[0],ebvs=[0],zs=[0],
-             law='claret',fitmethod='equidist_r_leastsq',outfile='mygrid.fits',**kwargs):
+             law='claret',fitmethod='equidist_r_leastsq',outfile='mygrid.fits',threads=1,**kwargs):
     
     if os.path.isfile(outfile):
         hdulist = pyfits.open(outfile,mode='update')
@@ -842,29 +880,18 @@ def generate_grid(photbands,vrads=[0],ebvs=[0],zs=[0],
     hd.update('LAW', law, 'FITTED LD LAW')
     hd.update('GRID', kwargs.get('grid',defaults['grid']), 'GRID')
     
+    todo = []
     for photband in photbands:
         if photband in existing_bands:
             logger.info('BAND {} already exists: skipping'.format(photband))
-            continue
-        pars,coeffs,Imu1s = fit_law_to_grid(photband,vrads=vrads,ebvs=ebvs,zs=zs,**kwargs)
-        cols = []
-
-        cols.append(pyfits.Column(name='Teff', format='E', array=pars[:,0]))
-        cols.append(pyfits.Column(name="logg", format='E', array=pars[:,1]))
-        cols.append(pyfits.Column(name="ebv" , format='E', array=pars[:,2]))
-        cols.append(pyfits.Column(name="vrad", format='E', array=pars[:,3]))
-        cols.append(pyfits.Column(name="z"   , format='E', array=pars[:,4]))
-        for col in range(coeffs.shape[1]):
-            cols.append(pyfits.Column(name='a{:d}'.format(col+1), format='E', array=coeffs[:,col]))
-        cols.append(pyfits.Column(name='Imu1', format='E', array=Imu1s[:,0]))
-        cols.append(pyfits.Column(name='SRS', format='E', array=Imu1s[:,1]))
-        cols.append(pyfits.Column(name='dint', format='E', array=Imu1s[:,2]))
-
-        newtable = pyfits.new_table(pyfits.ColDefs(cols))
-        newtable.header.update('EXTNAME', photband, "SYSTEM.FILTER")
-        newtable.header.update('SYSTEM', photband.split('.')[0], 'PASSBAND SYSTEM')
-        newtable.header.update('FILTER', photband.split('.')[1], 'PASSBAND FILTER')
-        hdulist.append(newtable)
+        else:
+            todo.append(photband)
+    #-- all passbands are integrated and fitted in one pass over the grid
+    if todo:
+        pars,coeffs,Imu1s = fit_law_to_grid(todo,vrads=vrads,ebvs=ebvs,zs=zs,
+                                law=law,fitmethod=fitmethod,threads=threads,**kwargs)
+        for i,photband in enumerate(todo):
+            hdulist.append(_ld_table(photband,pars,coeffs[i],Imu1s[i]))
     
     if os.path.isfile(outfile):
         hdulist.close()
@@ -875,6 +902,70 @@ def generate_grid(photbands,vrads=[0],ebvs=[0],zs=[0],
 
 #{ Internal functions
 
+def _fit_law_task(args):
+    """
+    Fit the LD law in all passbands for one model.
+    
+    @return: task, array (Nphotbands x (teff,logg,ebv,vrad,z,coeffs,Imu1,SRS,dint)),
+    error message
+    @rtype: tuple, ndarray, str
+    """
+    task,(teff,logg,ebv,vrad,z,photbands,law,fitmethod,kwargs) = args
+    try:
+        mu,Imu = get_limbdarkening(teff=teff,logg=logg,ebv=ebv,vrad=vrad,z=z,photbands=photbands,**kwargs)
+        Imu1 = Imu.max(axis=0)
+        Imu = Imu/Imu1
+        output = []
+        for j in range(len(photbands)):
+            coeffs,res,dflux = fit_law(mu[mu>0],Imu[mu>0,j],law=law,fitmethod=fitmethod)
+            output.append(np.hstack([teff,logg,ebv,vrad,z,coeffs,Imu1[j],res,dflux]))
+    except Exception:
+        return task,None,'teff={}, logg={}, ebv={}, vrad={}, z={}: {}'.format(teff,logg,ebv,vrad,z,sys.exc_info()[1])
+    return task,np.array(output),None
+
+def _ld_table(photband,pars,coeffs,Imu1s):
+    """
+    Make a FITS table extension of the LD coefficients of one passband.
+    
+    @param pars: grid points (Nmodels x 5: teff, logg, ebv, vrad, z)
+    @type pars: array
+    @param coeffs: LD coefficients (Nmodels x Ncoeffs)
+    @type coeffs: array
+    @param Imu1s: Imu1, SRS and dint (Nmodels x 3)
+    @type Imu1s: array
+    @return: table extension
+    @rtype: pyfits.BinTableHDU
+    """
+    cols = []
+    cols.append(pyfits.Column(name='Teff', format='E', array=pars[:,0]))
+    cols.append(pyfits.Column(name="logg", format='E', array=pars[:,1]))
+    cols.append(pyfits.Column(name="ebv" , format='E', array=pars[:,2]))
+    cols.append(pyfits.Column(name="vrad", format='E', array=pars[:,3]))
+    cols.append(pyfits.Column(name="z"   , format='E', array=pars[:,4]))
+    for col in range(coeffs.shape[1]):
+        cols.append(pyfits.Column(name='a{:d}'.format(col+1), format='E', array=coeffs[:,col]))
+    cols.append(pyfits.Column(name='Imu1', format='E', array=Imu1s[:,0]))
+    cols.append(pyfits.Column(name='SRS', format='E', array=Imu1s[:,1]))
+    cols.append(pyfits.Column(name='dint', format='E', array=Imu1s[:,2]))
+
+    newtable = pyfits.new_table(pyfits.ColDefs(cols))
+    newtable.header.update('EXTNAME', photband, "SYSTEM.FILTER")
+    newtable.header.update('SYSTEM', photband.split('.')[0], 'PASSBAND SYSTEM')
+    newtable.header.update('FILTER', photband.split('.')[1], 'PASSBAND FILTER')
+    return newtable
+
+def encode(teff=0,logg=0,ebv=0,vrad=0):
+    """
+    Encode grid parameters in one number, e.g. for sorting and searching.
+    
+    Works on arrays as well as on scalars.
+    
+    >>> print(int(encode(teff=50000,logg=4.0)))
+    50000400000500
+    """
+    return np.round(teff)*1e9 + np.round(np.asarray(logg)*100)*1e6 +\
+           np.round(np.asarray(ebv)*100)*1e3 + np.round(vrad) + 500
+
 def _r(mu):
     """
     Convert mu to r coordinates
@@ -1007,21 +1098,55 @@ def _get_itable_markers(photband,gridfile,
     #-- we construct an array representing the teff-logg-ebv content, but
     #   in one number: 50000400 means: 
     #   T=50000,logg=4.0
-    N = len(grid[0])
-    markers = np.zeros(N,float)
-    gridpnts = np.zeros((N,len(grid)))
-    pars = np.zeros((N,5))
-    
-    for i,entries in enumerate(zip(*grid)):
-        markers[i] = encode(**{key:entry for key,entry in zip(names,entries)})
-        gridpnts[i]= entries
-        pars[i] = list(ext.data[i][-5:])
+    markers = encode(**dict(zip(names,grid)))
+    gridpnts = np.column_stack(grid)
+    pars = np.column_stack([ext.data.field(name) for name in columns[-5:]]).astype(float)
     ff.close()
     sa = np.argsort(markers)
     print 'read in gridfile',gridfile
     pars[:,-1] = np.log10(pars[:,-1])
     return markers[sa],grid_axes,gridpnts[sa],pars[sa]
 
+@memoized
+def _get_pix_grid(photbands,**kwargs):
+    """
+    Prepare a pixel grid of LD coefficients and central intensities.
+    
+    The axes are C{teff}, C{logg} and, if present and not constant in the grid,
+    C{ebv} and C{vrad}. For every passband, the grid holds the coefficients of
+    the fitted law followed by the logarithm of the central intensity.
+    
+    @param photbands: photometric passbands
+    @type photbands: tuple of str
+    @return: axis values, pixel grid, names of the axes, name of the LD law
+    @rtype: list of arrays, array, list of str, str
+    """
+    gridfile = get_file(**kwargs)
+    ff = pyfits.open(gridfile)
+    law = ff[0].header.get('LAW','claret')
+    grid_pars,data = None,[]
+    for photband in photbands:
+        ext = ff[photband]
+        columns = ext.columns.names
+        names = ['teff','logg']+[name for name in ['ebv','vrad'] if name in columns]
+        grid = np.array([ext.data.field(name) for name in names],float)
+        #-- make sure the rows of all passbands are in the same order
+        sa = np.lexsort(grid[::-1])
+        if grid_pars is None:
+            grid_pars = grid[:,sa]
+        elif grid_pars.shape!=grid.shape or np.any(grid_pars!=grid[:,sa]):
+            raise ValueError('Passbands in {0} are not defined on the same grid'.format(gridfile))
+        coeff_names = [name for name in columns if name[0].lower()=='a' and name[1:].isdigit()]
+        data += [ext.data.field(name)[sa] for name in coeff_names]
+        data.append(np.log10(ext.data.field('Imu1')[sa]))
+    ff.close()
+    #-- don't take axes into account if they have only one value
+    keep = np.array([np.any(column!=column[0]) for column in grid_pars])
+    names = [name for name,keep_ in zip(names,keep) if keep_]
+    axis_values,pixelgrid = interpol.create_pixeltypegrid(grid_pars[keep],np.array(data))
+    logger.info('Prepared LD pixel grid from {0} ({1})'.format(gridfile,', '.join(names)))
+    return axis_values,pixelgrid,names,law
+
 #}    
     
 
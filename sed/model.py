@@ -120,6 +120,11 @@ because it will remove the models without checking if there is another process
 using them. So if you have multiple scripts running that are using the same models,
 only clean the scratch disk after the last process is finished.
 
+Grids on the scratch disk are checked against the original files (and, on
+request, against their checksums) and reused by later calls to copy2scratch(),
+also by other jobs running on the same node. So if you fit many stars with the
+same grids, there is no need to clean the scratch disk in between.
+
 The gain in speed can be up to 70% in single sed fitting, and up to 40% in binary
 and multiple sed fitting.
 
@@ -310,7 +315,8 @@ from ivs import config
 from ivs.units import conversions
 from ivs.units import constants
 from ivs.aux import loggers
-from ivs.aux.decorators import memoized,clear_memoization
+from ivs.aux.decorators import memoized,clear_memoization,LRUCache
+from ivs.aux import decorators
 import itertools
 import functools
 from ivs.aux import numpy_ext
@@ -322,6 +328,10 @@ from ivs.catalogs import sesame
 import reddening
 import getpass
 import shutil
+import json
+import hashlib
+import fcntl
+import contextlib
 
 logger = logging.getLogger("SED.MODEL")
 logger.addHandler(loggers.NullHandler)
@@ -342,6 +352,15 @@ defaults_multiple = [defaults.copy(),defaults.copy()]
 #-- relative location of the grids
 basedir = 'sedtables/modelgrids/'
 scratchdir = None
+#-- number of integrated grids that are kept in memory simultaneously
+grid_cache_size = 4
+#-- E(B-V) nodes of the tabulated effective wavelengths (see L{_get_eff_wave_grid})
+eff_wave_ebvs = np.linspace(0,2,21)
+#-- open grid files and decoded model spectra (see L{set_spectrum_cache})
+_open_grids = LRUCache(maxsize=8,on_evict=lambda key,hdulist: hdulist.close())
+_model_spectra = LRUCache(maxmem=256*2**20)
+decorators.memory.setdefault(__name__,{}).update(_open_grids=_open_grids,
+                                                 _model_spectra=_model_spectra)
 
 #{ Interface to library
 
@@ -362,6 +381,36 @@ def set_defaults(*args,**kwargs):
             logger.info('Set %s to %s'%(key,kwargs[key]))        
                 
 
+def set_grid_cache(maxsize=None,maxmem=None):
+    """
+    Set the number of integrated grids that are kept in memory.
+    
+    The interpolation functions keep the most recently used grids in memory.
+    When more than C{maxsize} grids are loaded, or they take more than
+    C{maxmem} bytes, the least recently used grid is removed from memory.
+    
+    >>> set_grid_cache(maxsize=2)
+    
+    @param maxsize: maximum number of grids (None for no limit)
+    @type maxsize: int
+    @param maxmem: maximum memory used by the grids in bytes (None for no limit)
+    @type maxmem: int
+    """
+    global grid_cache_size
+    grid_cache_size = maxsize
+    for func in [_get_itable_markers,_get_pix_grid]:
+        func.cache.resize(maxsize=maxsize,maxmem=maxmem)
+
+def grid_cache_info():
+    """
+    Return statistics on the in-memory grid cache.
+    
+    @return: hits, misses, evictions and memory use per grid type
+    @rtype: dict
+    """
+    return dict(markers=_get_itable_markers.cache_info(),
+                pixgrid=_get_pix_grid.cache_info())
+
 def set_defaults_multiple(*args):
     """
     Set defaults for multiple stars
@@ -374,69 +423,195 @@ def set_defaults_multiple(*args):
                 defaults_multiple[i][key] = arg[key]
                 logger.info('Set %s to %s (star %d)'%(key,arg[key],i)) 
 
-def copy2scratch(**kwargs):
+def _file_checksum(filename,blocksize=2**20):
+    """
+    Compute the MD5 checksum of a file.
+    
+    @param filename: name of the file
+    @type filename: str
+    @return: hexadecimal checksum
+    @rtype: str
+    """
+    md5 = hashlib.md5()
+    with open(filename,'rb') as ff:
+        for block in iter(lambda: ff.read(blocksize),''):
+            md5.update(block)
+    return md5.hexdigest()
+
+@contextlib.contextmanager
+def _staging_lock(target):
+    """
+    Hold an exclusive lock on a staged file.
+    
+    The lock is taken on a separate C{.lock} file next to the staged file, so
+    that all processes on a node that share the scratch directory wait for
+    each other instead of copying the same grid simultaneously.
+    
+    The lock file is removed by L{unstage_file}; a process that was waiting
+    on a removed lock file takes the lock again on a new one.
+    """
+    while True:
+        lock = open(target+'.lock','a')
+        fcntl.flock(lock.fileno(),fcntl.LOCK_EX)
+        #-- make sure the lock file was not removed while we were waiting
+        try:
+            if os.fstat(lock.fileno()).st_ino==os.stat(target+'.lock').st_ino:
+                break
+        except OSError:
+            pass
+        lock.close()
+    try:
+        yield
+    finally:
+        fcntl.flock(lock.fileno(),fcntl.LOCK_UN)
+        lock.close()
+
+def _read_staging_manifest(target):
+    """
+    Read the manifest (source, size, modification time and checksum) of a
+    staged file, or return None if it does not exist or cannot be read.
+    """
+    try:
+        with open(target+'.md5','r') as ff:
+            return json.load(ff)
+    except (IOError,ValueError):
+        return None
+
+def stage_file(source,directory,verify=False):
+    """
+    Copy a file to a (scratch) directory, unless a valid copy is present.
+    
+    Every staged file has a manifest (C{<file>.md5}) with the size and
+    modification time of the source, and the MD5 checksum of the staged copy.
+    A staged copy is reused when the source did not change since it was staged;
+    with C{verify=True}, also the checksum of the staged copy is checked. The
+    copy is written under a temporary name and moved in place, while a lock on
+    the file is held: concurrent processes on the same node wait for the first
+    one to finish, and then reuse its copy.
+    
+    @param source: file to stage
+    @type source: str
+    @param directory: directory to stage the file in
+    @type directory: str
+    @param verify: recompute the checksum of an existing staged copy
+    @type verify: bool
+    @return: name of the staged file
+    @rtype: str
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            #-- another process could have created it in the mean time
+            if not os.path.isdir(directory):
+                raise
+    target = os.path.join(directory,os.path.basename(source))
+    stat = os.stat(source)
+    signature = dict(source=os.path.abspath(source),size=stat.st_size,mtime=stat.st_mtime)
+    with _staging_lock(target):
+        manifest = _read_staging_manifest(target)
+        if manifest is not None and os.path.isfile(target) and \
+           all([manifest.get(key)==signature[key] for key in signature]):
+            if not verify or _file_checksum(target)==manifest['md5']:
+                logger.info('Using existing grid: %s from scratch'%(os.path.basename(source)))
+                return target
+            logger.warning('Checksum of staged grid %s does not match, copying it again'%(target))
+        #-- copy under a temporary name, and compute the checksum on the fly
+        tmpname = '{0}.{1}'.format(target,os.getpid())
+        md5 = hashlib.md5()
+        with open(source,'rb') as fin:
+            with open(tmpname,'wb') as fout:
+                for block in iter(lambda: fin.read(2**20),''):
+                    md5.update(block)
+                    fout.write(block)
+        os.rename(tmpname,target)
+        signature['md5'] = md5.hexdigest()
+        with open(tmpname,'w') as ff:
+            json.dump(signature,ff)
+        os.rename(tmpname,target+'.md5')
+        logger.info('Copied grid: %s to scratch'%(source))
+    return target
+
+def unstage_file(target):
+    """
+    Remove a staged file, its manifest and its lock file.
+    
+    The lock file is removed last, while the lock is still held.
+    
+    @param target: name of the staged file
+    @type target: str
+    """
+    with _staging_lock(target):
+        for fname in [target,target+'.md5',target+'.lock']:
+            if os.path.isfile(fname):
+                os.remove(fname)
+        logger.info('Removed file: %s'%(target))
+
+def _scratch_defaults(kwargs,integrated,use_scratch=False):
+    """
+    Collect the grid files of the single and multiple grid defaults.
+    
+    Values in C{kwargs} (e.g. C{z='*'}) temporarily replace the defaults.
+    """
+    #-- we have defaults for the single and multiple grid
+    defaults_ = []
+    defaults_.append(defaults)
+    defaults_.extend(defaults_multiple)
+    fnames = []
+    for default in defaults_:
+        default_ = default.copy()
+        for key in kwargs:
+            if key in default_:
+                default_[key] = kwargs[key]
+                logger.debug('Using provided value for {0:s}={1:s} for the scratch disk'.format(key,str(kwargs[key])))
+        default_['use_scratch'] = use_scratch
+        for integrated_ in integrated:
+            fname = get_file(integrated=integrated_,**default_)
+            #-- we could have received a list (multiple files) or a string (single file)
+            if isinstance(fname,str):
+                fname = [fname]
+            fnames.extend([ifname for ifname in fname if not ifname in fnames])
+    return defaults_,fnames
+
+def copy2scratch(directory=None,verify=False,**kwargs):
     """
     Copy the grids to the scratch directory to speed up the fitting process.
-    Files are placed in the directory: /scratch/uname/ where uname is your username.
+    Files are placed in the directory: /scratch/uname/ where uname is your username,
+    unless you give another C{directory} (e.g. a directory shared by all your
+    jobs on a node).
     
     This function checks the grids that are set with the functions set_defaults()
     and set_defaults_multiple(). Every time a grid setting is changed, this
     function needs to be called again.
     
+    Grids that are already on the scratch disk are only copied again when the
+    original grid changed (see L{stage_file}), so the staged grids can be
+    reused by subsequent jobs. Concurrent jobs wait for each other, such that
+    a grid is copied only once per node.
+    
     Don`t forget to remove the files from the scratch directory after the fitting
     process is completed with clean_scratch()
     
     It is possible to give z='*' and Rv='*' as an option; when you do that, the grids
     with all z, Rv values are copied. Don't forget to add that option to clean_scratch too!
+    
+    @param directory: scratch directory
+    @type directory: str
+    @param verify: check the checksums of grids that are already staged
+    @type verify: bool
     """
     global scratchdir
-    uname = getpass.getuser()
-    if not os.path.isdir('/scratch/%s/'%(uname)):
-        os.makedirs('/scratch/%s/'%(uname))
-    scratchdir = '/scratch/%s/'%(uname)
-    
-    #-- we have defaults for the single and multiple grid
-    defaults_ = []
-    defaults_.append(defaults)
-    defaults_.extend(defaults_multiple)
+    if directory is None:
+        directory = '/scratch/%s/'%(getpass.getuser())
+    scratchdir = os.path.join(directory,'')
     
     #-- now run over the defaults for the single and multiple grid, and
     #   copy the necessary files to the scratch disk
+    defaults_,fnames = _scratch_defaults(kwargs,integrated=[False,True])
+    for ifname in fnames:
+        stage_file(ifname,scratchdir,verify=verify)
     for default in defaults_:
-        default['use_scratch'] = False
-        #-- set the z with the starred version '*' if asked for, but remember
-        #   the original value to reset it after the loop is done.
-        originalDefaults = {}
-        for key in kwargs:
-            if key in default:
-                originalDefaults[key] = default[key]
-                default[key] = kwargs[key]
-                logger.debug('Using provided value for {0:s}={1:s} when copying to scratch'.format(key,str(kwargs[key])))
-        #grid
-        fname = get_file(integrated=False,**default)
-        #-- we could have received a list (multiple files) or a string (single file)
-        if isinstance(fname,str):
-            fname = [fname]
-        for ifname in fname:
-            if not os.path.isfile(scratchdir + os.path.basename(ifname)):
-                shutil.copy(ifname,scratchdir)
-                logger.info('Copied grid: %s to scratch'%(ifname))
-            else:
-                logger.info('Using existing grid: %s from scratch'%(os.path.basename(ifname)))
-        #integrated grid
-        fname = get_file(integrated=True,**default)
-        if isinstance(fname,str):
-            fname = [fname]
-        for ifname in fname:
-            if not os.path.isfile(scratchdir + os.path.basename(ifname)):
-                shutil.copy(ifname,scratchdir)
-                logger.info('Copied grid: %s to scratch'%(ifname))
-            else:
-                logger.info('Using existing grid: %s from scratch'%(os.path.basename(ifname)))
         default['use_scratch'] = True
-        for key in kwargs:
-            if key in default:
-                default[key] = originalDefaults[key]
 
 def clean_scratch(**kwargs):
     """
@@ -444,45 +619,17 @@ def clean_scratch(**kwargs):
     function copy2scratch(). Be carefull with this function, as it doesn't check
     if the models are still in use. If you are running multiple scripts that
     use the same models, only clean the scratch disk after the last script is
-    finnished.
+    finnished. Since staged grids are reused by later calls to copy2scratch(),
+    it is often better not to clean the scratch disk at all.
     """
-    defaults_ = []
-    defaults_.append(defaults)
-    defaults_.extend(defaults_multiple)
-    
+    if scratchdir is None:
+        return None
+    defaults_,fnames = _scratch_defaults(kwargs,integrated=[False,True],use_scratch=True)
+    for ifname in fnames:
+        if os.path.isfile(ifname):
+            unstage_file(ifname)
     for default in defaults_:
-        if default['use_scratch']:
-            originalDefaults = {}
-            for key in kwargs:
-                if key in default:
-                    originalDefaults[key] = default[key]
-                    default[key] = kwargs[key]
-                    logger.debug('Using provided value for {0:s}={1:s} when deleting from scratch'.format(key,str(kwargs[key])))
-            
-            #if z is not None:
-                #previous_z = default['z']
-                #default['z']
-            fname = get_file(integrated=False,**default)
-            if isinstance(fname,str):
-                fname = [fname]
-            for ifname in fname:
-                if os.path.isfile(ifname):
-                    logger.info('Removed file: %s'%(ifname))
-                    os.remove(ifname)
-            
-            fname = get_file(integrated=True,**default)
-            if isinstance(fname,str):
-                fname = [fname]
-            for ifname in fname:
-                if os.path.isfile(ifname):
-                    logger.info('Removed file: %s'%(ifname))
-                    os.remove(ifname)    
-            default['use_scratch'] = False
-            for key in kwargs:
-                if key in default:
-                    default[key] = originalDefaults[key]
-            #if z is not None:
-                #default['z'] = previous_z
+        default['use_scratch'] = False
 
 def defaults2str():
     """
@@ -1018,14 +1165,11 @@ def get_table_single(teff=None,logg=None,ebv=None,rad=None,star=None,
     #-- get the FITS-file containing the tables
     gridfile = get_file(**kwargs)
     
-    #-- read the file:
-    ff = pyfits.open(gridfile)
     #-- a possible grid is the one where only selected stellar models are
     #   present. In that case, we there is no need for interpolation or
     #   other stuff.
     if star is not None:
-        wave = ff[star.upper()].data.field('wavelength')
-        flux = ff[star.upper()].data.field('flux')
+        wave,flux = _get_model_spectrum(gridfile,star.upper())
     else:
         teff = float(teff)
         logg = float(logg)
@@ -1033,9 +1177,7 @@ def get_table_single(teff=None,logg=None,ebv=None,rad=None,star=None,
         try:
             #-- extenstion name as in fits files prepared by Steven
             mod_name = "T%05d_logg%01.02f" %(teff,logg)
-            mod = ff[mod_name]
-            wave = mod.data.field('wavelength')
-            flux = mod.data.field('flux')
+            wave,flux = _get_model_spectrum(gridfile,mod_name)
             logger.debug('Model SED taken directly from file (%s)'%(os.path.basename(gridfile)))
         #-- if the teff/logg is not present, use the interpolation thing
         except KeyError:
@@ -1060,14 +1202,115 @@ def get_table_single(teff=None,logg=None,ebv=None,rad=None,star=None,
     if wave_units!='AA':
         wave = conversions.convert('AA',wave_units,wave,**kwargs)
     
-    ff.close()
-    
     if rad != None:
         flux = rad**2 * flux
     
     return wave,flux
 
 
+def _open_gridfile(gridfile):
+    """
+    Return an open FITS handle to a grid file.
+    
+    The most recently used grid files are kept open, so that consecutive
+    calls do not need to open and parse the file again. File handles are
+    never shared between processes.
+    
+    @param gridfile: name of the grid file
+    @type gridfile: str
+    @return: open FITS file
+    @rtype: HDUList
+    """
+    key = (os.getpid(),gridfile)
+    hdulist = _open_grids.get(key)
+    if hdulist is None:
+        hdulist = pyfits.open(gridfile)
+        _open_grids.put(key,hdulist)
+    return hdulist
+
+def _get_model_spectrum(gridfile,mod_name):
+    """
+    Retrieve one model spectrum from a grid file.
+    
+    Decoded spectra are kept in memory (up to a maximum amount, see
+    L{set_spectrum_cache}). The returned arrays are shared with the cache and
+    should not be changed in place.
+    
+    @param gridfile: name of the grid file
+    @type gridfile: str
+    @param mod_name: name of the extension (e.g. 'T10000_logg4.00')
+    @type mod_name: str
+    @return: wavelength, flux
+    @rtype: ndarray,ndarray
+    @raise KeyError: model is not present in the grid
+    """
+    key = (gridfile,mod_name)
+    spectrum = _model_spectra.get(key)
+    if spectrum is None:
+        mod = _open_gridfile(gridfile)[mod_name]
+        wave = np.array(mod.data.field('wavelength'),float)
+        flux = np.array(mod.data.field('flux'),float)
+        spectrum = wave,flux
+        _model_spectra.put(key,spectrum)
+    return spectrum
+
+def prefetch_tables(teffs,loggs,**kwargs):
+    """
+    Load many model spectra of a grid into one contiguous 2D array.
+    
+    All models need to be present in the grid (no interpolation is done).
+    If all models share the same wavelength grid, the fluxes are stacked
+    as they are, otherwise they are interpolated onto the wavelength grid of
+    the first model. Copies of the rows that did not need interpolation are
+    also put in the model spectrum cache, so subsequent calls to L{get_table}
+    for these models do not touch the file, and changing the returned array
+    does not affect the cache.
+    
+    >>> teffs,loggs = get_grid_dimensions()
+    >>> wave,fluxes = prefetch_tables(teffs[:10],loggs[:10])
+    
+    Extra kwargs specify the grid.
+    
+    @param teffs: effective temperatures
+    @type teffs: array
+    @param loggs: surface gravities
+    @type loggs: array
+    @return: wavelength (A), fluxes (erg/s/cm2/AA/sr) with one model per row
+    @rtype: ndarray,2D ndarray
+    """
+    gridfile = get_file(**kwargs)
+    ff = _open_gridfile(gridfile)
+    wave = None
+    for i,(teff,logg) in enumerate(zip(teffs,loggs)):
+        mod_name = "T%05d_logg%01.02f" %(teff,logg)
+        mod = ff[mod_name]
+        wave_ = mod.data.field('wavelength')
+        flux_ = mod.data.field('flux')
+        if wave is None:
+            wave = np.array(wave_,float)
+            cache_wave = wave.copy()
+            fluxes = np.zeros((len(teffs),len(wave)))
+        if len(wave_)==len(wave) and np.all(wave_==wave):
+            fluxes[i] = flux_
+            #-- a view on the row would keep the whole array alive
+            _model_spectra.put((gridfile,mod_name),(cache_wave,fluxes[i].copy()))
+        else:
+            fluxes[i] = np.interp(wave,wave_,flux_)
+    return wave,fluxes
+
+def set_spectrum_cache(maxfiles=8,maxmem=256*2**20):
+    """
+    Set the number of grid files kept open and the memory for model spectra.
+    
+    @param maxfiles: maximum number of open grid files
+    @type maxfiles: int
+    @param maxmem: maximum memory used by decoded model spectra (bytes)
+    @type maxmem: int
+    """
+    _open_grids.resize(maxsize=maxfiles)
+    _model_spectra.resize(maxmem=maxmem)
+
+
 def get_itable_single(teff=None,logg=None,ebv=0,z=0,rad=None,photbands=None,
                wave_units=None,flux_units='erg/s/cm2/AA/sr',**kwargs):
     """
@@ -1103,7 +1346,7 @@ def get_itable_single(teff=None,logg=None,ebv=0,z=0,rad=None,photbands=None,
     @param flux_units: units to convert the fluxes to (if not given, erg/s/cm2/AA/sr)
     @type flux_units: str
     @keyword clear_memory: flag to clear memory from previously loaded SED tables.
-    If you set it to False, you can easily get an overloaded memory!
+    The number of tables kept in memory is limited anyway (see L{set_grid_cache}).
     @type clear_memory: boolean
     @return: (wave,) flux, absolute luminosity
     @rtype: (ndarray,)ndarray,float
@@ -1117,7 +1360,7 @@ def get_itable_single(teff=None,logg=None,ebv=0,z=0,rad=None,photbands=None,
         raise ValueError('no photometric passbands given')
     ebvrange = kwargs.pop('ebvrange',(-np.inf,np.inf))
     zrange = kwargs.pop('zrange',(-np.inf,np.inf))
-    clear_memory = kwargs.pop('clear_memory',True)
+    clear_memory = kwargs.pop('clear_memory',False)
     #-- get the FITS-file containing the tables
     #c0 = time.time()
     #c1 = time.time() - c0
@@ -1262,8 +1505,7 @@ def get_itable_single(teff=None,logg=None,ebv=0,z=0,rad=None,photbands=None,
         flux = conversions.nconvert('erg/s/cm2/AA/sr',flux_units,flux,photband=photbands,**kwargs)
     
     if wave_units is not None:
-        model = get_table(teff=teff,logg=logg,ebv=ebv,**kwargs)
-        wave = filters.eff_wave(photbands,model=model)
+        wave = _get_eff_waves(photbands,teff,logg,ebv,**kwargs)
         if wave_units !='AA':
             wave = wave = conversions.convert('AA',wave_units,wave,**kwargs)
     
@@ -1430,6 +1672,11 @@ def get_itable_single_pix(teff=None,logg=None,ebv=None,z=0,rv=3.1,vrad=0,photban
     ...     p = pl.xlabel(names[i])
     
     
+    If C{derivatives=True}, also the partial derivatives of the fluxes with
+    respect to the parameters that are interpolated over (and to C{rad}, if
+    given) are returned, as a dictionary with the parameter names as keys.
+    Derivatives are only available for the default flux units.
+    
     Thanks to Steven Bloemen for the core implementation of the interpolation
     algorithm.
     """
@@ -1448,6 +1695,9 @@ def get_itable_single_pix(teff=None,logg=None,ebv=None,z=0,rv=3.1,vrad=0,photban
     vrad = 0
     N = 1
     clear_memory = kwargs.pop('clear_memory',False)
+    derivatives = kwargs.pop('derivatives',False)
+    if derivatives and flux_units!='erg/s/cm2/AA/sr':
+        raise ValueError,'Derivatives are only available in erg/s/cm2/AA/sr'
     for var in ['teff','logg','ebv','z','rv','vrad']:
         if not hasattr(locals()[var],'__iter__'):
             kwargs.setdefault(var+'range',(locals()[var],locals()[var]))
@@ -1462,23 +1712,38 @@ def get_itable_single_pix(teff=None,logg=None,ebv=None,z=0,rv=3.1,vrad=0,photban
     for i,col in enumerate(cols):
         values[i] = locals()[col]
     
-    pars = 10**interpol.interpolate(values,axis_values,pixelgrid)
+    if derivatives:
+        pars,dpars = interpol.interpolate(values,axis_values,pixelgrid,derivatives=True)
+        pars = 10**pars
+    else:
+        pars = 10**interpol.interpolate(values,axis_values,pixelgrid)
     
     flux,Labs = pars[:-1],pars[-1]
     
+    #-- the grid is logarithmic in flux: d(10**f)/dx = ln(10) 10**f df/dx
+    if derivatives:
+        dflux = dict([(col,np.log(10)*flux*dpars[i][:-1]) for i,col in enumerate(cols)])
+    
     #-- Take radius into account when provided
     if 'rad' in kwargs:
         flux,Labs = flux*kwargs['rad']**2, Labs*kwargs['rad']**2
+        if derivatives:
+            for col in dflux:
+                dflux[col] = dflux[col]*kwargs['rad']**2
+            dflux['rad'] = 2*flux/kwargs['rad']
     
     #-- change flux and wavelength units if needed
     if flux_units!='erg/s/cm2/AA/sr':
         flux = conversions.nconvert('erg/s/cm2/AA/sr',flux_units,flux,photband=photbands,**kwargs)
     if wave_units is not None:
-        model = get_table(teff=teff,logg=logg,ebv=ebv,**kwargs)
-        wave = filters.eff_wave(photbands,model=model)
+        wave = _get_eff_waves(photbands,teff,logg,ebv,**kwargs)
         if wave_units !='AA':
             wave = wave = conversions.convert('AA',wave_units,wave,**kwargs)
+        if derivatives:
+            return wave,flux,Labs,dflux
         return wave,flux,Labs
+    elif derivatives:
+        return flux,Labs,dflux
     else:
         return flux,Labs
     
@@ -1486,6 +1751,14 @@ def get_itable_pix(photbands=None, wave_units=None, flux_units='erg/s/cm2/AA/sr'
                 grids=None, **kwargs):
     """
     Super fast grid interpolator for multiple tables, completely based on get_itable_pix.
+    
+    All components are interpolated in one pass per pixel grid (see
+    L{_get_itable_pix_components}), so that a binary costs about as much as
+    two single stars. Flux units are converted with one factor per passband.
+    
+    With C{derivatives=True}, the partial derivatives of the summed fluxes are
+    returned as well (see L{get_itable_single_pix}), with the component number
+    appended to the parameter names where the components differ.
     """
     
     #-- Find the parameters provided and store them separately.
@@ -1503,37 +1776,173 @@ def get_itable_pix(photbands=None, wave_units=None, flux_units='erg/s/cm2/AA/sr'
         return get_itable_single_pix(photbands=photbands,wave_units=wave_units,
                                      flux_units=flux_units,**kwargs)
     
-    #-- run over all fluxes and sum them, we do not need to multiply with the radius
-    #   as the radius is provided as an argument to itable_single_pix.
-    fluxes, Labs = [],[]                                
-    for i, (comp, grid) in enumerate(zip(components,defaults_multiple)):
-        trash = grid.pop('z',0.0), grid.pop('Rv',0.0)
-        kwargs_ = kwargs
-        kwargs_.update(grid)
+    #-- collect the parameters and grid settings of every component, without
+    #   changing the default grid settings
+    derivatives = kwargs.pop('derivatives',False)
+    clear_memory = kwargs.pop('clear_memory',False)
+    if derivatives and flux_units!='erg/s/cm2/AA/sr':
+        raise ValueError,'Derivatives are only available in erg/s/cm2/AA/sr'
+    if grids is None:
+        grids = defaults_multiple
+    comp_kwargs = []
+    for comp, grid in zip(sorted(components),grids):
+        kwargs_ = kwargs.copy()
+        kwargs_.update([(key,grid[key]) for key in grid if not key in ['z','Rv']])
         for par in parameters:
             kwargs_[par] = values[par+comp] if par+comp in values else values[par]
-        
-        f,L = get_itable_single_pix(photbands=photbands,wave_units=None,**kwargs_)
-                                     
-        fluxes.append(f)
-        Labs.append(L)
-    
-    fluxes = np.sum(fluxes,axis=0)
-    Labs = np.sum(Labs,axis=0)
+        comp_kwargs.append(kwargs_)
+    
+    #-- interpolate all components and sum them, the radius is taken into
+    #   account in the interpolation engine
+    output = _get_itable_pix_components(photbands,comp_kwargs,derivatives=derivatives,
+                                        clear_memory=clear_memory,
+                                        keep_components=wave_units is not None)
+    fluxes,Labs,dflux = output[:3]
+    
+    #-- parameters shared by the components collect all derivatives
+    if derivatives:
+        dfluxes = {}
+        for comp,df in zip(sorted(components),dflux):
+            for par in df:
+                name = par+comp if par+comp in values else par
+                dfluxes[name] = dfluxes[name]+df[par] if name in dfluxes else df[par]
     
     if flux_units!='erg/s/cm2/AA/sr':
-        fluxes = np.array([conversions.convert('erg/s/cm2/AA/sr',flux_units,fluxes[i],photband=photbands[i]) for i in range(len(fluxes))])
+        factors = _get_flux_unit_factors(tuple(photbands),flux_units)
+        if factors is not None:
+            fluxes *= factors.reshape((-1,)+(1,)*(fluxes.ndim-1))
+        else:
+            fluxes = np.array([conversions.convert('erg/s/cm2/AA/sr',flux_units,fluxes[i],photband=photbands[i]) for i in range(len(fluxes))])
     
     if wave_units is not None:
-        model = get_table_multiple(teff=teff,logg=logg,ebv=ebv, grids=grids,**kwargs)
-        wave = filters.eff_wave(photbands,model=model)
+        #-- effective wavelengths of the combined model: the flux weighted
+        #   mean of those of the components
+        comp_fluxes = output[3]
+        wave = 0.
+        for kwargs_,comp_flux in zip(comp_kwargs,comp_fluxes):
+            grid = dict([(key,kwargs_[key]) for key in kwargs_ if not key in parameters])
+            eff_waves = _get_eff_waves(photbands,kwargs_['teff'],kwargs_['logg'],
+                                       kwargs_.get('ebv',None),**grid)
+            #-- scalar parameters give one wavelength per passband, but the
+            #   fluxes always have a column per point
+            wave = wave + comp_flux*np.reshape(eff_waves,comp_flux.shape)
+        wave = wave/np.sum(comp_fluxes,axis=0)
         if wave_units !='AA':
-            wave = wave = conversions.convert('AA',wave_units,wave)
+            wave = conversions.convert('AA',wave_units,wave)
+        if derivatives:
+            return wave,fluxes,Labs,dfluxes
         return wave,fluxes,Labs
     
+    if derivatives:
+        return fluxes,Labs,dfluxes
     return fluxes,Labs   
 
 
+def _get_itable_pix_components(photbands,components,derivatives=False,
+                               clear_memory=False,keep_components=False):
+    """
+    Interpolate the fluxes of several components in their pixel grids and sum them.
+    
+    Components are grouped per pixel grid: components that are interpolated
+    in the same grid (same grid settings and the same fixed parameters) are
+    stacked and interpolated in one pass. The fluxes are scaled with the
+    radius (C{rad}, if given) and summed in place.
+    
+    @param photbands: list of photometric passbands
+    @type photbands: list of str
+    @param components: parameters (teff, logg, ebv, z, rv, rad) and grid
+    settings of every component
+    @type components: list of dict
+    @param derivatives: compute the partial derivatives of the fluxes
+    @type derivatives: bool
+    @param keep_components: also return the fluxes of the individual components
+    @type keep_components: bool
+    @return: summed fluxes (Nbands x N), summed Labs (N), derivatives of every
+    component (list of dict, None if not computed)[, fluxes per component]
+    @rtype: array, array, list[, list]
+    """
+    #-- group the components per pixel grid, and set fixed parameters the way
+    #   L{get_itable_single_pix} does
+    groups = []
+    N = 1
+    for i,kwargs in enumerate(components):
+        kwargs = kwargs.copy()
+        pars = dict(teff=kwargs.pop('teff',None),logg=kwargs.pop('logg',None),
+                    ebv=kwargs.pop('ebv',None),z=kwargs.pop('z',0),
+                    rv=kwargs.pop('rv',3.1),vrad=0)
+        kwargs.pop('vrad',None)
+        if pars['ebv'] is None:
+            pars['ebv'] = np.zeros_like(pars['teff'])
+        rad = kwargs.pop('rad',None)
+        for var in ['teff','logg','ebv','z','rv','vrad']:
+            if not hasattr(pars[var],'__iter__'):
+                kwargs.setdefault(var+'range',(pars[var],pars[var]))
+            else:
+                N = len(pars[var])
+        for group_kwargs,members in groups:
+            if group_kwargs==kwargs:
+                members.append((i,pars,rad))
+                break
+        else:
+            groups.append((kwargs,[(i,pars,rad)]))
+    
+    fluxes,Labs = None,None
+    dfluxes = [None]*len(components)
+    comp_fluxes = [None]*len(components)
+    for kwargs,members in groups:
+        axis_values,gridpnts,pixelgrid,cols = _get_pix_grid(photbands,
+                            include_Labs=True,clear_memory=clear_memory,**kwargs)
+        clear_memory = False
+        #-- stack the components: each one takes N consecutive points
+        values = np.zeros((len(cols),N*len(members)))
+        for j,(i,pars,rad) in enumerate(members):
+            for k,col in enumerate(cols):
+                values[k,j*N:(j+1)*N] = pars[col]
+        if derivatives:
+            pars_,dpars = interpol.interpolate(values,axis_values,pixelgrid,derivatives=True)
+        else:
+            pars_ = interpol.interpolate(values,axis_values,pixelgrid)
+        pars_ = 10**pars_
+        
+        for j,(i,pars,rad) in enumerate(members):
+            section = slice(j*N,(j+1)*N)
+            flux,L = pars_[:-1,section],pars_[-1,section]
+            if rad is not None:
+                flux,L = flux*rad**2,L*rad**2
+            #-- the grid is logarithmic in flux: d(10**f)/dx = ln(10) 10**f df/dx
+            if derivatives:
+                dfluxes[i] = dict([(col,np.log(10)*flux*dpars[k][:-1,section]) for k,col in enumerate(cols)])
+                if rad is not None:
+                    dfluxes[i]['rad'] = 2*flux/rad
+            if keep_components:
+                comp_fluxes[i] = flux
+            if fluxes is None:
+                fluxes,Labs = flux.copy(),L.copy()
+            else:
+                fluxes += flux
+                Labs += L
+    
+    if keep_components:
+        return fluxes,Labs,dfluxes,comp_fluxes
+    return fluxes,Labs,dfluxes
+
+
+@memoized
+def _get_flux_unit_factors(photbands,flux_units):
+    """
+    Conversion factors from erg/s/cm2/AA/sr to other flux units, per passband.
+    
+    @return: factor per passband, or None if the conversion is not a simple
+    scaling (e.g. magnitudes)
+    @rtype: array
+    """
+    factors = np.array([conversions.convert('erg/s/cm2/AA/sr',flux_units,1.,photband=photband) for photband in photbands])
+    doubles = np.array([conversions.convert('erg/s/cm2/AA/sr',flux_units,2.,photband=photband) for photband in photbands])
+    if np.allclose(doubles,2*factors):
+        return factors
+    return None
+
+
 #def get_table_multiple(teff=None,logg=None,ebv=None,radius=None,
               #wave_units='AA',flux_units='erg/cm2/s/AA/sr',grids=None,full_output=False,**kwargs):
 def get_table(wave_units='AA',flux_units='erg/cm2/s/AA/sr',grids=None,full_output=False,**kwargs):
@@ -2117,10 +2526,16 @@ def synthetic_flux(wave,flux,photbands,units=None):
     
     See e.g. Maiz-Apellaniz, 2006.
     
+    You can also integrate many spectra on the same wavelength grid at once,
+    by giving a 2D array of fluxes (one spectrum per row, e.g. the output of
+    L{reddening.redden_multi}). The output then has one row per spectrum and
+    one column per passband. The response curves are then only interpolated
+    once for the whole stack of spectra.
+    
     @param wave: model wavelengths (angstrom)
     @type wave: ndarray
     @param flux: model fluxes (erg/s/cm2/AA)
-    @type flux: ndarray
+    @type flux: ndarray (1D, or 2D with shape (Nspectra,len(wave)))
     @param photbands: list of photometric passbands
     @type photbands: list of str
     @param units: list containing Flambda or Fnu flag (defaults to all Flambda)
@@ -2130,7 +2545,35 @@ def synthetic_flux(wave,flux,photbands,units=None):
     """    
     if isinstance(units,str):
         units = [units]*len(photbands)
-    energys = np.zeros(len(photbands))
+    flux = np.asarray(flux)
+    if flux.ndim==1:
+        return _synthetic_flux_multi(wave,flux.reshape(1,-1),photbands,units=units)[0]
+    return _synthetic_flux_multi(wave,flux,photbands,units=units)
+
+
+def _synthetic_flux_multi(wave,flux,photbands,units=None,max_points=2**22):
+    """
+    Compute synthetic fluxes for a stack of spectra on the same wavelength grid.
+    
+    This is the engine of L{synthetic_flux}: the response curves are prepared
+    once per passband, and all rows of C{flux} are integrated at once. In the
+    infrared, where the spectra are interpolated onto a dense grid, the rows
+    are processed in blocks of at most C{max_points} interpolated fluxes.
+    
+    @param wave: model wavelengths (angstrom)
+    @type wave: ndarray
+    @param flux: model fluxes (erg/s/cm2/AA), one spectrum per row
+    @type flux: 2D ndarray
+    @param photbands: list of photometric passbands
+    @type photbands: list of str
+    @param units: list containing Flambda or Fnu flag (defaults to all Flambda)
+    @type units: list of strings
+    @param max_points: maximum number of interpolated fluxes held in memory
+    @type max_points: int
+    @return: model fluxes, shape (Nspectra,len(photbands))
+    @rtype: 2D ndarray
+    """
+    energys = np.zeros((flux.shape[0],len(photbands)))
     
     #-- only keep relevant information on filters:
     filter_info = filters.get_info()
@@ -2138,7 +2581,6 @@ def synthetic_flux(wave,flux,photbands,units=None):
     filter_info = filter_info[keep]
     
     for i,photband in enumerate(photbands):
-        #if filters.is_color
         waver,transr = filters.get_response(photband)
         #-- make wavelength range a bit bigger, otherwise F25 from IRAS has only
         #   one Kurucz model point in its wavelength range... this is a bit
@@ -2146,52 +2588,68 @@ def synthetic_flux(wave,flux,photbands,units=None):
         region = ((waver[0]-0.4*waver[0])<=wave) & (wave<=(2*waver[-1]))
         #-- if we're working in infrared (>4e4A) and the model is not of high
         #   enough resolution (100000 points over wavelength range), interpolate
-        #   the model in logscale on to a denser grid (in logscale!)
-        if filter_info['eff_wave'][i]>=4e4 and sum(region)<1e5 and sum(region)>1:
+        #   the model in logscale on to a denser grid (in logscale!), block
+        #   per block of spectra
+        dense = filter_info['eff_wave'][i]>=4e4 and sum(region)<1e5 and sum(region)>1
+        if dense:
             logger.debug('%10s: Interpolating model to integrate over response curve'%(photband))
-            wave_ = np.logspace(np.log10(wave[region][0]),np.log10(wave[region][-1]),1e5)
-            flux_ = 10**np.interp(np.log10(wave_),np.log10(wave[region]),np.log10(flux[region]),)
+            wave_ = np.logspace(np.log10(wave[region][0]),np.log10(wave[region][-1]),int(1e5))
+            nrows = max(1,int(max_points//len(wave_)))
         else:
             wave_ = wave[region]
-            flux_ = flux[region]
+            nrows = len(flux)
         if not len(wave_):
-            energys[i] = np.nan
+            energys[:,i] = np.nan
             continue
         #-- perhaps the entire response curve falls in between model points (happends with
         #   narrowband UV filters), or there's very few model points covering it
+        wave_model = wave_
         if (np.searchsorted(wave_,waver[-1])-np.searchsorted(wave_,waver[0]))<5:
-            wave__ = np.sort(np.hstack([wave_,waver]))
-            flux_ = np.interp(wave__,wave_,flux_)
-            wave_ = wave__
+            wave_ = np.sort(np.hstack([wave_,waver]))
         #-- interpolate response curve onto model grid
         transr = np.interp(wave_,waver,transr,left=0,right=0)
         
         #-- integrated flux: different for bolometers and CCDs
-        #-- WE WORK IN FLAMBDA
         if units is None or ((units is not None) and (units[i].upper()=='FLAMBDA')):
-            if photband=='OPEN.BOL':
-                energys[i] = np.trapz(flux_,x=wave_)
-            elif filter_info['type'][i]=='BOL':
-                energys[i] = np.trapz(flux_*transr,x=wave_)/np.trapz(transr,x=wave_)
-            elif filter_info['type'][i]=='CCD':
-                energys[i] = np.trapz(flux_*transr*wave_,x=wave_)/np.trapz(transr*wave_,x=wave_)
-        
-        #-- we work in FNU
+            fnu = False
         elif units[i].upper()=='FNU':
-            #-- convert wavelengths to frequency, Flambda to Fnu
+            fnu = True
+            #-- convert wavelengths to frequency; Flambda to Fnu is a
+            #   multiplication with lambda**2/c, the same for every row
             freq_ = conversions.convert('AA','Hz',wave_)
-            flux_f = conversions.convert('erg/s/cm2/AA','erg/s/cm2/Hz',flux_,wave=(wave_,'AA'))
+            to_fnu = conversions.convert('erg/s/cm2/AA','erg/s/cm2/Hz',np.ones_like(wave_),wave=(wave_,'AA'))
             #-- sort again!
             sa = np.argsort(freq_)
             transr = transr[sa]
             freq_ = freq_[sa]
-            flux_f = flux_f[sa]
-            if filter_info['type'][i]=='BOL':
-                energys[i] = np.trapz(flux_f*transr,x=freq_)/np.trapz(transr,x=freq_)
-            elif filter_info['type'][i]=='CCD':
-                energys[i] = np.trapz(flux_f*transr/freq_,x=wave_)/np.trapz(transr/freq_,x=wave_)
+            to_fnu = to_fnu[sa]
         else:
             raise ValueError,'units %s not understood'%(units)
+        
+        for start in xrange(0,len(flux),nrows):
+            rows = slice(start,start+nrows)
+            if dense:
+                flux_ = 10**numpy_ext.interp_rows(np.log10(wave_model),np.log10(wave[region]),np.log10(flux[rows][:,region]))
+            else:
+                flux_ = flux[rows][:,region]
+            if len(wave_)>len(wave_model):
+                flux_ = numpy_ext.interp_rows(wave_,wave_model,flux_)
+            
+            #-- WE WORK IN FLAMBDA
+            if not fnu:
+                if photband=='OPEN.BOL':
+                    energys[rows,i] = np.trapz(flux_,x=wave_,axis=1)
+                elif filter_info['type'][i]=='BOL':
+                    energys[rows,i] = np.trapz(flux_*transr,x=wave_,axis=1)/np.trapz(transr,x=wave_)
+                elif filter_info['type'][i]=='CCD':
+                    energys[rows,i] = np.trapz(flux_*(transr*wave_),x=wave_,axis=1)/np.trapz(transr*wave_,x=wave_)
+            #-- we work in FNU
+            else:
+                flux_f = flux_[:,sa]*to_fnu
+                if filter_info['type'][i]=='BOL':
+                    energys[rows,i] = np.trapz(flux_f*transr,x=freq_,axis=1)/np.trapz(transr,x=freq_)
+                elif filter_info['type'][i]=='CCD':
+                    energys[rows,i] = np.trapz(flux_f*(transr/freq_),x=wave_,axis=1)/np.trapz(transr/freq_,x=wave_)
     
     #-- that's it!
     return energys
@@ -2257,46 +2715,46 @@ def luminosity(wave,flux,radius=1.):
 
 #}
 
-@memoized
+@memoized(maxsize=grid_cache_size)
 def _get_itable_markers(photbands,
                     teffrange=(-np.inf,np.inf),loggrange=(-np.inf,np.inf),
                     ebvrange=(-np.inf,np.inf),zrange=(-np.inf,np.inf),
                     include_Labs=True,clear_memory=True,**kwargs):
     """
     Get a list of markers to more easily retrieve integrated fluxes.
+    
+    At most C{grid_cache_size} sets of markers are kept in memory (see
+    L{set_grid_cache}). If C{clear_memory} is True, all previously loaded sets
+    are discarded.
     """
     if clear_memory:
-        clear_memoization(keys=['ivs.sed.model'])
+        _get_itable_markers.cache.clear()
     gridfiles = get_file(z='*',integrated=True,**kwargs)
     if isinstance(gridfiles,str):
         gridfiles = [gridfiles]
     #-- sort gridfiles per metallicity
-    metals_sa = np.argsort([pyfits.getheader(ff,1)['z'] for ff in gridfiles])
+    grid_zs = [pyfits.getheader(ff,1)['z'] for ff in gridfiles]
+    metals_sa = np.argsort(grid_zs)
     gridfiles = np.array(gridfiles)[metals_sa]
+    grid_zs = np.array(grid_zs)[metals_sa]
     flux = []
     gridpnts = []
     grid_z = []
     markers = []
     
     #-- collect information
-    for gridfile in gridfiles:
-        ff = pyfits.open(gridfile)
-        ext = ff[1]
-        z = ff[1].header['z']
+    for gridfile,z in zip(gridfiles,grid_zs):
         if z<zrange[0] or zrange[1]<z:
             continue
-    
-        teffs = ext.data.field('teff')
-        loggs = ext.data.field('logg')
-        ebvs = ext.data.field('ebv')
-        keep = (ebvrange[0]<=ebvs) & (ebvs<=ebvrange[1])
+        
+        header,(teffs,loggs,ebvs),partial_flux = _read_grid_rows(gridfile,photbands,
+                        ['teff','logg','ebv'],dict(ebv=ebvrange),include_Labs=include_Labs)
         
         #-- for some reason, the Kurucz grid has a lonely point at Teff=14000,logg=2
         #   which messes up our interpolation
         #correct = (teffs==14000) & (loggs==2.0)
         #teffs[correct] = 12000
         
-        teffs,loggs,ebvs = teffs[keep],loggs[keep],ebvs[keep]
         grid_teffs = np.sort(list(set(teffs)))
         grid_loggs = np.sort(list(set(loggs)))
         grid_ebvs = np.sort(list(set(ebvs)))
@@ -2312,8 +2770,7 @@ def _get_itable_markers(photbands,
         for i,(it,il,ie) in enumerate(zip(teffs,loggs,ebvs)):
             markers[-1][i] = float('%3d%05d%03d%03d'%(int(round((z+5)*100)),int(round(it)),int(round(il*100)),int(round(ie*100))))
 	    gridpnts[-1][i]= it,il,ie,z
-        flux.append(_get_flux_from_table(ext,photbands,include_Labs=include_Labs))
-        ff.close()
+        flux.append(partial_flux)
     
     flux = np.vstack(flux)
     markers = np.hstack(markers)
@@ -2323,7 +2780,7 @@ def _get_itable_markers(photbands,
     return np.array(markers),(grid_teffs,grid_loggs,grid_ebvs,grid_z),gridpnts,flux
 
 
-@memoized
+@memoized(maxsize=grid_cache_size)
 def _get_pix_grid(photbands,
                     teffrange=(-np.inf,np.inf),loggrange=(-np.inf,np.inf),
                     ebvrange=(-np.inf,np.inf),zrange=(-np.inf,np.inf),
@@ -2337,9 +2794,14 @@ def _get_pix_grid(photbands,
     here. I'm thinking about:
     
         teff, logg, ebv, z, Rv, vrad.
+    
+    At most C{grid_cache_size} pixel grids are kept in memory (see
+    L{set_grid_cache}), so that e.g. the grids of both components of a binary
+    stay loaded. If C{clear_memory} is True, all previously loaded pixel grids
+    are discarded.
     """
     if clear_memory:
-        clear_memoization(keys=['ivs.sed.model'])
+        _get_pix_grid.cache.clear()
         
     #-- remove Rv and z from the grid keywords
     trash = kwargs.pop('Rv', 0.0)
@@ -2350,38 +2812,16 @@ def _get_pix_grid(photbands,
     flux = []
     grid_pars = []
     grid_names = np.array(variables)
-    #-- collect information from all the grid files
+    #-- collect information from all the grid files. We already cut the grid
+    #   here, in order not to take too much memory
+    ranges = dict([(name,locals()[name+'range']) for name in variables])
     for gridfile in gridfiles:
-        with pyfits.open(gridfile) as ff:
-            # Fix duplicate column names
-            had_columns = []
-            for key in ff[1].header.keys():
-                if key[:5]=='TTYPE' and not ff[1].header[key] in had_columns:
-                    had_columns.append(ff[1].header[key])
-                elif key[:5]=='TTYPE':
-                    ff[1].header[key] += '-1'
-            #-- make an alias for further reference
-            ext = ff[1]
-            #-- we already cut the grid here, in order not to take too much memory
-            keep = np.ones(len(ext.data),bool)
-            for name in variables:
-                #-- we need to be carefull for rounding errors
-                low,high = locals()[name+'range']
-                in_range = (low<=ext.data.field(name)) & (ext.data.field(name)<=high)
-                on_edge  = np.allclose(ext.data.field(name),low) | np.allclose(ext.data.field(name),high)
-                #on_edge_low = np.less_equal(np.abs(ext.data.field(name)-low),1e-8 + 1e-5*np.abs(low))
-                #on_edge_high = np.less_equal(np.abs(ext.data.field(name)-high),1e-8 + 1e-5*np.abs(high))
-                #keep_this = (in_range | on_edge_low | on_edge_high)
-                #if not sum(keep_this):
-                    #logger.warning("_get_pix_grid: No selection done in axis {}".format(name))
-                    #continue
-                #keep = keep & keep_this
-                keep = keep & (in_range | on_edge)
-            partial_grid = np.vstack([ext.data.field(name)[keep] for name in variables])
-            if sum(keep):
-                grid_pars.append(partial_grid)
-                #-- the flux grid:
-                flux.append(_get_flux_from_table(ext,photbands,include_Labs=include_Labs)[keep])
+        header,partial_grid,partial_flux = _read_grid_rows(gridfile,photbands,
+                                     variables,ranges,include_Labs=include_Labs)
+        if partial_grid.shape[1]:
+            grid_pars.append(partial_grid)
+            #-- the flux grid:
+            flux.append(partial_flux)
     #-- make the entire grid: it consists of fluxes and grid parameters
     flux = np.vstack(flux)
     grid_pars = np.hstack(grid_pars)
@@ -2405,6 +2845,113 @@ def _get_pix_grid(photbands,
     return axis_values,grid_pars.T,pixelgrid,grid_names
 
 
+@memoized(maxsize=grid_cache_size)
+def _get_eff_wave_grid(photbands,**kwargs):
+    """
+    Tabulate the effective wavelengths of passbands for all models in a grid.
+    
+    The effective wavelengths are computed in one go for all model atmospheres
+    of the grid (see L{get_grid_mesh}), reddened with each of the E(B-V) values
+    in C{eff_wave_ebvs}. The table is returned as an interpolating function in
+    (log Teff, logg), giving for every point the effective wavelengths at all
+    E(B-V) nodes.
+    
+    @return: interpolating function, returning (len(eff_wave_ebvs) x
+    len(photbands)) values per point
+    @rtype: LinearNDInterpolator
+    """
+    wave,teffs,loggs,flux,flux_grid = get_grid_mesh(**kwargs)
+    reddened = reddening.redden_multi(np.ones_like(wave),wave=wave,ebvs=eff_wave_ebvs,
+                                      rtype='flux',**kwargs)
+    table = np.array([filters.eff_wave(photbands,model=(wave,flux*red)) for red in reddened])
+    table = table.transpose(1,0,2).reshape(len(teffs),-1)
+    logger.info('Tabulated effective wavelengths of {0} passbands for {1} models'.format(len(photbands),len(teffs)))
+    return LinearNDInterpolator(np.array([np.log10(teffs),loggs]).T,table)
+
+def _get_eff_waves(photbands,teff,logg,ebv,**kwargs):
+    """
+    Compute the effective wavelengths of passbands taking the model into account.
+    
+    The values are interpolated in the table of L{_get_eff_wave_grid}, so that
+    no model atmosphere needs to be loaded. Points outside the table (in Teff,
+    logg or E(B-V), or if the tabulation is not available) are computed from
+    the model atmosphere directly.
+    
+    @return: effective wavelengths (len(photbands), or len(photbands) x N for
+    arrays of parameters)
+    @rtype: array
+    """
+    kwargs = dict([(key,kwargs[key]) for key in kwargs if not (key.endswith('range') or key=='rad')])
+    scalar = not hasattr(teff,'__iter__')
+    teff,logg,ebv = np.broadcast_arrays(np.atleast_1d(teff),np.atleast_1d(logg),
+                                        np.atleast_1d(0. if ebv is None else ebv))
+    photbands = tuple(photbands)
+    wave = np.nan*np.ones((len(teff),len(photbands)))
+    if new_scipy:
+        table = _get_eff_wave_grid(photbands,**kwargs)
+        table = table(np.log10(teff),logg).reshape(len(teff),len(eff_wave_ebvs),len(photbands))
+        #-- linear interpolation in E(B-V); values outside the tabulated range
+        #   are not extrapolated, but computed from the model atmospheres
+        ebv_ = np.clip(ebv,eff_wave_ebvs[0],eff_wave_ebvs[-1])
+        right = np.clip(eff_wave_ebvs.searchsorted(ebv_),1,len(eff_wave_ebvs)-1)
+        weight = ((ebv_-eff_wave_ebvs[right-1])/(eff_wave_ebvs[right]-eff_wave_ebvs[right-1]))[:,None]
+        index = np.arange(len(teff))
+        wave = table[index,right-1]*(1-weight) + table[index,right]*weight
+        wave[ebv_!=ebv] = np.nan
+    #-- fall back to the model atmospheres themselves
+    for i in np.arange(len(teff))[np.isnan(wave).any(axis=1)]:
+        model = get_table(teff=teff[i],logg=logg[i],ebv=ebv[i],**kwargs)
+        wave[i] = filters.eff_wave(photbands,model=model)
+    if scalar:
+        return wave[0]
+    return wave.T
+
+
+def _read_grid_rows(gridfile,photbands,variables,ranges,include_Labs=True):
+    """
+    Read the axes and integrated fluxes of the rows of a grid within ranges.
+    
+    The table is memory mapped, and only the columns of the axes, of the
+    passbands (and C{Labs}) are decoded, for the selected rows only. Thus,
+    memory and time scale with the passbands that are used, not with the
+    number of passbands in the grid.
+    
+    @param gridfile: integrated grid file
+    @type gridfile: str
+    @param photbands: list of photometric passbands
+    @type photbands: list of str
+    @param variables: names of the axis columns
+    @type variables: list of str
+    @param ranges: (low,high) per axis, rows outside are skipped
+    @type ranges: dict
+    @return: header, axes (Nvariables x Nrows), fluxes (Nrows x Nbands(+1))
+    @rtype: Header, array, array
+    """
+    with pyfits.open(gridfile,memmap=True) as ff:
+        # Fix duplicate column names
+        had_columns = []
+        for key in ff[1].header.keys():
+            if key[:5]=='TTYPE' and not ff[1].header[key] in had_columns:
+                had_columns.append(ff[1].header[key])
+            elif key[:5]=='TTYPE':
+                ff[1].header[key] += '-1'
+        #-- make an alias for further reference
+        ext = ff[1]
+        keep = np.ones(ext.header['NAXIS2'],bool)
+        for name in variables:
+            #-- we need to be carefull for rounding errors
+            low,high = ranges.get(name,(-np.inf,np.inf))
+            if low==-np.inf and high==np.inf:
+                continue
+            values = ext.data.field(name)
+            in_range = (low<=values) & (values<=high)
+            on_edge  = np.allclose(values,low) | np.allclose(values,high)
+            keep = keep & (in_range | on_edge)
+        index = np.arange(len(keep))[keep]
+        grid_pars = np.array([ext.data.field(name)[index] for name in variables],float)
+        flux = _get_flux_from_table(ext,photbands,index=index,include_Labs=include_Labs)
+        header = ext.header.copy()
+    return header,grid_pars,flux
 
 
 def _get_flux_from_table(fits_ext,photbands,index=None,include_Labs=True):
@@ -2444,7 +2991,7 @@ def _get_flux_from_table(fits_ext,photbands,index=None,include_Labs=True):
                     fluxes.append(fu*fb/fv**2)
         except KeyError:
             logger.warning('Passband %s missing from table'%(photband))
-            fluxes.append(np.nan*np.ones(len(fits_ext.data)))
+            fluxes.append(np.nan*np.ones_like(np.arange(fits_ext.header['NAXIS2'])[index],float))
     #-- possibly include absolute luminosity
     if include_Labs:
         fluxes.append(fits_ext.data.field("Labs")[index])
@@ -95,7 +95,7 @@ import logging
 
 from ivs.io import ascii
 from ivs.aux import loggers
-from ivs.aux.decorators import memoized
+from ivs.aux.decorators import memoized,LRUCache
 from ivs.units import conversions
 import filters
 import model
@@ -153,8 +153,8 @@ def get_law(name,norm='E(B-V)',wave_units='AA',photbands=None,**kwargs):
     Rv = kwargs.setdefault('Rv',3.1)
     
     #-- get the curve
-    wave,mag = globals()[name.lower()](**kwargs)
-    wave_orig,mag_orig = wave.copy(),mag.copy()
+    table = get_law_table(name,**kwargs)
+    wave,mag = table['wave'],table['mag'].copy()
     
     #-- interpolate on user defined grid
     if wave_ is not None:
@@ -165,21 +165,21 @@ def get_law(name,norm='E(B-V)',wave_units='AA',photbands=None,**kwargs):
            
     #-- pick right normalisation: convert to A(lambda)/Av if needed
     if norm.lower()=='e(b-v)':
+        norm_reddening = 1./Rv
         mag *= Rv
     else:
-        #-- we allow ak and av as shortcuts for normalisation in JOHNSON K and
-        #   V bands
-        if norm.lower()=='ak':
-            norm = 'JOHNSON.K'
-        elif norm.lower()=='av':
-            norm = 'JOHNSON.V'
-        norm_reddening = model.synthetic_flux(wave_orig,mag_orig,[norm])[0]
+        norm = _norm_photband(norm)
+        norm_reddening = _get_band_values(table,[norm])[0]
         logger.info('Normalisation via %s: Av/%s = %.6g'%(norm,norm,1./norm_reddening))
         mag /= norm_reddening
     
-    #-- maybe we want the curve in photometric filters
+    #-- maybe we want the curve in photometric filters. On the standard grid
+    #   of the law, these are tabulated already
     if photbands is not None:
-        mag = model.synthetic_flux(wave,mag,photbands)
+        if wave_ is None:
+            mag = _get_band_values(table,photbands)/norm_reddening
+        else:
+            mag = model.synthetic_flux(wave,mag,photbands)
         wave = filters.get_info(photbands)['eff_wave']
     
     
@@ -235,6 +235,65 @@ def redden(flux,wave=None,photbands=None,ebv=0.,rtype='flux',law='cardelli1989',
         np.seterr(**old_settings)
         return magnitude_reddened
 
+def redden_multi(flux,wave=None,photbands=None,ebvs=None,rtype='flux',law='cardelli1989',**kwargs):
+    """
+    Redden flux or magnitudes for a whole array of E(B-V) values at once.
+    
+    This is the batched version of L{redden}: the reddening law is evaluated
+    only once on the wavelength grid (or in the passbands), and all values of
+    C{ebvs} are applied in one go as an outer product. The result is a 2D
+    array with one row per E(B-V) value.
+    
+    >>> wave = np.r_[1e3:1e5:10]
+    >>> flux = np.ones_like(wave)
+    >>> fluxes = redden_multi(flux,wave=wave,ebvs=np.r_[0:1.01:0.25])
+    >>> print fluxes.shape
+    (5, 9900)
+    >>> np.allclose(fluxes[2],redden(flux,wave=wave,ebv=0.5))
+    True
+    
+    Negative values of E(B-V) B{deredden}.
+    
+    @param flux: fluxes to (de)redden (magnitudes if C{rtype='mag'})
+    @type flux: ndarray (floats)
+    @param wave: wavelengths matching the fluxes (or give C{photbands})
+    @type wave: ndarray (floats)
+    @param photbands: photometry bands matching the fluxes (or give C{wave})
+    @type photbands: ndarray of str
+    @param ebvs: reddening parameters E(B-V)
+    @type ebvs: ndarray (floats)
+    @param rtype: type of dereddening (magnituds or fluxes)
+    @type rtype: str ('flux' or 'mag')
+    @return: (de)reddened flux/magnitude, shape (len(ebvs),len(flux))
+    @rtype: 2D ndarray (floats)
+    """
+    if ebvs is None:
+        ebvs = np.zeros(1)
+    ebvs = np.asarray(ebvs,float).ravel()
+    if photbands is not None:
+        wave = filters.get_info(photbands)['eff_wave']
+        
+    old_settings =  np.seterr(all='ignore')
+    wave, reddeningMagnitude = get_law(law,wave=wave,**kwargs)
+    #-- one row per E(B-V): A(lambda) = E(B-V) * A(lambda)/E(B-V)
+    extinction = np.outer(ebvs,reddeningMagnitude)
+    
+    if rtype=='flux':
+        # In this case flux means really flux
+        extinction *= -0.4*np.log(10)
+        flux_reddened = np.exp(extinction,extinction)
+        flux_reddened *= flux
+        np.seterr(**old_settings)
+        return flux_reddened
+    elif rtype=='mag':
+        # In this case flux means actually a magnitude
+        extinction += flux
+        np.seterr(**old_settings)
+        return extinction
+    else:
+        np.seterr(**old_settings)
+        raise ValueError,'rtype %s not understood'%(rtype)
+
 def deredden(flux,wave=None,photbands=None,ebv=0.,rtype='flux',**kwargs):
     """
     Deredden flux or magnitudes.
@@ -257,6 +316,134 @@ def deredden(flux,wave=None,photbands=None,ebv=0.,rtype='flux',**kwargs):
 
 #}
 
+#{ Law tables
+
+#-- tables of the most recently used laws and parameter sets
+_law_tables = LRUCache(maxsize=32)
+
+#-- the parameters each law depends on: other keywords (e.g. passed on via
+#   redden) do not change the curve
+_law_parameters = dict(chiar2006=('Rv','curve'),fitzpatrick1999=('Rv',),
+                       fitzpatrick2004=('Rv',),donnell1994=('Rv',),
+                       cardelli1989=('Rv','curve'),seaton1979=('Rv',))
+
+def get_law_table(name,**kwargs):
+    """
+    Retrieve the precomputed table of an interstellar reddening law.
+    
+    For every law and set of parameters (e.g. C{Rv}), the curve on the standard
+    wavelength grid of the law is computed once. The tables of the 32 most
+    recently used laws and parameter sets are kept in memory, so subsequent
+    calls are lookups.
+    
+    The table is a dictionary with keys C{wave} and C{mag} (the curve as
+    returned by the law function), C{Rv}, and C{photbands}, a dictionary
+    mapping passbands to the integrated curve. Passbands are only integrated
+    when they are first requested (see L{get_band_extinction}), so callers
+    that only need the curve on a wavelength grid pay nothing for them.
+    
+    Only the parameters of the law itself (see C{_law_parameters}) are used,
+    other keywords are ignored.
+    
+    >>> ext = get_band_extinction(['JOHNSON.K'],Rv=3.1,norm='Av')
+    >>> print '%.3g'%(ext[0])
+    0.114
+    
+    @param name: name of the interstellar law
+    @type name: str, one of the functions defined here
+    @return: table of the law
+    @rtype: dict
+    """
+    parameters = _law_parameters.get(name.lower(),None)
+    if parameters is not None:
+        kwargs = dict([(key,kwargs[key]) for key in parameters if key in kwargs])
+    Rv = kwargs.setdefault('Rv',3.1)
+    key = (name.lower(),tuple(sorted(kwargs.items())))
+    try:
+        table = _law_tables.get(key)
+    except TypeError:
+        #-- unhashable parameters (e.g. arrays) cannot be cached
+        key,table = None,None
+    if table is not None:
+        return table
+    wave,mag = globals()[name.lower()](**kwargs)
+    table = dict(wave=wave,mag=mag,Rv=Rv,photbands={})
+    logger.info('Tabulated law %s (%s)'%(name,', '.join(['%s=%s'%(k,v) for k,v in sorted(kwargs.items())])))
+    if key is not None:
+        _law_tables.put(key,table)
+    return table
+
+
+def get_band_extinction(photbands,law='cardelli1989',Rv=3.1,norm='Av',**kwargs):
+    """
+    Retrieve the extinction in passbands from the law tables.
+    
+    This is equivalent to C{get_law(law,Rv=Rv,norm=norm,photbands=photbands)[1]},
+    but C{Rv} can be an array, e.g. for fitting Rv over a grid. Every distinct
+    value of Rv is tabulated only once.
+    
+    >>> ext = get_band_extinction(['JOHNSON.V','JOHNSON.K'],Rv=[2.5,3.1,3.1,5.0])
+    >>> print ext.shape
+    (4, 2)
+    
+    @param photbands: list of photometric passbands
+    @type photbands: list of strings
+    @param law: name of the interstellar law
+    @type law: str, one of the functions defined here
+    @param Rv: Av/E(B-V)
+    @type Rv: float or array
+    @param norm: type of normalisation of the curve (E(B-V), Av, Ak or a passband)
+    @type norm: str
+    @return: extinction in the passbands, shape (len(photbands),) or
+    Rv.shape+(len(photbands),)
+    @rtype: ndarray
+    """
+    Rvs = np.asarray(Rv,float)
+    unique_Rvs,inverse = np.unique(Rvs.ravel(),return_inverse=True)
+    output = np.zeros((len(unique_Rvs),len(photbands)))
+    for i,Rv_ in enumerate(unique_Rvs):
+        table = get_law_table(law,Rv=Rv_,**kwargs)
+        output[i] = _get_band_values(table,photbands)
+        if norm.lower()=='e(b-v)':
+            output[i] *= Rv_
+        else:
+            output[i] /= _get_band_values(table,[_norm_photband(norm)])[0]
+    return output[inverse].reshape(Rvs.shape+(len(photbands),))
+
+
+def _get_band_values(table,photbands):
+    """
+    Look up the integrated curve in passbands.
+    
+    Passbands that are not in the table yet are integrated and added to it.
+    
+    @param table: table of the law (see L{get_law_table})
+    @type table: dict
+    @param photbands: list of photometric passbands
+    @type photbands: list of strings
+    @return: integrated curve
+    @rtype: ndarray
+    """
+    missing = [photband for photband in photbands if not photband in table['photbands']]
+    if missing:
+        table['photbands'].update(zip(missing,model.synthetic_flux(table['wave'],table['mag'],missing)))
+    return np.array([table['photbands'][photband] for photband in photbands])
+
+
+def _norm_photband(norm):
+    """
+    Translate a normalisation to a passband.
+    
+    We allow ak and av as shortcuts for normalisation in JOHNSON K and V bands.
+    """
+    if norm.lower()=='ak':
+        return 'JOHNSON.K'
+    elif norm.lower()=='av':
+        return 'JOHNSON.V'
+    return norm
+
+#}
+
 #{ Curve definitions
 @memoized
 def chiar2006(Rv=3.1,curve='ism',**kwargs):
@@ -6,13 +6,22 @@ Unit test covering sed.fit.py
 import numpy as np
 from numpy import inf, array
 from ivs import sigproc
-from ivs.sed import fit, model, builder, filters
+from ivs.sed import fit, model, builder, filters, reddening, decorators, limbdark
+from ivs.sed import extinctionmodels
 from ivs.units import constants
 from ivs.catalogs import sesame
 from ivs.aux import loggers
 from ivs.units import constants
 from matplotlib import mlab
 
+import os
+import shutil
+import tempfile
+try:
+    import pyfits
+except ImportError:
+    import astropy.io.fits as pyfits
+
 import unittest
 try:
     import mock
@@ -140,7 +149,38 @@ class ModelTestCase(SEDTestCase):
         self.assertArrayAlmostEqual(flux_[0],flux[0],delta=0.01e+11)
         self.assertArrayAlmostEqual(flux_[1],flux[1],delta=0.01e+09)
         self.assertArrayAlmostEqual(Labs_,Labs,places=3)
-        
+
+    def testGetItablePixBinaryDerivatives(self):
+        """ model.get_itable_pix() multiple case with derivatives and wave_units """
+        bgrid = {'teff': 22674., 'logg': 5.75, 'ebv': 0.0018, 'rad': 4.96,
+                 'teff2': 38779., 'logg2': 4.67, 'ebv2': 0.0018, 'rad2': 6.99}
+
+        wave, flux, Labs, dflux = model.get_itable_pix(photbands=self.photbands,
+                                        wave_units='AA', derivatives=True, **bgrid)
+        flux_, Labs_ = model.get_itable_pix(photbands=self.photbands, **bgrid)
+
+        self.assertEqual(flux.shape, (2, 1))
+        self.assertEqual(wave.shape, flux.shape)
+        self.assertArrayAlmostEqual(flux[:,0]/flux_[:,0], [1.0, 1.0], places=8)
+        #-- the effective wavelength lies in between those of the components
+        waves = []
+        for comp, grid in zip(['', '2'], model.defaults_multiple):
+            grid = dict([(key, grid[key]) for key in grid if not key in ['z', 'Rv']])
+            waves.append(model._get_eff_waves(self.photbands, bgrid['teff'+comp],
+                                    bgrid['logg'+comp], bgrid['ebv'+comp], **grid))
+        for i in range(len(self.photbands)):
+            self.assertAllBetween(wave[i], min(waves[0][i], waves[1][i]), max(waves[0][i], waves[1][i]))
+
+        #-- derivatives against finite differences
+        for par, step in [('teff', 1.), ('teff2', 1.), ('logg2', 0.001), ('rad', 0.01)]:
+            bgrid_ = dict(bgrid)
+            bgrid_[par] = bgrid[par] + step
+            flux_up = model.get_itable_pix(photbands=self.photbands, **bgrid_)[0]
+            bgrid_[par] = bgrid[par] - step
+            flux_down = model.get_itable_pix(photbands=self.photbands, **bgrid_)[0]
+            numeric = (flux_up - flux_down)[:,0] / (2*step)
+            self.assertArrayAlmostEqual(dflux[par][:,0]/numeric, [1.0, 1.0], places=2)
+
     def testGetItableSingle(self):
         """ model.get_itable() single case """
                                 
@@ -201,6 +241,365 @@ class ModelTestCase(SEDTestCase):
         self.assertAlmostEqual(flux[40000], 141915936.111, delta=0.001)
         self.assertAlmostEqual(flux[80000], 12450102.801, delta=0.001)
     
+    def testPrefetchTables(self):
+        """ model.prefetch_tables() caches copies of the spectra """
+        teffs, loggs = model.get_grid_dimensions()
+        wave, fluxes = model.prefetch_tables(teffs[:3], loggs[:3])
+        expected = fluxes.copy()
+        fluxes[:] = 0.
+
+        gridfile = model.get_file()
+        for i in range(3):
+            mod_name = "T%05d_logg%01.02f" %(teffs[i], loggs[i])
+            wave_, flux_ = model._get_model_spectrum(gridfile, mod_name)
+            self.assertTrue(flux_.base is None)
+            self.assertArrayAlmostEqual(flux_, expected[i], places=8)
+
+    def testGetEffWaves(self):
+        """ model._get_eff_waves() against filters.eff_wave() """
+        teffs, loggs = model.get_grid_dimensions()
+        teff, logg = teffs[len(teffs)//2], loggs[len(loggs)//2]
+        ebvs = np.array([0.15, 2.5])
+
+        waves = model._get_eff_waves(self.photbands, [teff, teff], [logg, logg], ebvs)
+        self.assertEqual(waves.shape, (2, 2))
+        for i, ebv in enumerate(ebvs):
+            table = model.get_table(teff=teff, logg=logg, ebv=ebv)
+            waves_ = filters.eff_wave(self.photbands, model=table)
+            self.assertArrayAlmostEqual(waves[:,i]/waves_, [1.0, 1.0], places=3)
+        #-- outside the tabulated E(B-V) range, the model itself is used
+        self.assertArrayAlmostEqual(waves[:,1], waves_, places=8)
+
+    def testSyntheticFluxMultiple(self):
+        """ model.synthetic_flux() with a stack of spectra """
+        wave, flux = model.get_table(teff=6874, logg=4.21, ebv=0.0)
+        ebvs = np.array([0.0, 0.1, 0.5])
+        
+        fluxes = reddening.redden_multi(flux, wave=wave, ebvs=ebvs, law='fitzpatrick2004', Rv=3.1)
+        synflux = model.synthetic_flux(wave, fluxes, self.photbands)
+        
+        self.assertEqual(synflux.shape, (3, 2))
+        for i, ebv in enumerate(ebvs):
+            flux_ = reddening.redden(flux, wave=wave, ebv=ebv, law='fitzpatrick2004', Rv=3.1)
+            self.assertArrayAlmostEqual(fluxes[i], flux_, places=5)
+            synflux_ = model.synthetic_flux(wave, flux_, self.photbands)
+            self.assertArrayAlmostEqual(synflux[i]/synflux_, [1.0, 1.0], places=8)
+
+        #-- in the infrared, the spectra are interpolated in blocks of rows
+        photbands = ['IRAS.F12', 'JOHNSON.V']
+        synflux = model.synthetic_flux(wave, fluxes, photbands, units=['Flambda', 'Fnu'])
+        synflux_ = model._synthetic_flux_multi(wave, fluxes, photbands, units=['Flambda', 'Fnu'],
+                                               max_points=200000)
+        for i in range(len(ebvs)):
+            self.assertArrayAlmostEqual(synflux_[i]/synflux[i], [1.0, 1.0], places=10)
+
+    def testBandExtinction(self):
+        """ reddening.get_band_extinction() with an array of Rv """
+        Rvs = np.array([2.5, 3.1, 5.0])
+
+        ext = reddening.get_band_extinction(self.photbands, law='cardelli1989', Rv=Rvs, norm='Av')
+
+        self.assertEqual(ext.shape, (3, 2))
+        for i, Rv in enumerate(Rvs):
+            #-- integrate the raw curve of the law
+            wave, mag = reddening.cardelli1989(Rv=Rv)
+            Av = model.synthetic_flux(wave, mag, ['JOHNSON.V'])[0]
+            ext_ = model.synthetic_flux(wave, mag, self.photbands) / Av
+            self.assertArrayAlmostEqual(ext[i]/ext_, [1.0, 1.0], places=8)
+
+        #-- keywords that are not parameters of the law share the same table
+        table = reddening.get_law_table('cardelli1989', Rv=3.1)
+        self.assertTrue(reddening.get_law_table('cardelli1989', Rv=3.1, teff=5000., law='cardelli1989') is table)
+        self.assertFalse(reddening.get_law_table('cardelli1989', Rv=3.1, curve='donnell') is table)
+
+        #-- passbands are only integrated on request
+        table = reddening.get_law_table('cardelli1989', Rv=3.37)
+        reddening.get_law('cardelli1989', Rv=3.37, wave=np.linspace(3000., 10000., 50))
+        self.assertEqual(table['photbands'], {})
+        reddening.get_band_extinction(self.photbands, law='cardelli1989', Rv=3.37)
+        self.assertEqual(sorted(table['photbands'].keys()), sorted(self.photbands+['JOHNSON.V']))
+
+    def testStageFile(self):
+        """ model.stage_file() reuses valid copies """
+        directory = tempfile.mkdtemp()
+        try:
+            source = os.path.join(directory, 'grid.fits')
+            with open(source, 'wb') as ff:
+                ff.write('grid'*100)
+            target = model.stage_file(source, os.path.join(directory, 'scratch'))
+            self.assertEqual(open(target, 'rb').read(), 'grid'*100)
+            
+            #-- a corrupted copy is only detected when verifying
+            with open(target, 'wb') as ff:
+                ff.write('corrupt')
+            model.stage_file(source, os.path.join(directory, 'scratch'))
+            self.assertEqual(open(target, 'rb').read(), 'corrupt')
+            model.stage_file(source, os.path.join(directory, 'scratch'), verify=True)
+            self.assertEqual(open(target, 'rb').read(), 'grid'*100)
+            
+            model.unstage_file(target)
+            self.assertFalse(os.path.isfile(target))
+            self.assertFalse(os.path.isfile(target+'.md5'))
+            self.assertFalse(os.path.isfile(target+'.lock'))
+        finally:
+            shutil.rmtree(directory)
+
+class DecoratorsTestCase(SEDTestCase):
+
+    def gridsearch(self, points=10, teffrange=(4000., 6000.), loggrange=(4., 4.),
+                   ebvrange=(0., 0.), zrange=(0., 0.), minimum=1.):
+        """ grid search on a parabola in teff, sampled evenly """
+        self.calls.append((points, teffrange))
+        teff = np.linspace(teffrange[0], teffrange[1], points)
+        ones = np.ones(points)
+        chisq = minimum + ((teff-5000.)/1000.)**2
+        return np.rec.fromarrays([teff, loggrange[0]*ones, ebvrange[0]*ones, zrange[0]*ones, chisq],
+                                 names='teff,logg,ebv,z,chisq')
+
+    def setUp(self):
+        self.calls = []
+
+    def testColumnBuffer(self):
+        """ sed.decorators._ColumnBuffer """
+        data = self.gridsearch(points=5)
+        buff = decorators._ColumnBuffer(data.dtype, capacity=2)
+        buff.append(data[:3])
+        buff.append(data[3:])
+        buff.append(data)
+        self.assertEqual(len(buff), 10)
+        self.assertArrayAlmostEqual(buff['teff'], np.hstack([data['teff'], data['teff']]), places=8)
+        records = buff.records()
+        self.assertEqual(records.dtype, data.dtype)
+        self.assertArrayAlmostEqual(records['chisq'], np.hstack([data['chisq'], data['chisq']]), places=8)
+
+    def testIterateGridsearch(self):
+        """ sed.decorators.iterate_gridsearch() stages and stopping rule """
+        gridsearch = decorators.iterate_gridsearch(self.gridsearch)
+
+        #-- by default, there is no zooming in
+        data = gridsearch()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(len(data), 10)
+
+        #-- the next stage only adds the missing points inside the confidence
+        #   region (the 6 points with chi2 below 1.5 times the best chi2)
+        self.calls = []
+        data = gridsearch(iterations=2, speed=0.5)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.calls[1][0], 4)
+        self.assertAlmostEqual(self.calls[1][1][0], 4000.+2*2000./9, places=6)
+        self.assertAlmostEqual(self.calls[1][1][1], 4000.+7*2000./9, places=6)
+        self.assertEqual(len(data), 14)
+
+        #-- stop when the best chi2 and the confidence region do not change
+        self.calls = []
+        data = gridsearch(iterations=5, points=11, minimum=0.)
+        self.assertEqual(len(self.calls), 2)
+        self.assertAlmostEqual(data['teff'][np.argmin(data['chisq'])], 5000., places=6)
+
+class LimbDarkeningTestCase(SEDTestCase):
+    
+    def setUp(self):
+        """ Write a small LD grid with coefficients that are linear in teff and logg """
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.photbands = ('JOHNSON.V', 'JOHNSON.B')
+        teffs, loggs = np.meshgrid([5000., 6000., 7000.], [3.5, 4.0, 4.5])
+        pars = np.column_stack([teffs.ravel(), loggs.ravel(), np.zeros((teffs.size, 3))])
+        hdulist = pyfits.HDUList([pyfits.PrimaryHDU(np.array([[0, 0]]))])
+        hdulist[0].header.update('LAW', 'claret', 'FITTED LD LAW')
+        for i, photband in enumerate(self.photbands):
+            coeffs = np.column_stack(self.coeffs(pars[:,0], pars[:,1], i))
+            Imu1s = np.column_stack([self.Imu1(pars[:,0], pars[:,1], i), np.zeros((len(pars), 2))])
+            hdulist.append(limbdark._ld_table(photband, pars, coeffs, Imu1s))
+        gridfile = os.path.join(self.directory, 'ldtest.fits')
+        hdulist.writeto(gridfile)
+        self.create_patch(limbdark, 'get_file', return_value=gridfile)
+        self.addCleanup(limbdark._get_pix_grid.cache.clear)
+        limbdark._get_pix_grid.cache.clear()
+    
+    def coeffs(self, teff, logg, i):
+        return [0.5+teff/1e4, -0.1*logg, 0.01*(i+1), teff/1e5]
+    
+    def Imu1(self, teff, logg, i):
+        return 10**(3.+teff/1e4+0.1*logg-0.2*i)
+    
+    def testGetPixGrid(self):
+        """ limbdark._get_pix_grid() skips constant axes """
+        axis_values, pixelgrid, names, law = limbdark._get_pix_grid(self.photbands, grid='ldtest')
+        self.assertEqual(names, ['teff', 'logg'])
+        self.assertEqual(law, 'claret')
+        self.assertArrayAlmostEqual(axis_values[0], [5000., 6000., 7000.])
+        self.assertArrayAlmostEqual(axis_values[1], [3.5, 4.0, 4.5])
+        #-- per passband four coefficients and log10(Imu1)
+        self.assertEqual(pixelgrid.shape[-1], 2*5)
+    
+    def testGetItableArray(self):
+        """ limbdark.get_itable() on arrays equals per-point scalar calls """
+        teffs = np.array([5000., 5250.5, 6000., 6800., 7000.])
+        loggs = np.array([3.5, 3.7, 4.5, 4.1, 4.0])
+        mus = np.array([1.0, 0.3, 0.75, 0.5, 0.1])
+        
+        Imu = limbdark.get_itable(teff=teffs, logg=loggs, mu=mus, photbands=self.photbands, grid='ldtest')
+        Iabs = limbdark.get_itable(teff=teffs, logg=loggs, mu=mus, photbands=self.photbands,
+                                   absolute=True, grid='ldtest')
+        self.assertEqual(Imu.shape, (len(self.photbands), len(teffs)))
+        self.assertEqual(Iabs.shape, (len(self.photbands), len(teffs)))
+        
+        for j, (teff, logg, mu) in enumerate(zip(teffs, loggs, mus)):
+            Imu_ = limbdark.get_itable(teff=teff, logg=logg, mu=mu, photbands=self.photbands, grid='ldtest')
+            self.assertEqual(Imu_.shape, (len(self.photbands),))
+            self.assertArrayAlmostEqual(Imu[:,j], Imu_, places=10)
+            for i in range(len(self.photbands)):
+                #-- the coefficients and log(Imu1) are linear, so interpolation is exact
+                expected = limbdark.ld_claret(mu, self.coeffs(teff, logg, i))
+                self.assertAlmostEqual(Imu[i,j], expected, places=5)
+                #-- absolute intensities include the central intensity
+                self.assertAlmostEqual(Iabs[i,j]/(Imu[i,j]*self.Imu1(teff, logg, i)), 1.0, places=5)
+        
+        #-- at the center of the disk the absolute intensity is Imu1
+        Iabs = limbdark.get_itable(teff=teffs, logg=loggs, mu=1, photbands=self.photbands,
+                                   absolute=True, grid='ldtest')
+        for i in range(len(self.photbands)):
+            self.assertArrayAlmostEqual(Iabs[i]/self.Imu1(teffs, loggs, i), np.ones(len(teffs)), places=5)
+    
+class ExtinctionModelsTestCase(SEDTestCase):
+    """ Array input of the extinction models equals element-by-element scalar calls """
+    
+    def assertArrayCalls(self, function, lngs, lats, distances=None, **kwargs):
+        if distances is None:
+            out = function(lngs, lats, **kwargs)
+            out_ = [function(lng, lat, **kwargs) for lng, lat in zip(lngs, lats)]
+        else:
+            out = function(lngs, lats, distance=distances, **kwargs)
+            out_ = [function(lng, lat, distance=dd, **kwargs) for lng, lat, dd in zip(lngs, lats, distances)]
+        self.assertEqual(out.shape, (len(lngs),))
+        self.assertArrayAlmostEqual(out, out_, places=10)
+        return out
+    
+    def testMarshall(self):
+        """ extinctionmodels.findext_marshall() below, between and beyond the distance bins """
+        lng, lat = 271.05, -4.93
+        tree, nb, rr, ext = extinctionmodels._get_marshall_index()
+        kma = tree.query([lng, lat])[1]
+        rr, ext, nb = rr[kma], ext[kma], nb[kma]
+        distances = np.array([0.5*rr[0], 0.5*(rr[0]+rr[1]), 2*rr[nb-1]])*1e3
+        norm = extinctionmodels._get_norm_factor('cardelli1989', 3.1, 'Ak', 'JOHNSON.K')
+        
+        ak = self.assertArrayCalls(extinctionmodels.findext_marshall, [lng]*3, [lat]*3,
+                                   distances, norm='Ak')
+        expected = np.array([0.5*ext[0], 0.5*(ext[0]+ext[1]), ext[nb-1]])/norm
+        self.assertArrayAlmostEqual(ak, expected, places=6)
+        
+        #-- without distance, the extinction of the last bin
+        ak = self.assertArrayCalls(extinctionmodels.findext_marshall, [lng, 10.2], [lat, 9.0], norm='Ak')
+        self.assertAlmostEqual(ak[0], ext[nb-1]/norm, places=6)
+        
+        #-- invalid positions give NaN in arrays, and None for scalars
+        ak = extinctionmodels.findext_marshall([lng, 150., 10.2], [lat, 0., 59.0], norm='Ak')
+        self.assertFalse(np.isnan(ak[0]))
+        self.assertTrue(np.isnan(ak[1:]).all())
+        self.assertEqual(extinctionmodels.findext_marshall(150., 0., norm='Ak'), None)
+        self.assertEqual(extinctionmodels.findext_marshall(10.2, 59.0, norm='Ak'), None)
+    
+    def testArenou(self):
+        """ extinctionmodels.findext_arenou() at the boundaries of the cells """
+        #-- longitudes on and just below the boundaries of the Appendix cells
+        lngs = np.array([0., 28.999, 29., 57., 84.5, 359.5, 10.2, 107.05])
+        lats = np.array([-70., -70., -70., -70., -70., -70., 59., -34.93])
+        params = extinctionmodels._getarenouparams_multi(lngs, lats)
+        self.assertEqual(params.shape, (5, len(lngs)))
+        for i, (lng, lat) in enumerate(zip(lngs, lats)):
+            self.assertArrayAlmostEqual(params[:,i], extinctionmodels._getarenouparams(lng, lat), places=10)
+        self.assertNotEqual(params[0,1], params[0,2])
+        
+        #-- on a latitude boundary, the cell above is used
+        params = extinctionmodels._getarenouparams_multi(np.array([40.]), np.array([-60.]))
+        self.assertArrayAlmostEqual(params[:,0], extinctionmodels._getarenouparams(40., -59.5), places=10)
+        
+        self.assertArrayCalls(extinctionmodels.findext_arenou, lngs, lats)
+        self.assertArrayCalls(extinctionmodels.findext_arenou, lngs, lats,
+                              np.array([10., 50., 100., 1000., 144.65, 30., 1000., 144.65]))
+    
+    def testDrimmel(self):
+        """ extinctionmodels.findext_drimmel() inside and outside the local grids """
+        #-- within 0.75 kpc, within the local Orion grid, and outside both
+        lngs = np.array([10.2, 90., 90., 180., 10.2, 271.05])
+        lats = np.array([9.0, 1.0, 1.0, -2.0, 9.0, -4.93])
+        distances = np.array([100., 500., 1500., 800., 5000., 3000.])
+        self.assertArrayCalls(extinctionmodels.findext_drimmel, lngs, lats, distances)
+        self.assertArrayCalls(extinctionmodels.findext_drimmel, lngs, lats, distances, rescaling=False)
+        self.assertArrayCalls(extinctionmodels.findext_drimmel, lngs, lats)
+    
+    def testCOBEPixels(self):
+        """ extinctionmodels COBE quad-cube pixel routines on arrays """
+        res = 9
+        pixels = np.arange(0, 6*4**(res-1), 997)
+        fij = extinctionmodels._pix2fij(pixels, res)
+        self.assertEqual(fij.shape, (3, len(pixels)))
+        self.assertArrayEqual(extinctionmodels._fij2pix(fij, res), pixels)
+        xout, yout = extinctionmodels._rastr(pixels, res)
+        for i, pixel in enumerate(pixels[::50]):
+            fij_ = extinctionmodels._pix2fij(pixel, res)
+            self.assertListEqual(list(fij_[:,0]), list(fij[:,i*50]))
+            self.assertEqual(extinctionmodels._fij2pix(fij_, res)[0], pixel)
+            xout_, yout_ = extinctionmodels._rastr(pixel, res)
+            self.assertEqual((xout_[0], yout_[0]), (xout[i*50], yout[i*50]))
+        
+        #-- unit vectors from galactic coordinates, and on all faces of the cube
+        lngs = np.array([0., 45., 90., 135., 180., 225., 270., 315., 10.2, 271.05])
+        lats = np.array([0., 80., -80., 30., -30., 89., -89., 5., 59., -4.93])
+        vectors = extinctionmodels._galvec2eclvec(extinctionmodels._ll2uv(lngs, lats))
+        self.assertArrayEqual(extinctionmodels._ll2pix(lngs, lats, res), extinctionmodels._uv2pix(vectors, res))
+        axes = np.array([[1., 0.1, 0.2], [0.1, 1., 0.2], [0.2, 0.1, 1.]])
+        axes = np.vstack([axes, -axes])
+        vectors = np.vstack([vectors, axes/np.sqrt((axes**2).sum(axis=1))[:,None]])
+        x, y, face = extinctionmodels._axisxy(vectors)
+        pixels = extinctionmodels._uv2pix(vectors, res)
+        for i, vector in enumerate(vectors):
+            x_, y_, face_ = extinctionmodels._axisxy(vector)
+            self.assertAlmostEqual(x_[0], x[i], places=10)
+            self.assertAlmostEqual(y_[0], y[i], places=10)
+            self.assertEqual(face_[0], face[i])
+            self.assertEqual(extinctionmodels._uv2pix(vector, res)[0], pixels[i])
+        self.assertListEqual(list(face[-6:]), [1, 2, 0, 3, 4, 5])
+    
+class FiltersTestCase(SEDTestCase):
+
+    def testPassbandDatabase(self):
+        """ filters.get_database() skips non-curves and rebuilds on edits """
+        basedir = filters.basedir
+        directory = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(directory, 'filters', 'old'))
+            shutil.copy(os.path.join(basedir, 'zeropoints.dat'), directory)
+            for name, peak in [('TEST.A', 4000.), ('TEST.B', 5000.)]:
+                np.savetxt(os.path.join(directory, 'filters', name),
+                           np.column_stack([np.linspace(peak-500, peak+500, 11), np.ones(11)]))
+            with open(os.path.join(directory, 'filters', 'README'), 'w') as ff:
+                ff.write('Response curves of the test systems\n')
+            shutil.copy(os.path.join(directory, 'filters', 'TEST.A'), os.path.join(directory, 'filters', 'old'))
+
+            filters.basedir = directory
+            filters._database.clear()
+            db = filters.get_database()
+            self.assertListEqual(db['photbands'], ['TEST.A', 'TEST.B'])
+            self.assertAlmostEqual(db['data'][0, 0], 3500.)
+
+            #-- editing a curve in place does not touch the directory
+            dbtime = os.path.getmtime(os.path.join(directory, filters.dbfile))
+            np.savetxt(os.path.join(directory, 'filters', 'TEST.A'),
+                       np.column_stack([np.linspace(3000., 4000., 11), np.ones(11)]))
+            os.utime(os.path.join(directory, 'filters', 'TEST.A'), (dbtime+10, dbtime+10))
+            self.assertAlmostEqual(filters._sources_mtime(), dbtime+10, places=3)
+            filters._database.clear()
+            db = filters.get_database()
+            self.assertAlmostEqual(db['data'][0, 0], 3000.)
+        finally:
+            filters.basedir = basedir
+            filters._database.clear()
+            shutil.rmtree(directory)
+
 class PixFitTestCase(SEDTestCase):
     
     @classmethod
@@ -341,6 +740,143 @@ class PixFitTestCase(SEDTestCase):
         
         mock_stat.assert_called()
     
+    def testStatChi2Blocks(self):
+        """ fit.stat_chi2() in blocks """
+        np.random.seed(1111)
+        meas = np.random.uniform(1,2,size=5).reshape(-1,1)
+        emeas = 0.05*meas
+        colors = array([False, False, True, False, True])
+        syn = np.random.uniform(0.5,1.5,size=(5,103))
+        
+        chisqs_full = fit.stat_chi2(meas,emeas,colors,syn,full_output=True)[0].sum(axis=0)
+        ratio = (meas/syn)[-colors]
+        weights = (meas/emeas)[-colors]
+        scales_ = np.average(ratio,weights=weights.reshape(-1),axis=0)
+        
+        chisqs,scales,e_scales = fit.stat_chi2(meas,emeas,colors,syn,blocksize=10)
+        self.assertArrayAlmostEqual(chisqs,chisqs_full,places=8)
+        self.assertArrayAlmostEqual(scales,scales_,places=10)
+        self.assertEqual(len(e_scales),103)
+        
+        chisqs_,scales_,e_scales_,index = fit.stat_chi2(meas,emeas,colors,syn,blocksize=10,keep=5)
+        self.assertListEqual(index.tolist(),np.argsort(chisqs)[:5].tolist())
+        self.assertArrayAlmostEqual(chisqs_,chisqs[index],places=10)
+        
+        limit = np.median(chisqs)
+        chisqs_,scales_,e_scales_,index = fit.stat_chi2(meas,emeas,colors,syn,blocksize=10,chi2_limit=limit)
+        self.assertEqual(len(index),sum(chisqs<=limit))
+        self.assertTrue(np.all(np.diff(chisqs_)>=0))
+
+        #-- single precision synthetic fluxes and unused keywords
+        syn32 = syn.astype(np.float32)
+        chisqs32 = fit.stat_chi2(meas,emeas,colors,syn32,blocksize=10,masses=(1.,0.5))[0]
+        chisqs_ = fit.stat_chi2(meas,emeas,colors,syn32.astype(float),blocksize=10)[0]
+        self.assertArrayAlmostEqual(chisqs32,chisqs_,places=8)
+
+    def testConstraintMask(self):
+        """ fit.constraint_mask() """
+        pars = {'logg': array([4.0, 4.0, 4.0, 4.0]),
+                'rad': array([1.0, 1.0, 2.0, 1.0]),
+                'ebv': array([0.01, 0.01, 0.01, 0.01]),
+                'logg2': array([5.0, 4.0, 4.0, 4.0]),
+                'rad2': array([0.5, 2.0, 1.0, 1.0]),
+                'ebv2': array([0.01, 0.01, 0.01, 0.02])}
+        
+        keep = fit.constraint_mask({}, **pars)
+        self.assertListEqual(keep.tolist(), [True, True, True, False])
+        
+        keep = fit.constraint_mask({'radius_ratio':(0.4, 1.0)}, **pars)
+        self.assertListEqual(keep.tolist(), [True, False, True, False])
+        
+        keep = fit.constraint_mask({'mass_ratio':(1.0, 5.0)}, **pars)
+        self.assertListEqual(keep.tolist(), [True, True, False, False])
+        
+        self.assertEqual(fit.constraint_mask({}, teff=array([5000.])), None)
+    
+    def testPCAEmulator(self):
+        """ fit.get_PCA_emulator() """
+        #-- keeping all components reproduces the grid
+        report = fit.report_PCA_emulator(self.photbands,points=100,ncomp=3)
+        self.assertEqual(report['ncomp'],3)
+        self.assertEqual(report['photbands'],self.photbands+['Labs'])
+        self.assertTrue(np.all(report['max']<1e-6))
+
+        flux,Labs = fit.get_itable_pca(teff=array([5000.,6000.]),logg=array([4.,4.]),
+                                  ebv=array([0.01,0.01]),photbands=self.photbands,ncomp=3)
+        self.assertEqual(flux.shape,(2,2))
+        self.assertEqual(len(Labs),2)
+
+    def testPCAEmulatorCompressed(self):
+        """ fit.get_itable_pca() with fewer components than passbands """
+        photbands = ['STROMGREN.U', 'STROMGREN.B', 'STROMGREN.V', 'STROMGREN.Y',
+                     '2MASS.J', '2MASS.H', '2MASS.KS']
+        report = fit.report_PCA_emulator(photbands,points=100,ncomp=4)
+        self.assertEqual(report['ncomp'],4)
+        self.assertTrue(np.all(report['median']<0.01))
+        self.assertTrue(np.all(report['max']<0.05))
+
+        #-- against exact interpolation in the pixel grid
+        grid = dict(teff=array([5500., 6000., 6800.]), logg=array([3.7, 4.1, 4.4]),
+                    ebv=array([0.006, 0.01, 0.014]), z=array([-0.4, -0.2, -0.1]),
+                    rv=array([2.2, 2.8, 3.0]))
+        flux,Labs = model.get_itable_pix(photbands=photbands,**grid)
+        flux_,Labs_ = fit.get_itable_pca(photbands=photbands,ncomp=4,**grid)
+        self.assertEqual(flux_.shape,flux.shape)
+        self.assertTrue(np.all(np.abs(flux_/flux-1)<0.05))
+        self.assertTrue(np.all(np.abs(Labs_/Labs-1)<0.05))
+
+        #-- the emulator in a grid search: the true model fits best
+        meas = flux[:,1]*1e-20
+        emeas = meas/100.
+        chisqs,scales,e_scales,lumis = fit.igrid_search_pix(meas,emeas,photbands,
+                                                    model_func='pca',ncomp=4,**grid)
+        self.assertEqual(len(chisqs),3)
+        self.assertTrue(np.all(np.isfinite(chisqs)))
+        self.assertEqual(np.argmin(chisqs),1)
+
+        #-- and in the minimizer
+        pars = dict(teff_value=6200, teff_min=5000, teff_max=7000, teff_vary=True,
+                    logg_value=4.0, logg_min=3.5, logg_max=4.5, logg_vary=True,
+                    ebv_value=0.01, ebv_min=0.005, ebv_max=0.015, ebv_vary=False,
+                    z_value=-0.2, z_min=-0.5, z_max=0.0, z_vary=False,
+                    rv_value=2.8, rv_min=2.1, rv_max=3.1, rv_vary=False)
+        result, chisqr, nfev, scale, lumis = fit.iminimize(meas,emeas,photbands,points=None,
+                                                          model_func='pca',**pars)
+        self.assertAlmostEqual(result['teff'][0],6000.,delta=150)
+        self.assertAlmostEqual(result['logg'][0],4.1,delta=0.2)
+        self.assertAlmostEqual(scale[0],1e-20,delta=0.1e-20)
+
+    def testiGridSearchMC(self):
+        """ fit.igrid_search_mc() """
+        meas = array([3.64007e-13, 2.49267e-13, 9.53516e-14] )
+        emeas = array([3.64007e-14, 2.49267e-14, 9.53516e-15])
+        photbands = ['STROMGREN.U', 'STROMGREN.B', 'STROMGREN.V']
+        grid = {'teff': array([ 22674.,  21774.,  22813.,  29343., 28170.]),
+                'logg': array([ 5.75,  6.07,  6.03 ,  6.38,  5.97]),
+                'ebv': array([ 0.0018,  0.0077,  0.0112,  0.0046,  0.0110])}
+        syn_flux = array([[8.0218e+08, 7.2833e+08, 8.1801e+08, 1.6084e+09, 1.4178e+09],
+                    [4.3229e+08, 4.0536e+08, 4.3823e+08, 7.0594e+08, 6.4405e+08],
+                    [6.2270e+08, 5.7195e+08, 6.2482e+08, 1.0415e+09, 9.5594e+08]])
+        lumis = array([232.5337, 200.0878, 238.7946, 625.3935, 533.8251])
+        
+        mock_grid = self.create_patch(fit, 'generate_grid_pix', return_value=grid)
+        mock_model = self.create_patch(model, 'get_itable_pix', return_value=(syn_flux, lumis))
+        mock_color = self.create_patch(filters, 'is_color', return_value=False)
+        
+        results = fit.igrid_search_mc(meas, emeas, photbands, realisations=3, points=5,
+                                      disturb=False, teffrange=(20000,30000))
+        
+        chisqs,scales,e_scales = fit.stat_chi2(meas.reshape(-1,1), emeas.reshape(-1,1),
+                                               np.zeros(3,bool), syn_flux)
+        best = chisqs.argmin()
+        self.assertEqual(len(results['chisq']), 3)
+        for i in range(3):
+            self.assertEqual(results['teff'][i], grid['teff'][best])
+            self.assertEqual(results['labs'][i], lumis[best])
+            self.assertAlmostEqual(results['chisq'][i], chisqs[best], places=5)
+            self.assertAlmostEqual(results['scale'][i]/scales[best], 1.0, places=8)
+            self.assertAlmostEqual(results['escale'][i]/e_scales[best], 1.0, places=5)
+    
     def testCreateParameterDict(self):
         """ fit.create_parameter_dict() """
         
@@ -557,6 +1093,36 @@ class BuilderTestCase(SEDTestCase):
         pass
     
     
+    def testSaveLoadFits(self):
+        """ builder.sed.save_fits() after load_fits() from the same file """
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'TEST.fits')
+            self.sed.master = np.rec.fromarrays([array(['STROMGREN.U', '2MASS.H']),
+                                        array([1e-13, 2e-14])], names='photband,cmeas')
+            grid = np.rec.fromarrays([array([5000., 6000., 7000.]), array([1., 2., 3.])],
+                                     names='teff,chisq')
+            model_ = (array([1000., 2000., 3000.]), array([1., 2., 3.]), array([2., 3., 4.]))
+            self.sed.results = {'igrid_search': {'grid':grid, 'model':model_,
+                    'chi2':array([1., 2.]), 'factor':1.5,
+                    'synflux':(array([3500., 16500.]), array([1e-13, 2e-14]), self.sed.master['photband']),
+                    'CI':{'teff':6000., 'teff_l':5000., 'teff_u':7000.}}}
+            self.sed.save_fits(filename=filename)
+            
+            #-- the grid and model are read lazily from the file that is overwritten
+            sed = builder.SED(ID='TEST', load_fits=False, load_hdf5=False)
+            sed.load_fits(filename=filename)
+            sed.save_fits(filename=filename)
+            sed = builder.SED(ID='TEST', load_fits=False, load_hdf5=False)
+            sed.load_fits(filename=filename)
+            
+            res = sed.results['igrid_search']
+            self.assertListEqual(res['grid']['teff'].tolist(), grid['teff'].tolist())
+            self.assertListEqual(res['model'][2].tolist(), model_[2].tolist())
+            self.assertAlmostEqual(res['CI']['teff_l'], 5000., places=3)
+        finally:
+            shutil.rmtree(directory)
+    
     @unittest.skipIf(noMock, "Mock not installed")
     def testiGridSearch(self):
         """ builder.sed.igrid_search() mocked """
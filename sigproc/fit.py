@@ -440,6 +440,7 @@ from ivs.timeseries import pyKEP
 
 import re
 import copy
+from multiprocessing import Pool,Array,Value,cpu_count
 import pylab as pl
 import matplotlib as mpl
 from ivs.sigproc import lmfit
@@ -1239,11 +1240,11 @@ class Function(object):
                 
             return self.function(pars,x, **kwargs)
             
-    def evaluate_jacobian(self, x, *args):
+    def evaluate_jacobian(self, x, *args, **kwargs):
         """
         Evaluates the jacobian if that function is provided, using the given parameter object.
         If no parameter object is given then the parameter object belonging to the function
-        is used.
+        is used. Extra keywords are passed on to the jacobian function.
         """
         if self.jacobian == None:
             return [0.0 for i in self.par_names]
@@ -1254,7 +1255,7 @@ class Function(object):
             for name in self.par_names:
                 pars.append(self.parameters[name].value)
                 
-            return self.jacobian(pars,x)
+            return self.jacobian(pars,x, **kwargs)
         
         if len(args) == 1:
             #-- Use the provided parameters
@@ -1266,7 +1267,7 @@ class Function(object):
             else:
                 pars = args[0]
                 
-            return self.jacobian(pars,x)
+            return self.jacobian(pars,x, **kwargs)
             
     def setup_parameters(self, value=None, bounds=None, vary=None, expr=None, **kwargs):
         """
@@ -1845,7 +1846,7 @@ class Minimizer(object):
 
     def __init__(self, x, y, model, errors=None, weights=None, resfunc=None,
              engine='leastsq', args=None, kws=None, grid_points=1, grid_params=None,
-             verbose=False, **kwargs):
+             verbose=False, jacfunc=None, threads=1, dup_tol=None, **kwargs):
         
         self.x = x
         self.y = y
@@ -1855,7 +1856,10 @@ class Minimizer(object):
         self.model_kws = kws
         self.fit_kws = kwargs #fx: iter_cb, scale_covar
         self.resfunc = model.resfunc
+        self.jacfunc = jacfunc
         self.engine = engine
+        self.threads = threads
+        self.dup_tol = dup_tol
         self._minimizers = [None]
         
         if weights == None:
@@ -1956,7 +1960,8 @@ class Minimizer(object):
         
         return ci
     
-    def calculate_CI_2D(self, xpar=None, ypar=None, res=10,  limits=None, ctype='prob'):
+    def calculate_CI_2D(self, xpar=None, ypar=None, res=10,  limits=None, ctype='prob',
+                        threads=1, refine=0, levels=None):
         """
         Calculates the confidence interval for 2 given parameters. Both the  confidence interval
         calculated using the F-test method from the I{estimate_error} method, and the normal chi 
@@ -1965,33 +1970,124 @@ class Minimizer(object):
         The confidence intervall is returned as a grid, together with the x and y distribution of
         the parameters: (x-values, y-values, grid)
         
+        Every point of the grid is a fit with the two parameters fixed. The grid is filled in
+        rings around the best fit, and every fit starts from the best fit of the nearest point
+        that is already done. The fits of one ring are independent, and can be run on a pool
+        of I{threads} processes.
+        
+        With I{refine} > 0, the grid is first computed every 2**refine points. In every next
+        step, the points in between are only fitted where one of the chi square I{levels} is
+        crossed, elsewhere the chi squares are interpolated. This way, the fits are spent
+        around the contours of the confidence intervall.
+        
         @param xname: The parameter on the x axis
         @param yname: The parameter on the y axis
         @param res: The resolution of the grid over which the confidence intervall is calculated
         @param limits: The upper and lower limit on the parameters for which the confidence
                        intervall is calculated. If None, 5 times the stderr is used.
         @param ctype: 'prob' for probabilities plot (using F-test), 'chi2' for chi-squares. 
+        @param threads: The number of processes to use (or 'max')
+        @type threads: int or str
+        @param refine: The number of refinement steps (0 to fit every point of the grid)
+        @type refine: int
+        @param levels: The chi square levels to refine (required when refine > 0)
+        @type levels: list of float
         
         @return: the x values, y values and confidence values
         @rtype: (array, array, 2d array)
         """
-        
+        global _ci2d_task
         xn = hasattr(res,'__iter__') and res[0] or res
         yn = hasattr(res,'__iter__') and res[1] or res
-        
-        prob_func = None
-        if ctype == 'chi2':
-            def prob_func(Ndata, Nparas, new_chi, best_chi, nfix=1.):
-                return new_chi
+        if refine and levels is None:
+            raise ValueError, 'Provide the chi square levels to refine the grid on'
+        
+        mini = self.minimizer
+        params = mini.params
+        if not hasattr(mini, 'covar'):
+            mini.leastsq()
+        best_chi = mini.chisqr
+        org = lmfit.confidence.copy_vals(params)
+        x, y = params[xpar], params[ypar]
+        
+        if limits is None:
+            (x_upper, x_lower) = (x.value + 5 * x.stderr, x.value - 5 * x.stderr)
+            (y_upper, y_lower) = (y.value + 5 * y.stderr, y.value - 5 * y.stderr)
+        else:
+            (x_upper, x_lower) = limits[0]
+            (y_upper, y_lower) = limits[1]
+        x_points = np.linspace(x_lower, x_upper, xn)
+        y_points = np.linspace(y_lower, y_upper, yn)
+        
+        #-- the cells (iy, ix) that are fitted at every refinement step
+        step = 2**refine
+        lattice = lambda n, step: np.unique(np.hstack([np.arange(0, n, step), n-1]))
+        chi2 = np.zeros((yn, xn)) * np.nan
+        starts = {}
+        best_cell = (np.abs(y_points - y.value).argmin(), np.abs(x_points - x.value).argmin())
+        
+        x_vary, y_vary = x.vary, y.vary
+        x.vary, y.vary = False, False
+        nvarys = len([par for par in params.values() if par.vary and par.expr is None])
+        threads = cpu_count() if threads == 'max' else threads
         old = np.seterr(divide='ignore') #turn division errors off temporary
-        x, y, grid = lmfit.conf_interval2d(self.minimizer, xpar, ypar, xn, yn, limits=limits,
-                                           prob_func=prob_func)
-        np.seterr(divide=old['divide'])
+        pool = None
+        if threads > 1:
+            _ci2d_task = (mini, xpar, ypar)
+            pool = Pool(threads)
+        try:
+            #-- first the coarse grid, in rings around the best fit
+            iy, ix = lattice(yn, step), lattice(xn, step)
+            jbest, ibest = iy.searchsorted(best_cell[0]), ix.searchsorted(best_cell[1])
+            cells = [(jj, ii) for jj in iy for ii in ix]
+            ring = np.array([max(abs(j - jbest), abs(i - ibest)) for j in range(len(iy)) \
+                                                                 for i in range(len(ix))])
+            batches = [[cells[k] for k in np.flatnonzero(ring == r)] for r in np.unique(ring)]
+            while True:
+                for batch in batches:
+                    _profile_cells(mini, xpar, ypar, x_points, y_points, batch, chi2, starts,
+                                   org, pool=pool)
+                if step == 1:
+                    break
+                #-- interpolate the current lattice on the next, and only fit the new cells
+                #   of which the neighbours on the current lattice cross a level
+                iy_, ix_ = lattice(yn, step//2), lattice(xn, step//2)
+                coarse = chi2[iy][:,ix]
+                fine = np.array([np.interp(iy_, iy, col) for col in coarse.T]).T
+                fine = np.array([np.interp(ix_, ix, row) for row in fine])
+                batch = []
+                for j, jj in enumerate(iy_):
+                    for i, ii in enumerate(ix_):
+                        if not np.isnan(chi2[jj, ii]):
+                            continue
+                        j1, i1 = min(iy.searchsorted(jj), len(iy)-1), min(ix.searchsorted(ii), len(ix)-1)
+                        j0, i0 = max(j1 - 1, 0), max(i1 - 1, 0)
+                        corners = coarse[[j0, j0, j1, j1], [i0, i1, i0, i1]]
+                        if np.any([(corners.min() <= level) & (level <= corners.max()) for level in levels]):
+                            batch.append((jj, ii))
+                        else:
+                            chi2[jj, ii] = fine[j, i]
+                logger.debug('CI 2D: fitting %i of %i points at step %i'%(len(batch), \
+                                                              len(iy_)*len(ix_), step//2))
+                step = step // 2
+                iy, ix = iy_, ix_
+                batches = [batch]
+        finally:
+            if pool is not None:
+                pool.terminate()
+                _ci2d_task = None
+            x.vary, y.vary = x_vary, y_vary
+            lmfit.confidence.restore_vals(org, params)
+            mini.chisqr = best_chi
+            np.seterr(divide=old['divide'])
+        
+        if ctype == 'prob':
+            ndata = mini.ndata
+            grid = lmfit.confidence.f_compare(ndata, nvarys, chi2, best_chi, nfix=2.) * 100.
+        else:
+            grid = chi2
         
-        if ctype=='prob':
-            grid *= 100.
- 
-        return x, y, grid
+        return x_points, y_points, grid
     
     def calculate_MC_error(self, points=100, errors=None, distribution='gauss', 
                            short_output=True, verbose=True, **kwargs):
@@ -2334,6 +2430,11 @@ class Minimizer(object):
         else:
             self._error = np.ones_like(self.x) * val[0]
         
+    @property
+    def startpars(self):
+        'get the starting parameters of the minimizer grid (same order as grid)'
+        return self._startpars
+    
     @property
     def grid(self):
         'get minimizer grid'
@@ -2370,7 +2471,16 @@ class Minimizer(object):
     
     def _setup_jacobian_function(self):
         "Internal function to setup the jacobian function for the minimizer."
-        if self.model.jacobian != None:
+        if self.model.jacobian != None and self.jacfunc != None:
+            #-- the jacobian of a custom residual function: only the columns of
+            #   the varying parameters are passed to the fitter.
+            def jacobian(params, x, y, weights=None, errors=None, **kwargs):
+                jac = self.model.evaluate_jacobian(x, params, **kwargs)
+                jac = self.jacfunc(jac, y, weights=weights, errors=errors, **kwargs)
+                vary = np.array([params[name].vary for name in self.model.par_names])
+                return jac[:,vary]
+            self.jacobian = jacobian
+        elif self.model.jacobian != None:
             def jacobian(params, x, y, weights=None, errors=None, **kwargs):
                 return self.model.evaluate_jacobian(x, params, **kwargs)
             self.jacobian = jacobian
@@ -2385,39 +2495,78 @@ class Minimizer(object):
         grid_params = params.can_kick(pnames=grid_params)
         minimizers = np.empty(grid_points, dtype=Minimizer)
         
+        #-- make the jacobian available to later refits (e.g. calculate_CI)
+        fit_kws = self.fit_kws
+        if self.jacobian != None and self.engine == 'leastsq':
+            fit_kws = dict(self.fit_kws, Dfun=self.jacobian)
+        
         if grid_points == 1 or len(grid_params) == 0:
             #-- just one fit
             minimizers[0] = lmfit.Minimizer(self.residuals, params, fcn_args=fcn_args,
-                                         fcn_kws=fcn_kws, **self.fit_kws)
+                                         fcn_kws=fcn_kws, **fit_kws)
         else:
             #-- create the minimizer grid
             for i in range(grid_points):
                 params_ = copy.deepcopy(params)
                 params_.kick(pnames=grid_params)
                 minimizers[i] = lmfit.Minimizer(self.residuals, params_, fcn_args=fcn_args,
-                                            fcn_kws=fcn_kws, **self.fit_kws)
+                                            fcn_kws=fcn_kws, **fit_kws)
+        #-- remember where each minimizer started
+        startpars = np.empty(len(minimizers), dtype=object)
+        for i, mini in enumerate(minimizers):
+            startpars[i] = copy.deepcopy(mini.params)
         if append:
             self._minimizers.append(minimizers)
+            self._startpars.append(startpars)
         else:
             self._minimizers = minimizers
+            self._startpars = startpars
         
     def _start_minimize(self, engine, verbose=False, **kwargs):
-        "Internal function that starts all minimizers one by one"
+        "Internal function that starts all minimizers, one by one or in a pool of processes"
+        global _pool_task
         #-- Possible termial output
         if len(self._minimizers) <= 1: verbose = False
         if verbose: print "Grid Minimizer ({:.0f} points):".format(len(self._minimizers))
         if verbose: Pmeter = progress.ProgressMeter(total=len(self._minimizers))
         
+        #-- Keep track of the minima that are found, to stop duplicate starts
+        register = None
+        if len(self._minimizers) > 1 and self.dup_tol != None:
+            register = _MinimaRegister(self.model.parameters, len(self._minimizers),
+                                       self.dup_tol)
+        
         #-- Start all minimizers
-        chisqrs = np.empty_like(self._minimizers, dtype=float)
-        for i, mini in enumerate(self._minimizers):
-            if verbose: Pmeter.update(1)
-            mini.start_minimize(engine, **kwargs)
-            chisqrs[i] = mini.chisqr
+        threads = cpu_count() if self.threads == 'max' else self.threads
+        threads = min(threads, len(self._minimizers))
+        if threads > 1:
+            #-- evaluate the model once before forking, so that the processes
+            #   share everything it caches (e.g. the memoized pixel grids)
+            mini = self._minimizers[0]
+            mini.userfcn(mini.params, *mini.userargs, **mini.userkws)
+            _pool_task = (self._minimizers, engine, register, kwargs)
+            pool = Pool(threads)
+            try:
+                for i, state in pool.imap_unordered(_pool_minimize, range(len(self._minimizers))):
+                    if verbose: Pmeter.update(1)
+                    _set_minimizer_state(self._minimizers[i], state)
+            finally:
+                pool.terminate()
+                _pool_task = None
+        else:
+            for mini in self._minimizers:
+                if verbose: Pmeter.update(1)
+                _run_minimizer(mini, engine, register, **kwargs)
+        chisqrs = np.array([mini.chisqr for mini in self._minimizers], dtype=float)
+        if register != None:
+            stopped = [mini.message == _duplicate_message for mini in self._minimizers]
+            logger.info('Grid minimizer: stopped %i of %i starts running into a known minimum'%\
+                        (sum(stopped), len(chisqrs)))
             
         #-- Sort on chisqr
         inds = chisqrs.argsort()
         self._minimizers = self._minimizers[inds]
+        self._startpars = self._startpars[inds]
         self.model.parameters = self._minimizers[0].params
     
     def _perturb_input_data(self, points, **kwargs):
@@ -2470,8 +2619,158 @@ class Minimizer(object):
     
     #}
 
+class _DuplicateStart(Exception):
+    "Raised to stop a start of the grid minimizer that runs into a known minimum"
+    pass
+
+_duplicate_message = 'Stopped: converging to an already found minimum.'
+
+class _MinimaRegister(object):
+    """
+    Register of the minima found by the starts of a grid minimizer, shared
+    between processes. A start is a duplicate when all its parameters are
+    within C{tol} times their range (or value, if unbounded) of a known minimum.
+    """
+    def __init__(self, params, size, tol):
+        self.names = [name for name, par in params.items() if par.expr == None]
+        self.scales = np.ones(len(self.names))
+        for i, name in enumerate(self.names):
+            par = params[name]
+            if not par.min in (None, -np.inf) and not par.max in (None, np.inf):
+                self.scales[i] = par.max - par.min
+            elif par.value:
+                self.scales[i] = abs(par.value)
+        self.tol = tol
+        self.size = size
+        self.values = Array('d', size*len(self.names))
+        self.count = Value('i', 0)
+    
+    def _get_values(self, params):
+        return np.array([params[name].value for name in self.names], dtype=float)
+    
+    def add(self, params):
+        "Add the parameters of a converged start"
+        with self.count.get_lock():
+            i, n = self.count.value, len(self.names)
+            if i < self.size:
+                self.values[i*n:(i+1)*n] = list(self._get_values(params))
+                self.count.value = i + 1
+    
+    def is_known(self, params):
+        "Check if the given parameters are close to a known minimum"
+        count = self.count.value
+        if count == 0:
+            return False
+        known = np.frombuffer(self.values.get_obj())[:count*len(self.names)]
+        known = known.reshape(count, len(self.names))
+        close = np.abs(known - self._get_values(params)) <= self.tol*self.scales
+        return np.any(np.all(close, axis=1))
+
+def _run_minimizer(mini, engine, register=None, **kwargs):
+    """
+    Start one lmfit minimizer. If a register of known minima is given, the
+    minimizer is stopped as soon as it approaches one of them, and its chisqr
+    is the one of the last evaluation.
+    """
+    iter_cb = mini.iter_cb
+    if register != None:
+        #-- give the minimizer at least one full step before checking
+        nmin = 2*(mini.nvarys + 1)
+        def check_duplicate(params, nfev, out, *args, **kws):
+            if hasattr(iter_cb, '__call__'):
+                iter_cb(params, nfev, out, *args, **kws)
+            if nfev > nmin and register.is_known(params):
+                raise _DuplicateStart(out)
+        mini.iter_cb = check_duplicate
+    try:
+        mini.start_minimize(engine, **kwargs)
+        if register != None:
+            register.add(mini.params)
+    except _DuplicateStart, msg:
+        residual = np.asarray(msg.args[0])
+        mini.residual = residual
+        mini.chisqr = (residual**2).sum()
+        mini.success = False
+        mini.message = _duplicate_message
+    finally:
+        mini.iter_cb = iter_cb
+
+#-- minimizers, engine, register and keywords shared with the pool processes
+_pool_task = None
+
+_state_attributes = ['chisqr', 'redchi', 'nfev', 'ndata', 'nfree', 'nvarys', 'success',
+                     'message', 'ier', 'lmdif_message', 'errorbars', 'covar', 'residual']
+
+def _pool_minimize(i):
+    """
+    Run start i of the shared minimizer grid in a pool process, and return
+    its (picklable) state.
+    """
+    minimizers, engine, register, kwargs = _pool_task
+    mini = minimizers[i]
+    _run_minimizer(mini, engine, register, **kwargs)
+    state = dict([(att, getattr(mini, att)) for att in _state_attributes if hasattr(mini, att)])
+    state['params'] = dict([(name, (par.value, par.stderr, par.correl, par.init_value)) \
+                                    for name, par in mini.params.items()])
+    return i, state
+
+def _set_minimizer_state(mini, state):
+    "Copy the state returned by L{_pool_minimize} to the minimizer"
+    state = state.copy()
+    for name, (value, stderr, correl, init_value) in state.pop('params').items():
+        par = mini.params[name]
+        par.value, par.stderr, par.correl, par.init_value = value, stderr, correl, init_value
+    for att, value in state.items():
+        setattr(mini, att, value)
+
+_ci2d_task = None
+
+def _profile(mini, xpar, ypar, cell, xval, yval, start):
+    """
+    Fit with xpar and ypar fixed at xval and yval, starting the other parameters
+    from the values in start. Returns the cell, the chi square and the best fit.
+    """
+    params = mini.params
+    for name, value in start.items():
+        params[name].value = value
+    params[xpar].value, params[ypar].value = xval, yval
+    mini.prepare_fit([params[xpar], params[ypar]])
+    mini.leastsq()
+    return cell, mini.chisqr, dict([(name, par.value) for name, par in params.items()])
+
+def _pool_profile(task):
+    "Run L{_profile} on the shared minimizer in a pool process"
+    mini, xpar, ypar = _ci2d_task
+    return _profile(mini, xpar, ypar, *task)
+
+def _profile_cells(mini, xpar, ypar, x_points, y_points, cells, chi2, starts, org, pool=None):
+    """
+    Fit the cells (iy, ix) of a 2D confidence grid. Every fit starts from the
+    best fit of the nearest cell in starts (or from the values in org if there
+    are none yet). The chi squares are stored in chi2, the best fits in starts.
+    """
+    if not len(cells):
+        return
+    done = starts.keys()
+    tasks = []
+    for cell in cells:
+        if len(done):
+            dist = ((np.array(done) - np.array(cell))**2).sum(axis=1)
+            start = starts[done[dist.argmin()]]
+        else:
+            start = dict([(name, value) for name, (value, stderr) in org.items()])
+        tasks.append((cell, x_points[cell[1]], y_points[cell[0]], start))
+    if pool is not None:
+        results = pool.map(_pool_profile, tasks)
+    else:
+        results = [_profile(mini, xpar, ypar, *task) for task in tasks]
+    for cell, chisqr, values in results:
+        chi2[cell] = chisqr
+        starts[cell] = values
+
 def minimize(x, y, model, errors=None, weights=None, resfunc=None, engine='leastsq', 
-             args=None, kws=None, scale_covar=True, iter_cb=None, verbose=True, **fit_kws):
+             args=None, kws=None, scale_covar=True, iter_cb=None, verbose=True, 
+             jacfunc=None, **fit_kws):
     """
     Basic minimizer function using the L{Minimizer} class, find values for the parameters
     so that the sum-of-squares of M{(y-model(x))} is minimized. When the fitting process 
@@ -2510,6 +2809,9 @@ def minimize(x, y, model, errors=None, weights=None, resfunc=None, engine='least
     @param weights: The weights given to the different y data
     @param resfunc: A function to calculate the residuals, if not provided standard 
                     residual function is used.
+    @param jacfunc: A function to calculate the jacobian of the custom residual function
+                    from the output of the jacobian of the model, called as 
+                    jacfunc(jac, y, weights=weights, errors=errors, **kws).
     @param engine: Which fitting engine to use: 'leastsq', 'anneal', 'lbfgsb'
     @param kws: Extra keyword arguments to be passed to the model
     @param fit_kws: Extra keyword arguments to be passed to the fitter function
@@ -2520,7 +2822,7 @@ def minimize(x, y, model, errors=None, weights=None, resfunc=None, engine='least
     
     fitter = Minimizer(x, y, model, errors=errors, weights=weights, resfunc=resfunc,
                        engine=engine, args=args, kws=kws,  scale_covar=scale_covar,
-                       iter_cb=iter_cb, verbose=verbose, **fit_kws)
+                       iter_cb=iter_cb, verbose=verbose, jacfunc=jacfunc, **fit_kws)
     if fitter.message and verbose:
         logger.warning(fitter.message)
     return fitter    
@@ -2528,7 +2830,8 @@ def minimize(x, y, model, errors=None, weights=None, resfunc=None, engine='least
 
 def grid_minimize(x, y, model, errors=None, weights=None, resfunc=None, engine='leastsq',
                   args=None, kws=None, scale_covar=True, iter_cb=None, points=100, 
-                  parameters=None, return_all=False, verbose=True, **fit_kws):
+                  parameters=None, return_all=False, verbose=True, jacfunc=None, 
+                  threads=1, dup_tol=None, **fit_kws):
     """                  
     Grid minimizer. Offers the posibility to start minimizing from a grid of starting
     parameters defined by the used. The number of starting points can be specified, as 
@@ -2544,6 +2847,11 @@ def grid_minimize(x, y, model, errors=None, weights=None, resfunc=None, engine='
     has vary = False, it will be kicked by the grid minimizer if it appears in parameters.
     This parameter will then be fixed at its new starting value.
     
+    The starting points can be fitted in parallel on a pool of I{threads} processes. The
+    model is evaluated once before the processes are started, so whatever it caches is
+    shared with them. When I{dup_tol} is given, starting points that run into an already
+    found minimum (all parameters within dup_tol times their range) are stopped early.
+    
     @param parameters: The parameters that you want to randomly chose in the fitting process
     @type parameters: array of strings
     @param points: The number of starting points
@@ -2551,20 +2859,26 @@ def grid_minimize(x, y, model, errors=None, weights=None, resfunc=None, engine='
     @param return_all: if True, the results of all fits are returned, if False, only the 
                        best fit is returned.
     @type return_all: Boolean
+    @param threads: The number of processes to use (or 'max')
+    @type threads: int or str
+    @param dup_tol: Tolerance to stop duplicate starts (None to run all starts till the end)
+    @type dup_tol: float
     
-    @return: The best minimizer, or all minimizers as [minimizers, newmodels, chisqrs]
+    @return: The best minimizer, or all minimizers as [minimizers, startpars, newmodels, chisqrs]
     @rtype: Minimizer object or array of [Minimizer, Model, float]
     """
     
     fitter = Minimizer(x, y, model, errors=errors, weights=weights, resfunc=resfunc,
                        engine=engine, args=args, kws=kws,  scale_covar=scale_covar,
                        iter_cb=iter_cb, grid_points=points, grid_params=parameters,
-                       verbose=verbose, **fit_kws)
+                       verbose=verbose, jacfunc=jacfunc, threads=threads, dup_tol=dup_tol,
+                       **fit_kws)
     if fitter.message and verbose:
         logger.warning(fitter.message)
         
     if return_all:
-        return fitter.grid
+        minimizers, newmodels, chisqrs = fitter.grid
+        return minimizers, fitter.startpars, newmodels, chisqrs
     else:
         return fitter
                       
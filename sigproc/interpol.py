@@ -178,16 +178,23 @@ def create_pixeltypegrid(grid_pars,grid_data):
     pixelgrid[indices] = grid_data.T
     return axis_values, pixelgrid
 
-def interpolate(p, axis_values, pixelgrid):
+def interpolate(p, axis_values, pixelgrid, derivatives=False):
     """
     Interpolates in a grid prepared by create_pixeltypegrid().
     
     p is an array of parameter arrays
     
+    If C{derivatives=True}, also the partial derivatives of the (multilinear)
+    interpolation with respect to each axis are returned. They are exact
+    inside each grid cell, and are computed from the same corner points as the
+    interpolated values, so they come at little extra cost.
+    
     @param p: Npar x Ninterpolate array
     @type p: array
-    @return: Ndata x Ninterpolate array
-    @rtype: array
+    @param derivatives: also return the partial derivatives
+    @type derivatives: bool
+    @return: Ndata x Ninterpolate array (, Npar x Ndata x Ninterpolate array)
+    @rtype: array (, array)
     """
     # convert requested parameter combination into a coordinate
     #p_ = [np.searchsorted(av_,val) for av_, val in zip(axis_values,p)]
@@ -214,8 +221,32 @@ def interpolate(p, axis_values, pixelgrid):
     p_coord = (p-lowervals_stepsize[:,0])/lowervals_stepsize[:,1] + np.array(p_)-1
 
     # interpolate
-    return np.array([ndimage.map_coordinates(pixelgrid[...,i],p_coord, order=1, prefilter=False) \
+    values = np.array([ndimage.map_coordinates(pixelgrid[...,i],p_coord, order=1, prefilter=False) \
                 for i in range(np.shape(pixelgrid)[-1])])
+    if not derivatives:
+        return values
+    
+    #-- derivatives: every corner of the grid cell contributes to the derivative
+    #   along an axis with the product of the weights along the other axes,
+    #   divided by the (local) stepsize along that axis.
+    npar = len(axis_values)
+    lower, frac, steps = [], [], []
+    for av_, coord in zip(axis_values, p_coord):
+        i0 = np.clip(np.floor(coord).astype(int), 0, len(av_)-2)
+        lower.append(i0)
+        frac.append(coord-i0)
+        steps.append(av_[i0+1]-av_[i0])
+    derivs = np.zeros((npar,)+values.shape)
+    for corner in itertools.product([0,1], repeat=npar):
+        corner_values = pixelgrid[tuple([i0+c for i0,c in zip(lower,corner)])].T
+        weights = [(f if c else 1-f) for f,c in zip(frac,corner)]
+        for d in range(npar):
+            w = np.ones(values.shape[-1])
+            for j in range(npar):
+                if j!=d: w = w*weights[j]
+            sign = 1. if corner[d] else -1.
+            derivs[d] += sign*w/steps[d]*corner_values
+    return values, derivs
 
 
 
@@ -11,7 +11,7 @@ function-to-be-minimized (residual function) in terms of these Parameters.
    <newville@cars.uchicago.edu>
 """
 
-from numpy import (dot, eye, ndarray, ones_like,
+from numpy import (array, asarray, dot, eye, ndarray, ones_like,
                    sqrt, take, transpose, triu)
 from numpy.dual import inv
 from numpy.linalg import LinAlgError
@@ -121,6 +121,7 @@ or set  leastsq_kws['maxfev']  to increase this maximum."""
         self.message = None
         self.var_map = []
         self.jacfcn = None
+        self.col_deriv = 0
         self.asteval = Interpreter()
         self.namefinder = NameFinder()
         self.__prepared = False
@@ -187,12 +188,19 @@ or set  leastsq_kws['maxfev']  to increase this maximum."""
         """
         for varname, val in zip(self.var_map, fvars):
             # self.params[varname].value = val
-            self.params[varname].from_internal(val)
+            par = self.params[varname]
+            par.value = par.from_internal(val)
 
         self.nfev = self.nfev + 1
         self.update_constraints()
-        # computing the jacobian
-        return self.jacfcn(self.params, *self.userargs, **self.userkws)
+        # computing the jacobian, and scale it to the internal
+        # (bounded) variables
+        jac = asarray(self.jacfcn(self.params, *self.userargs, **self.userkws))
+        grad = array([self.params[varname].scale_gradient(val)
+                      for varname, val in zip(self.var_map, fvars)])
+        if self.col_deriv:
+            return (jac.transpose()*grad).transpose()
+        return jac*grad
 
     def __set_params(self, params):
         """ set internal self.params from a Parameters object or
@@ -382,6 +390,7 @@ or set  leastsq_kws['maxfev']  to increase this maximum."""
 
         if lskws['Dfun'] is not None:
             self.jacfcn = lskws['Dfun']
+            self.col_deriv = lskws.get('col_deriv', 0)
             lskws['Dfun'] = self.__jacobian
 
         lsout = scipy_leastsq(self.__residual, self.vars, **lskws)
@@ -6,7 +6,8 @@ Unit test covering sigproc.fit.py and sigproc.funclib.py
 import copy
 import numpy as np
 from ivs.sigproc.lmfit import Minimizer
-from ivs.sigproc import fit, lmfit, funclib
+from ivs.sigproc import fit, lmfit, funclib, interpol
+from ivs.sed import fit as sed_fit
 
 import unittest
 try:
@@ -295,7 +296,7 @@ class TestCase4FittingFunction(FitTestCase):
         """ I sigproc.fit.Minimizer Function grid_minimize """
         model = self.model
         points = 100
-        fitters, newmodels, chisqrs = fit.grid_minimize(self.x, self.y, model,
+        fitters, startpars, newmodels, chisqrs = fit.grid_minimize(self.x, self.y, model,
                                             parameters=self.pnames, points=points, 
                                             return_all=True, verbose=False)
         values = newmodels[0].get_parameters()[0]
@@ -303,6 +304,7 @@ class TestCase4FittingFunction(FitTestCase):
         
         msg = 'Not correct amount of fitting points'
         self.assertEqual(len(fitters), points, msg=msg)
+        self.assertEqual(len(startpars), points, msg=msg)
         self.assertEqual(len(newmodels), points, msg=msg)
         self.assertEqual(len(chisqrs), points, msg=msg)
         
@@ -317,7 +319,38 @@ class TestCase4FittingFunction(FitTestCase):
         
         msg = 'Fit did not converge to the correct values'
         self.assertArrayAlmostEqual(values[0:2], self.value[0:2], places=2, msg=msg)
-    
+
+    def test2grid_minimize_parallel(self):
+        """ I sigproc.fit.Minimizer Function grid_minimize in parallel and with dup_tol """
+        points = 20
+        np.random.seed(2222)
+        fitters, startpars, newmodels, chisqrs = fit.grid_minimize(self.x, self.y,
+                                            copy.copy(self.fitFunc), parameters=self.pnames,
+                                            points=points, return_all=True, verbose=False)
+        np.random.seed(2222)
+        fitters_, startpars_, newmodels_, chisqrs_ = fit.grid_minimize(self.x, self.y,
+                                            copy.copy(self.fitFunc), parameters=self.pnames,
+                                            points=points, return_all=True, verbose=False,
+                                            threads=2)
+
+        msg = 'Grid minimizer in parallel does not give the same results'
+        self.assertEqual(len(fitters_), points, msg=msg)
+        self.assertArrayAlmostEqual(chisqrs_, chisqrs, places=6, msg=msg)
+        self.assertArrayAlmostEqual(newmodels_[0].get_parameters()[0],
+                                    newmodels[0].get_parameters()[0], places=6, msg=msg)
+
+        msg = 'Duplicate starts are not stopped'
+        np.random.seed(2222)
+        fitters_, startpars_, newmodels_, chisqrs_ = fit.grid_minimize(self.x, self.y,
+                                            copy.copy(self.fitFunc), parameters=self.pnames,
+                                            points=points, return_all=True, verbose=False,
+                                            dup_tol=0.01)
+        stopped = [mini.message == fit._duplicate_message for mini in fitters_]
+        self.assertEqual(len(fitters_), points, msg=msg)
+        self.assertTrue(0 < sum(stopped) < points, msg=msg)
+        self.assertFalse(stopped[0], msg=msg)
+        self.assertAlmostEqual(chisqrs_[0], chisqrs[0], places=6, msg=msg)
+
     def test3ci_interval(self):
         """ I sigproc.fit.Minimizer Function calculate_CI """
         model = self.model
@@ -397,6 +430,25 @@ class TestCase4FittingFunction(FitTestCase):
         self.assertArrayAlmostEqual(ci[4], exp1, places=2, msg=msg)
         self.assertArrayAlmostEqual(ci[:,4], exp2, places=2, msg=msg)
     
+    def test4ci2d_interval_parallel(self):
+        """ I sigproc.fit.Minimizer Function calculate_CI_2D in parallel and refined """
+        model = self.model
+        
+        result = fit.minimize(self.x, self.y, model)
+        x, y, ci = result.calculate_CI_2D(xpar='ampl', ypar='freq', res=9, ctype='chi2')
+        
+        msg = 'CI values in parallel are not the same'
+        x_, y_, ci_ = result.calculate_CI_2D(xpar='ampl', ypar='freq', res=9, ctype='chi2',
+                                             threads=2)
+        self.assertArrayAlmostEqual(ci_.ravel(), ci.ravel(), places=4, msg=msg)
+        
+        msg = 'Refined CI values are not correct around the contour'
+        level = np.median(ci)
+        x_, y_, ci_ = result.calculate_CI_2D(xpar='ampl', ypar='freq', res=9, ctype='chi2',
+                                             refine=2, levels=[level])
+        self.assertArrayAlmostEqual(x_, x, places=8, msg=msg)
+        self.assertEqual((ci_ <= level).sum(), (ci <= level).sum(), msg=msg)
+    
     def test5mc_error(self):
         """ I sigproc.fit.Minimizer Function calculate_MC_error """
         result = fit.minimize(self.x, self.y, self.model)
@@ -617,6 +669,63 @@ class TestCase6FittingModel(FitTestCase):
         self.assertArrayAlmostEqual(values1, self.value1, places=2)
         self.assertArrayAlmostEqual(values2, self.value2, places=2)
 
+class TestCase8Derivatives(FitTestCase):
+    """
+    Analytic derivatives against finite differences
+    """
+    
+    def testInterpolateDerivatives(self):
+        """ sigproc.interpol.interpolate with derivatives """
+        x, y = np.meshgrid([1., 2., 4., 5.], [0., 0.5, 1.5])
+        grid_pars = np.array([x.ravel(), y.ravel()])
+        grid_data = np.array([x.ravel()*y.ravel() + 2*x.ravel(), 3*y.ravel()**2])
+        axis_values, pixelgrid = interpol.create_pixeltypegrid(grid_pars, grid_data)
+        p = np.array([[1.3, 2.7, 4.2], [0.2, 1.1, 0.7]])
+        
+        values, derivs = interpol.interpolate(p.copy(), axis_values, pixelgrid, derivatives=True)
+        values_ = interpol.interpolate(p.copy(), axis_values, pixelgrid)
+        self.assertEqual(derivs.shape, (2, 2, 3))
+        self.assertArrayAlmostEqual(values.ravel(), values_.ravel(), places=10)
+        
+        msg = 'Derivatives of a bilinear function are not exact'
+        self.assertArrayAlmostEqual(derivs[0, 0], p[1]+2, places=8, msg=msg)
+        self.assertArrayAlmostEqual(derivs[1, 0], p[0], places=8, msg=msg)
+        
+        msg = 'Derivatives do not match finite differences'
+        h = 1e-6
+        for d in range(2):
+            p_up, p_down = p.copy(), p.copy()
+            p_up[d] += h
+            p_down[d] -= h
+            numeric = (interpol.interpolate(p_up, axis_values, pixelgrid) - \
+                       interpol.interpolate(p_down, axis_values, pixelgrid)) / (2*h)
+            self.assertArrayAlmostEqual(derivs[d].ravel(), numeric.ravel(), places=5, msg=msg)
+    
+    def testResidualsJacobian(self):
+        """ sed.fit analytic jacobian of the iminimize residuals """
+        synth = lambda p: np.array([p[0]*p[1], p[0]**2, p[0]+p[1], 3*p[1]])
+        dsynth = lambda p: np.array([[p[1], p[0]], [2*p[0], 0.], [1., 1.], [0., 3.]])
+        meas = np.array([2.1, 1.8, 2.9, 5.7])
+        weights = 1/(0.05*meas)
+        p = np.array([1.4, 1.6])
+        
+        msg = 'Analytic jacobian of the residuals does not match finite differences'
+        h = 1e-6
+        for kwargs in [dict(), dict(distance=1.2)]:
+            jac = sed_fit._iminimize_residuals_jacobian((synth(p), dsynth(p)), meas,
+                                                        weights=weights, **kwargs)
+            self.assertEqual(jac.shape, (4, 2))
+            for d in range(2):
+                p_up, p_down = p.copy(), p.copy()
+                p_up[d] += h
+                p_down[d] -= h
+                res_up = sed_fit._iminimize_residuals((synth(p_up).reshape(-1,1),), meas,
+                                                      weights=weights, **kwargs)
+                res_down = sed_fit._iminimize_residuals((synth(p_down).reshape(-1,1),), meas,
+                                                        weights=weights, **kwargs)
+                numeric = (res_up - res_down) / (2*h)
+                self.assertArrayAlmostEqual(jac[:,d], numeric, places=4, msg=msg)
+
 class TestCase7Funclib(unittest.TestCase):
     
     def testFunclibFunctions(self):